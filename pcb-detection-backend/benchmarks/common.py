@@ -0,0 +1,72 @@
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "benchmarks", "results")
+DATASET_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "pcb-dataset", "pcb")
+
+
+def percentiles(samples):
+    """p50/p95/p99 and mean of a list of seconds, reported in milliseconds"""
+    if not samples:
+        return {"n": 0}
+    values = np.asarray(samples) * 1000.0
+    return {
+        "n": len(samples),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BACKEND_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def machine_info():
+    import cv2
+
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "opencv": cv2.__version__,
+        "opencv_threads": cv2.getNumThreads(),
+    }
+
+
+def write_results(name, results, output=None):
+    """Write results as JSON, by default to benchmarks/results/<name>-<rev>-<time>.json"""
+    results = {
+        "benchmark": name,
+        "revision": git_revision(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": machine_info(),
+        **results,
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIR,
+            f"{name}-{results['revision'] or 'norev'}-{time.strftime('%Y%m%d_%H%M%S')}.json",
+        )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    return output
@@ -0,0 +1,138 @@
+"""Measure board results persisted per second by database.create_pcb_result
+
+    cd pcb-detection-backend
+    python -m benchmarks.db_commits --boards 500
+
+Compares the old persistence (a commit and refresh per image, SQLite's
+default rollback journal with synchronous=FULL) with the single
+transaction, first on the default journal and then on WAL with
+synchronous=NORMAL. Run it on the Pi's SD card with ``--dir`` pointing
+there, tmpfs hides the fsync cost this is about.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .common import percentiles, write_results
+
+MODES = ("per_image_commits", "single_transaction", "single_transaction_wal")
+
+
+def legacy_create_pcb_result(db, model, prepare_result, pcb_id, board_id):
+    """create_pcb_result as it was, nine commits per board"""
+    image_ids = {}
+    for key, image_info in prepare_result["images"].items():
+        image = model.ImagePCB(
+            filepath=image_info["filepath"],
+            filename=image_info["filename"],
+            uploaded_at=datetime.utcnow(),
+        )
+        db.add(image)
+        db.commit()
+        db.refresh(image)
+        image_ids[key] = image.image_id
+
+    db_result = model.Result(
+        accuracy=float(prepare_result["accuracy"]),
+        pcb_result_id=pcb_id,
+        description=prepare_result["result"],
+        board_id=board_id,
+        template_image=image_ids["template"],
+        defective_image=image_ids["defective"],
+        aligned_image=image_ids["aligned"],
+        diff_image=image_ids["diff"],
+        cleaned_image=image_ids["cleaned"],
+        result_image=image_ids["result"],
+    )
+    db.add(db_result)
+    db.commit()
+    db.refresh(db_result)
+
+    pcb = db.query(model.PCB).filter(model.PCB.id == pcb_id).first()
+    if pcb:
+        db.commit()
+        db.refresh(pcb)
+    return db_result
+
+
+def fake_result(board_id, keys):
+    return {
+        "accuracy": 91.5,
+        "result": f"board {board_id}",
+        "images": {
+            key: {"filename": f"{key}_{board_id}.jpg", "filepath": f"uploads/{key}_{board_id}.jpg"}
+            for key in keys
+        },
+    }
+
+
+def run_mode(mode, directory, boards):
+    from src.database import database, model
+
+    engine = create_engine(f"sqlite:///{os.path.join(directory, mode + '.db')}")
+    if mode == "single_transaction_wal":
+        model.configure_sqlite(engine)
+    else:
+        model.configure_sqlite(engine, journal_mode="DELETE", synchronous="FULL")
+    model.Base.metadata.create_all(engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+    pcb = model.PCB()
+    db.add(pcb)
+    db.commit()
+
+    latencies = []
+    started = time.perf_counter()
+    for board_id in range(1, boards + 1):
+        prepare_result = fake_result(board_id, database.RESULT_IMAGE_KEYS)
+        board_started = time.perf_counter()
+        if mode == "per_image_commits":
+            legacy_create_pcb_result(db, model, prepare_result, pcb.id, board_id)
+        else:
+            asyncio.run(database.create_pcb_result(db, prepare_result, pcb.id, board_id))
+        latencies.append(time.perf_counter() - board_started)
+    elapsed = time.perf_counter() - started
+
+    db.close()
+    engine.dispose()
+    return {
+        "boards": boards,
+        "boards_per_s": boards / elapsed,
+        "latency": percentiles(latencies),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--boards", type=int, default=300)
+    parser.add_argument("--dir", default=None, help="where the test databases are created")
+    parser.add_argument("--output", default=None, help="JSON path")
+    args = parser.parse_args(argv)
+
+    results = {"config": vars(args), "modes": {}}
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        # the app's own engine is created on import, keep it off the real database
+        os.environ["PCB_DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'app.db')}"
+        for mode in MODES:
+            results["modes"][mode] = run_mode(mode, directory, args.boards)
+
+    baseline = results["modes"]["per_image_commits"]["boards_per_s"]
+    for mode, result in results["modes"].items():
+        result["speedup"] = result["boards_per_s"] / baseline
+        print(
+            f"{mode:<24} {result['boards_per_s']:8.1f} boards/s"
+            f"  p99 {result['latency']['p99_ms']:7.2f}ms  x{result['speedup']:.1f}"
+        )
+    print(f"\nResults written to {write_results('db_commits', results, args.output)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""Load the server with dashboards and REST clients and measure what it delivers
+
+    cd pcb-detection-backend
+    python -m benchmarks.load --spawn --ws-clients 8 --prepare-rate 0.5 --results-rate 5
+
+Opens ``--ws-clients`` connections to each websocket path and fires
+/api/analysis/prepare and /factory/get_all_pcb_results at fixed rates
+(open loop, a slow server does not slow the clients down). Reports the
+frames/s each websocket client received, request latency percentiles and
+the server CPU read from /metrics. ``--spawn`` starts a local server whose
+camera replays pcb-dataset/pcb (PCB_CAMERA_SIMULATE), otherwise point
+``--url`` at a running server. Needs ``pip install httpx websockets``.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import websockets
+
+from .common import BACKEND_DIR, DATASET_DIR, percentiles, write_results
+
+WS_PATHS = ("/ws/pcb-detection", "/ws/factory-workflow")
+PREPARE_PATH = "/api/analysis/prepare"
+RESULTS_PATH = "/factory/get_all_pcb_results"
+
+
+def parse_metrics(text):
+    """Unlabelled samples of a Prometheus text page"""
+    values = {}
+    for line in text.splitlines():
+        if line.startswith("#") or "{" in line:
+            continue
+        name, _, value = line.partition(" ")
+        try:
+            values[name] = float(value)
+        except ValueError:
+            pass
+    return values
+
+
+async def ws_client(url, path, duration, results):
+    """Count the frames one dashboard receives, a frame is a preview plus a crop"""
+    arrivals = []
+    received_bytes = 0
+    messages = 0
+    error = None
+    started = time.perf_counter()
+    deadline = started + duration
+    try:
+        async with websockets.connect(url + path, max_size=None) as ws:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    message = await asyncio.wait_for(ws.recv(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if messages % 2 == 0:
+                    arrivals.append(time.perf_counter())
+                messages += 1
+                received_bytes += len(message)
+    except Exception as e:
+        error = str(e)
+    elapsed = time.perf_counter() - started
+    gaps = [b - a for a, b in zip(arrivals, arrivals[1:])]
+    results.append(
+        {
+            "path": path,
+            "frames": len(arrivals),
+            "fps": len(arrivals) / elapsed,
+            "kbytes_per_s": received_bytes / elapsed / 1024,
+            "frame_gap": percentiles(gaps),
+            "error": error,
+        }
+    )
+
+
+async def timed_request(client, method, path, kwargs, latencies, errors):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, path, **kwargs)
+        if response.status_code >= 400:
+            errors.append(f"HTTP {response.status_code}")
+    except httpx.HTTPError as e:
+        errors.append(type(e).__name__)
+    latencies.append(time.perf_counter() - started)
+
+
+async def rest_load(client, method, path, make_kwargs, rate, duration):
+    """Send ``rate`` requests per second for ``duration`` seconds"""
+    latencies = []
+    errors = []
+    tasks = []
+    started = time.perf_counter()
+    next_send = started
+    while next_send < started + duration:
+        tasks.append(
+            asyncio.create_task(
+                timed_request(client, method, path, make_kwargs(), latencies, errors)
+            )
+        )
+        next_send += 1.0 / rate
+        await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+    await asyncio.gather(*tasks)
+    return {
+        "target_rate": rate,
+        "sent": len(tasks),
+        "achieved_rate": len(latencies) / (time.perf_counter() - started),
+        "errors": len(errors),
+        "error_kinds": sorted(set(errors)),
+        "latency": percentiles(latencies),
+    }
+
+
+async def sample_cpu(client, interval, stop):
+    """Server CPU utilisation from consecutive /metrics scrapes"""
+    samples = []
+    rss = []
+    previous = None
+    while True:
+        try:
+            values = parse_metrics((await client.get("/metrics")).text)
+            now = time.perf_counter()
+            if previous is not None:
+                samples.append(
+                    (values["pcb_process_cpu_seconds_total"] - previous[1]) / (now - previous[0])
+                )
+            previous = (now, values["pcb_process_cpu_seconds_total"])
+            if "pcb_process_resident_memory_bytes" in values:
+                rss.append(values["pcb_process_resident_memory_bytes"])
+            cpu_count = values.get("pcb_cpu_count")
+        except (httpx.HTTPError, KeyError):
+            cpu_count = None
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+            break
+        except asyncio.TimeoutError:
+            pass
+    if not samples:
+        return {"samples": 0}
+    mean = sum(samples) / len(samples)
+    return {
+        "samples": len(samples),
+        "cpu_count": cpu_count,
+        "mean_cores": mean,
+        "max_cores": max(samples),
+        "mean_percent": mean / cpu_count * 100 if cpu_count else None,
+        "max_rss_bytes": max(rss) if rss else None,
+    }
+
+
+def prepare_files(template_path, defective_path):
+    with open(template_path, "rb") as f:
+        template = f.read()
+    with open(defective_path, "rb") as f:
+        defective = f.read()
+    return lambda: {
+        "files": [
+            ("files", ("template.jpg", template, "image/jpeg")),
+            ("files", ("defective.jpg", defective, "image/jpeg")),
+        ]
+    }
+
+
+async def run(args):
+    ws_url = "ws" + args.url[len("http"):]
+    ws_paths = [path for path in args.ws_paths.split(",") if path]
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+        stop = asyncio.Event()
+        cpu_task = asyncio.create_task(sample_cpu(client, args.sample_interval, stop))
+
+        ws_results = []
+        jobs = [
+            ws_client(ws_url, path, args.duration, ws_results)
+            for path in ws_paths
+            for _ in range(args.ws_clients)
+        ]
+        rest_names = []
+        if args.prepare_rate > 0:
+            rest_names.append(PREPARE_PATH)
+            jobs.append(
+                rest_load(
+                    client,
+                    "POST",
+                    PREPARE_PATH,
+                    prepare_files(args.template, args.defective),
+                    args.prepare_rate,
+                    args.duration,
+                )
+            )
+        if args.results_rate > 0:
+            rest_names.append(RESULTS_PATH)
+            jobs.append(
+                rest_load(client, "GET", RESULTS_PATH, dict, args.results_rate, args.duration)
+            )
+
+        outcomes = await asyncio.gather(*jobs)
+        stop.set()
+        cpu = await cpu_task
+
+    rest = dict(zip(rest_names, outcomes[len(outcomes) - len(rest_names):]))
+    websocket = {}
+    for path in ws_paths:
+        clients = [result for result in ws_results if result["path"] == path]
+        if not clients:
+            continue
+        websocket[path] = {
+            "clients": len(clients),
+            "fps_per_client": [client["fps"] for client in clients],
+            "min_fps": min(client["fps"] for client in clients),
+            "mean_fps": sum(client["fps"] for client in clients) / len(clients),
+            "errors": [client["error"] for client in clients if client["error"]],
+            "detail": clients,
+        }
+    return {"websocket": websocket, "rest": rest, "server_cpu": cpu}
+
+
+def spawn_server(args):
+    env = dict(os.environ)
+    env.setdefault("PCB_CAMERA_SIMULATE", args.dataset)
+    env.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+    port = args.url.rsplit(":", 1)[-1].strip("/")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "src.app:app", "--port", port, "--log-level", "warning"],
+        cwd=args.server_cwd,
+        env={**env, "PYTHONPATH": BACKEND_DIR},
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}")
+        try:
+            if httpx.get(args.url + "/api/", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    server.terminate()
+    raise RuntimeError("Server did not start in 30s")
+
+
+def print_summary(results):
+    for path, info in results["websocket"].items():
+        print(
+            f"{path:<32} {info['clients']} clients  fps min {info['min_fps']:.1f}"
+            f"  mean {info['mean_fps']:.1f}  errors {len(info['errors'])}"
+        )
+    for path, info in results["rest"].items():
+        latency = info["latency"]
+        print(
+            f"{path:<32} {info['achieved_rate']:.2f}/s  p50 {latency.get('p50_ms', 0):.0f}ms"
+            f"  p99 {latency.get('p99_ms', 0):.0f}ms  errors {info['errors']}"
+        )
+    cpu = results["server_cpu"]
+    if cpu.get("samples"):
+        print(
+            f"server CPU {cpu['mean_cores']:.2f} cores mean, {cpu['max_cores']:.2f} max"
+            f" of {cpu['cpu_count']}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--ws-clients", type=int, default=4, help="clients per websocket path")
+    parser.add_argument("--ws-paths", default=",".join(WS_PATHS))
+    parser.add_argument("--prepare-rate", type=float, default=0.5, help="requests/s, 0 disables")
+    parser.add_argument("--results-rate", type=float, default=5.0, help="requests/s, 0 disables")
+    parser.add_argument("--template", default=os.path.join(DATASET_DIR, "1_pcb_output3197.jpg"))
+    parser.add_argument("--defective", default=os.path.join(DATASET_DIR, "1_pcb_output4189.jpg"))
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--sample-interval", type=float, default=1.0)
+    parser.add_argument("--spawn", action="store_true", help="start a server with a simulated camera")
+    parser.add_argument("--server-cwd", default=BACKEND_DIR, help="holds database.db/ for --spawn")
+    parser.add_argument("--dataset", default=DATASET_DIR)
+    parser.add_argument("--output", default=None, help="JSON path")
+    args = parser.parse_args(argv)
+
+    server = spawn_server(args) if args.spawn else None
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(10)
+
+    results = {"config": vars(args), **results}
+    print_summary(results)
+    print(f"\nResults written to {write_results('load', results, args.output)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
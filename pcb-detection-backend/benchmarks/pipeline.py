@@ -0,0 +1,288 @@
+"""Benchmark board localization and inspection over pcb-dataset/pcb
+
+    cd pcb-detection-backend
+    python -m benchmarks.pipeline --variants dataset,vga,1080p --workers 1,2,4
+
+Every variant reports p50/p95/p99 latency of localization (HSV mask,
+contours, warp) and of the analysis path (registration, diff, artifact
+encode and write), the mean time of each stage, throughput with 1..N
+worker threads and the tracemalloc peak of each stage. Results go to
+benchmarks/results/ as JSON so runs can be compared across commits.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from src.function.artifacts import ARTIFACT_NAMES, store_artifact
+from src.function.detection_pcb import detect_boards, four_point_transform
+from src.function.image_store import SegmentStore
+from src.function.inspection import InspectionEngine
+from src.function.memory import memory_tracker
+from src.function.metrics import stage, stage_seconds
+
+from .common import DATASET_DIR, percentiles, write_results
+
+# None keeps the dataset images at their own size
+VARIANTS = {
+    "dataset": None,
+    "vga": (640, 480),
+    "1080p": (1920, 1080),
+    "12mp": (4000, 3000),
+}
+# Fraction of the frame width the board covers in the synthetic scenes
+BOARD_FILL = 0.6
+
+
+def load_dataset(directory):
+    images = []
+    for name in sorted(os.listdir(directory)):
+        image = cv2.imread(os.path.join(directory, name))
+        if image is not None:
+            images.append((name, image))
+    return images
+
+
+def perturb(image, seed):
+    """The same board slightly rotated, shifted, darker and noisier"""
+    rng = np.random.default_rng(seed)
+    height, width = image.shape[:2]
+    M = cv2.getRotationMatrix2D(
+        (width / 2, height / 2), float(rng.uniform(-2, 2)), float(rng.uniform(0.98, 1.02))
+    )
+    M[:, 2] += rng.uniform(-4, 4, size=2)
+    moved = cv2.warpAffine(image, M, (width, height), borderMode=cv2.BORDER_REPLICATE)
+    noise = rng.normal(0, 4, image.shape)
+    return np.clip(moved * rng.uniform(0.9, 1.0) + noise, 0, 255).astype(np.uint8)
+
+
+def make_pairs(images):
+    """(name, template, defective) pairs, boards of one type share a prefix
+
+    The first image of a type is the template of the others, a board with
+    no sibling is compared against a perturbed copy of itself.
+    """
+    groups = {}
+    for name, image in images:
+        groups.setdefault(name.split("_pcb")[0], []).append((name, image))
+
+    pairs = []
+    for members in groups.values():
+        template = members[0][1]
+        if len(members) == 1:
+            pairs.append((members[0][0], template, perturb(template, 0)))
+            continue
+        for name, image in members[1:]:
+            pairs.append((name, template, image))
+    return pairs
+
+
+def scene(board, size, seed):
+    """Place a board on a dark belt background of the given frame size"""
+    rng = np.random.default_rng(seed)
+    if size is None:
+        height, width = board.shape[:2]
+        size = (int(width * 1.6), int(height * 1.6))
+    frame_width, frame_height = size
+    frame = np.full((frame_height, frame_width, 3), 35, np.uint8)
+    frame = cv2.add(frame, rng.integers(0, 10, frame.shape, dtype=np.uint8))
+
+    board = scale_board(board, size)
+    height, width = board.shape[:2]
+    x = (frame_width - width) // 2
+    y = (frame_height - height) // 2
+    frame[y : y + height, x : x + width] = board
+    return frame
+
+
+def scale_board(board, size):
+    if size is None:
+        return board
+    frame_width, frame_height = size
+    height, width = board.shape[:2]
+    scale = min(frame_width * BOARD_FILL / width, frame_height * 0.9 / height)
+    return cv2.resize(board, (int(width * scale), int(height * scale)))
+
+
+def localize(frame):
+    boards = detect_boards(frame)
+    for board in boards:
+        if board["quad"] is not None:
+            return four_point_transform(frame, board["quad"])
+    return None
+
+
+def write_artifacts(inspected, store):
+    """The "full" level of save_pcb_artifacts, into a scratch image store"""
+    if not inspected["detected"]:
+        return
+    with stage("artifact_write"):
+        for name in ARTIFACT_NAMES:
+            store.put(*store_artifact(name, inspected["images"][name]))
+
+
+def stage_means(before, after):
+    means = {}
+    for name, totals in after.items():
+        count = totals["count"] - before.get(name, {}).get("count", 0)
+        seconds = totals["sum"] - before.get(name, {}).get("sum", 0.0)
+        if count:
+            means[name] = {"calls": count, "mean_ms": seconds / count * 1000.0}
+    return means
+
+
+def run_variant(variant, pairs, repeat, workers, directory):
+    size = VARIANTS[variant]
+    engine = InspectionEngine()
+    stores = []
+    workload = [
+        (name, scene(defective, size, seed), scale_board(template, size), scale_board(defective, size))
+        for seed, (name, template, defective) in enumerate(pairs)
+    ]
+
+    def new_store():
+        # one store per pass over the workload, a second put of the same
+        # artifact would only be a dedup hit
+        store = SegmentStore(os.path.join(directory, variant, str(len(stores))))
+        stores.append(store)
+        return store
+
+    def analyze(template, defective, store):
+        inspected = engine.run(template, defective)
+        write_artifacts(inspected, store)
+        return inspected
+
+    # warm up the allocators and OpenCV's thread pool
+    localize(workload[0][1])
+    analyze(workload[0][2], workload[0][3], new_store())
+
+    localize_times = []
+    analyze_times = []
+    found = 0
+    registered = 0
+    before = stage_seconds.snapshot()
+    for _ in range(repeat):
+        store = new_store()
+        for _, frame, template, defective in workload:
+            started = time.perf_counter()
+            found += localize(frame) is not None
+            localize_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            registered += analyze(template, defective, store)["detected"]
+            analyze_times.append(time.perf_counter() - started)
+    stages = stage_means(before, stage_seconds.snapshot())
+
+    throughput = {}
+    for worker_count in workers:
+        pass_stores = [new_store() for _ in range(repeat)]
+        jobs = [(item, store) for store in pass_stores for item in workload]
+        with ThreadPoolExecutor(max_workers=worker_count) as pool:
+            started = time.perf_counter()
+            list(pool.map(lambda item: localize(item[1]), workload * repeat))
+            localize_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            list(pool.map(lambda job: analyze(job[0][2], job[0][3], job[1]), jobs))
+            analyze_seconds = time.perf_counter() - started
+        throughput[str(worker_count)] = {
+            "localize_per_s": len(workload) * repeat / localize_seconds,
+            "analyze_per_s": len(workload) * repeat / analyze_seconds,
+        }
+
+    # one extra single-threaded pass so the tracemalloc peaks are exact
+    memory_tracker.reset()
+    memory_tracker.enable()
+    try:
+        store = new_store()
+        for _, frame, template, defective in workload:
+            localize(frame)
+            analyze(template, defective, store)
+        memory = {
+            name: {"peak_bytes": stats["peak_bytes"], "mean_peak_bytes": stats["mean_peak_bytes"]}
+            for name, stats in memory_tracker.report()["stages"].items()
+        }
+    finally:
+        memory_tracker.disable()
+        for store in stores:
+            store.stop()
+
+    frame_height, frame_width = workload[0][1].shape[:2]
+    return {
+        "frame_size": [frame_width, frame_height],
+        "images": len(workload),
+        "repeat": repeat,
+        "boards_localized": found,
+        "boards_registered": registered,
+        "localize": percentiles(localize_times),
+        "analyze": percentiles(analyze_times),
+        "stages": stages,
+        "throughput": throughput,
+        "memory": memory,
+    }
+
+
+def print_summary(results):
+    for variant, result in results["variants"].items():
+        width, height = result["frame_size"]
+        print(f"\n== {variant} ({width}x{height}, {result['images']} boards)")
+        for path in ("localize", "analyze"):
+            p = result[path]
+            print(
+                f"  {path:<9} p50 {p['p50_ms']:8.1f}ms  p95 {p['p95_ms']:8.1f}ms"
+                f"  p99 {p['p99_ms']:8.1f}ms"
+            )
+        for workers, rates in result["throughput"].items():
+            print(
+                f"  {workers} worker(s): localize {rates['localize_per_s']:7.1f}/s"
+                f"  analyze {rates['analyze_per_s']:6.2f}/s"
+            )
+        for name, info in sorted(result["stages"].items()):
+            peak = result["memory"].get(name, {}).get("peak_bytes", 0) / 1024 / 1024
+            print(f"  {name:<15} {info['mean_ms']:8.2f}ms  peak {peak:7.1f}MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dataset", default=DATASET_DIR)
+    parser.add_argument("--variants", default="dataset,vga,1080p,12mp")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-images", type=int, default=None)
+    parser.add_argument("--cv-threads", type=int, default=None, help="cv2.setNumThreads")
+    parser.add_argument("--output", default=None, help="JSON path")
+    args = parser.parse_args(argv)
+
+    if args.cv_threads is not None:
+        cv2.setNumThreads(args.cv_threads)
+    variants = [variant.strip() for variant in args.variants.split(",")]
+    unknown = [variant for variant in variants if variant not in VARIANTS]
+    if unknown:
+        parser.error(f"unknown variants {unknown}, choose from {list(VARIANTS)}")
+    workers = [int(count) for count in args.workers.split(",")]
+
+    pairs = make_pairs(load_dataset(args.dataset))[: args.max_images]
+    if not pairs:
+        print(f"No images in {args.dataset}", file=sys.stderr)
+        return 1
+
+    results = {"config": vars(args), "variants": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for variant in variants:
+            print(f"Running {variant}...", file=sys.stderr)
+            results["variants"][variant] = run_variant(
+                variant, pairs, args.repeat, workers, directory
+            )
+
+    print_summary(results)
+    print(f"\nResults written to {write_results('pipeline', results, args.output)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
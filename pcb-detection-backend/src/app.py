@@ -1,8 +1,36 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .routes import factoryWorkflow, pcb_detection, upload, websocket
+from fastapi.responses import PlainTextResponse
+from .function import metrics
+from .function.governor import governor
+from .function.heatmap import heatmap_store
+from .function.image_store import image_store
+from .function.loop_monitor import loop_monitor
+from .function.persistence import persistence_queue
+from .function.profiler import RouteTagMiddleware, profiler
+from .routes import factoryWorkflow, pcb_detection, system, upload, websocket
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    governor.start()
+    loop_monitor.start()
+    persistence_queue.start()
+    image_store.start()
+    profiler.attach(asyncio.get_running_loop())
+    yield
+    # boards already actuated must reach the database before we exit
+    await asyncio.to_thread(persistence_queue.stop)
+    await asyncio.to_thread(image_store.stop)
+    await asyncio.to_thread(heatmap_store.flush)
+    await loop_monitor.stop()
+    await governor.stop()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",            # กรณีเปิดจากตัวเครื่องเอง
@@ -17,8 +45,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(RouteTagMiddleware)
 
 app.include_router(pcb_detection.router, prefix="/api")
 app.include_router(websocket.router, prefix="/ws")
 app.include_router(upload.router, prefix="/api/image")
 app.include_router(factoryWorkflow.router, prefix="/factory")
+app.include_router(system.router, prefix="/api/system")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4"
+    )
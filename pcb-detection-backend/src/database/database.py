@@ -5,7 +5,29 @@ from datetime import datetime
 from fastapi import UploadFile
 import uuid
 import base64
-from sqlalchemy import func
+import json
+import logging
+import threading
+from sqlalchemy import delete, func, insert, text, update
+from ..function.artifacts import (
+    ARTIFACT_LEVELS,
+    DEFAULT_ARTIFACT_LEVEL,
+    artifact_cache,
+    display_artifact,
+    regenerate_artifacts,
+)
+from ..function.heatmap import heatmap_store
+from ..function.image_store import image_store
+from ..function.masks import MASK_ARTIFACTS, MASK_EXT, mask_stats
+from ..function.metrics import stage
+
+logger = logging.getLogger(__name__)
+
+RESULT_IMAGE_KEYS = ("template", "defective", "aligned", "diff", "cleaned", "result")
+RESULT_IMAGE_COLUMNS = tuple(f"{key}_image" for key in RESULT_IMAGE_KEYS)
+# Served by the factory router, a list view links to the artifacts it does
+# not have on disk instead of regenerating them
+RESULT_IMAGE_URL = "/factory/get_result_image/{result_id}/{name}"
 
 
 def save_uploaded_file(file: UploadFile, upload_dir: str = "uploads"):
@@ -22,6 +44,79 @@ def save_uploaded_file(file: UploadFile, upload_dir: str = "uploads"):
     return unique_filename, file_path
 
 
+# Held from an image_store.put to the commit of the rows referencing it,
+# and by remove_blobs: a put deduplicated against a blob that is being
+# freed then either commits its reference first, so the blob is kept, or
+# runs after the remove and revives the dead record.
+blob_lock = threading.RLock()
+
+
+def new_image(db: Session, filename: str, filepath: str, uploaded_at=None):
+    """Add an ImagePCB row, holding a reference on its blob when it has one"""
+    digest = image_store.digest_of(filepath)
+    if digest is not None:
+        # counted in SQL, concurrent sessions never overwrite each other
+        referenced = db.execute(
+            update(model.Blob)
+            .where(model.Blob.digest == digest)
+            .values(refcount=model.Blob.refcount + 1)
+        )
+        if referenced.rowcount == 0:
+            db.add(
+                model.Blob(
+                    digest=digest,
+                    filepath=filepath,
+                    size=image_store.size(filepath),
+                    refcount=1,
+                )
+            )
+            # later rows of this transaction must find it
+            db.flush()
+    image = model.ImagePCB(
+        filename=filename,
+        filepath=filepath,
+        uploaded_at=uploaded_at or datetime.utcnow(),
+        blob_digest=digest,
+    )
+    db.add(image)
+    return image
+
+
+def delete_image(db: Session, image, freed: list):
+    """Delete an ImagePCB row, appending the blob paths nobody references anymore
+
+    The caller passes ``freed`` to remove_blobs once the transaction commits.
+    """
+    db.delete(image)
+    if image.blob_digest is None:
+        return
+    db.execute(
+        update(model.Blob)
+        .where(model.Blob.digest == image.blob_digest)
+        .values(refcount=model.Blob.refcount - 1)
+    )
+    unreferenced = db.execute(
+        delete(model.Blob).where(
+            model.Blob.digest == image.blob_digest, model.Blob.refcount <= 0
+        )
+    )
+    if unreferenced.rowcount:
+        freed.append(image.filepath)
+
+
+def remove_blobs(db: Session, paths):
+    """Remove freed blobs from the store, unless a new reference appeared"""
+    with blob_lock:
+        for path in paths:
+            digest = image_store.digest_of(path)
+            if (
+                digest is not None
+                and db.query(model.Blob.digest).filter(model.Blob.digest == digest).first()
+            ):
+                continue
+            image_store.remove(path)
+
+
 async def create_pcb(
     db: Session,
 ):
@@ -52,14 +147,14 @@ async def upload_and_create_pcb(
 
     # contents = await file.read()
 
+    return insert_pcb(db, filename, filepath)
+
+
+def insert_pcb(db: Session, filename: str, filepath: str):
+    """Blocking body of upload_and_create_pcb, for a worker thread"""
     # Create image record
-    db_image = model.ImagePCB(
-        filename=filename,
-        filepath=filepath,
-        # filename=file.filename, image_data=contents,
-        uploaded_at=datetime.utcnow(),
-    )
-    db.add(db_image)
+    db_image = new_image(db, filename, filepath)
+    image_store.flush()
     db.commit()
     db.refresh(db_image)
 
@@ -82,6 +177,7 @@ async def create_pcb_result(
     db: Session,
     prepare_result: dict,
     pcb_id: int,
+    board_id: int = None,
 ):
     # def print_dict_structure(d, indent=0):
     #     for key, value in d.items():
@@ -98,49 +194,264 @@ async def create_pcb_result(
     # print("Creating PCB result in database...")
     # print(prepare_result["result"])
 
-    images_data = prepare_result["images"]
+    return insert_pcb_result(db, prepare_result, pcb_id, board_id)
 
-    def add_image_and_get_id(db: Session, filepath: str, filename: str) -> int:
-        image = model.ImagePCB(
-            filepath=filepath,
-            filename=filename,
-            uploaded_at=datetime.utcnow(),
-        )
-        db.add(image)
-        db.commit()
-        db.refresh(image)
-        return image.image_id
-
-    image_ids = {}
-    for key in ["template", "defective", "aligned", "diff", "cleaned", "result"]:
-        image_info = images_data[key]
-        image_ids[key] = add_image_and_get_id(
-            db, image_info["filepath"], image_info["filename"]
-        )
 
-    db_result = model.Result(
-        accuracy=float(prepare_result["accuracy"]),
-        pcb_result_id=pcb_id,
-        description=prepare_result["result"],
-        template_image=image_ids["template"],
-        defective_image=image_ids["defective"],
-        aligned_image=image_ids["aligned"],
-        diff_image=image_ids["diff"],
-        cleaned_image=image_ids["cleaned"],
-        result_image=image_ids["result"],
-    )
+def insert_pcb_result(db: Session, prepare_result: dict, pcb_id: int, board_id: int = None):
+    """Blocking body of create_pcb_result, for the persistence worker thread"""
+    with stage("db_commit"):
+        uploaded_at = datetime.utcnow()
+        # one transaction, the flush only assigns the image ids
+        try:
+            # only the images the product's artifact level wrote
+            images = {
+                key: new_image(db, image_info["filename"], image_info["filepath"], uploaded_at)
+                for key, image_info in prepare_result["images"].items()
+            }
+            db.flush()
+
+            def image_id(key):
+                return images[key].image_id if key in images else None
+
+            db_result = model.Result(
+                accuracy=float(prepare_result["accuracy"]),
+                pcb_result_id=pcb_id,
+                description=prepare_result["result"],
+                board_id=board_id,
+                template_image=image_id("template"),
+                defective_image=image_id("defective"),
+                aligned_image=image_id("aligned"),
+                diff_image=image_id("diff"),
+                cleaned_image=image_id("cleaned"),
+                result_image=image_id("result"),
+                capture_image=image_id("capture"),
+                artifact_level=prepare_result.get("artifact_level"),
+                params=prepare_result.get("params"),
+            )
+            db.add(db_result)
+            defects = prepare_result.get("defects")
+            if defects:
+                db.flush()
+                db.execute(
+                    insert(model.Defect),
+                    [
+                        dict(defect, result_id=db_result.results_id, pcb_id=pcb_id)
+                        for defect in defects
+                    ],
+                )
+            # the blobs are durable before any row points at them
+            image_store.flush()
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
 
-    db.add(db_result)
-    db.commit()
-    db.refresh(db_result)
+    return db_result
+
+
+def get_next_board_id(db: Session):
+    last_board_id = db.query(func.max(model.Result.board_id)).scalar()
+    return (last_board_id or 0) + 1
+
+
+def get_artifact_level(db: Session, pcb_id: int):
+    level = db.query(model.PCB.artifact_level).filter(model.PCB.id == pcb_id).scalar()
+    return level or DEFAULT_ARTIFACT_LEVEL
 
+
+def set_artifact_level(db: Session, pcb_id: int, level: str):
+    if level not in ARTIFACT_LEVELS:
+        raise ValueError(f"Unknown artifact level {level}, choose from {ARTIFACT_LEVELS}")
     pcb = db.query(model.PCB).filter(model.PCB.id == pcb_id).first()
-    if pcb:
-        pcb.result_id = db_result.results_id
-        db.commit()
-        db.refresh(pcb)
+    if not pcb:
+        return None
+    pcb.artifact_level = level
+    db.commit()
+    return pcb
+
+
+def read_image_file(db: Session, image_id: int):
+    image = db.query(model.ImagePCB).filter_by(image_id=image_id).first()
+    if image is None:
+        return None
+    return image_store.read_bytes(image.filepath)
+
+
+def regenerate_result_images(db: Session, resultData):
+    """(bytes, ext) of a result's artifacts rebuilt from its capture, {} if it cannot be"""
+    if not resultData.params or not resultData.capture_image:
+        return {}
+    params = json.loads(resultData.params)
+
+    def build():
+        template_id = params.get("template_image")
+        if template_id is None:
+            template_id = (
+                db.query(model.PCB.originalPcb)
+                .filter(model.PCB.id == resultData.pcb_result_id)
+                .scalar()
+            )
+        template_bytes = read_image_file(db, template_id)
+        capture_bytes = read_image_file(db, resultData.capture_image)
+        if template_bytes is None or capture_bytes is None:
+            raise FileNotFoundError("Template or capture file is missing")
+        return regenerate_artifacts(template_bytes, capture_bytes, params)
+
+    try:
+        return artifact_cache.get(resultData.results_id, build)
+    except (OSError, ValueError) as e:
+        logger.error(f"Cannot regenerate result {resultData.results_id}: {str(e)}")
+        return {}
 
-    return db_result
+
+def result_image_list(db: Session, resultData, columns=RESULT_IMAGE_COLUMNS, regenerate=True):
+    """Stored images of a result, the missing ones regenerated from its capture
+
+    With ``regenerate=False`` a missing image only gets its ``image_url``,
+    list views must not rebuild every board they show.
+    """
+    imageList = {key: None for key in columns}
+
+    for key in columns:
+        image_id = getattr(resultData, key, None)
+        image = db.query(model.ImagePCB).filter_by(image_id=image_id).first()
+        image_bytes = image_store.read_bytes(image.filepath) if image else None
+        if image_bytes is not None:
+            imageList[key] = {
+                "image_id": image.image_id,
+                "filename": image.filename,
+                "filepath": image.filepath,
+                "uploaded_at": (
+                    image.uploaded_at.isoformat() if image.uploaded_at else None
+                ),
+                "image_data": base64.b64encode(
+                    display_artifact(image.filepath, image_bytes)
+                ).decode("utf-8"),
+            }
+
+    if not regenerate:
+        if resultData.params and resultData.capture_image:
+            for key, image in imageList.items():
+                name = key[: -len("_image")]
+                if image is None:
+                    imageList[key] = {
+                        "image_id": None,
+                        "filename": f"{name}_{resultData.results_id}.jpg",
+                        "filepath": None,
+                        "uploaded_at": None,
+                        "image_data": None,
+                        "image_url": RESULT_IMAGE_URL.format(
+                            result_id=resultData.results_id, name=name
+                        ),
+                    }
+        return imageList
+
+    if any(image is None for image in imageList.values()):
+        regenerated = regenerate_result_images(db, resultData)
+        for key, image in imageList.items():
+            name = key[: -len("_image")]
+            if image is None and name in regenerated:
+                image_bytes, ext = regenerated[name]
+                filename = f"{name}_{resultData.results_id}{ext}"
+                imageList[key] = {
+                    "image_id": None,
+                    "filename": filename,
+                    "filepath": None,
+                    "uploaded_at": None,
+                    "image_data": base64.b64encode(
+                        display_artifact(filename, image_bytes)
+                    ).decode("utf-8"),
+                    "regenerated": True,
+                }
+    return imageList
+
+
+def result_image(db: Session, result_id: int, name: str):
+    """JPEG bytes of one artifact of a result, regenerated when not stored"""
+    if name not in RESULT_IMAGE_KEYS:
+        return None
+    resultData = db.query(model.Result).filter(model.Result.results_id == result_id).first()
+    if resultData is None:
+        return None
+    image = db.query(model.ImagePCB).filter_by(
+        image_id=getattr(resultData, f"{name}_image")
+    ).first()
+    image_bytes = image_store.read_bytes(image.filepath) if image else None
+    if image_bytes is not None:
+        return display_artifact(image.filepath, image_bytes)
+    image_bytes, ext = regenerate_result_images(db, resultData).get(name, (None, None))
+    if image_bytes is None:
+        return None
+    return display_artifact(f"{name}{ext}", image_bytes)
+
+
+DEFECT_COLUMNS = (
+    "id", "result_id", "x", "y", "width", "height", "area", "cx", "cy", "mean_intensity"
+)
+
+
+def query_defects(db: Session, pcb_id: int, region=None, result_id=None):
+    """Defects of a product, those whose box meets ``region`` (x0, y0, x1, y1)
+
+    The region goes through the defect_rtree R*Tree, which carries the
+    pcb_id, so only the matching rows of the defect table are read. Without
+    the index (not SQLite) the boxes are compared on the defect table.
+    """
+    columns = ", ".join(f"d.{name}" for name in DEFECT_COLUMNS)
+    params = {"pcb_id": pcb_id}
+    if region is None:
+        sql = f"SELECT {columns} FROM defect d WHERE d.pcb_id = :pcb_id"
+    else:
+        x0, y0, x1, y1 = region
+        params.update(
+            x0=min(x0, x1), x1=max(x0, x1), y0=min(y0, y1), y1=max(y0, y1)
+        )
+        if model.has_defect_index:
+            sql = (
+                f"SELECT {columns} FROM defect_rtree r JOIN defect d ON d.id = r.id"
+                " WHERE r.min_x <= :x1 AND r.max_x >= :x0"
+                " AND r.min_y <= :y1 AND r.max_y >= :y0 AND r.pcb_id = :pcb_id"
+            )
+        else:
+            sql = (
+                f"SELECT {columns} FROM defect d WHERE d.pcb_id = :pcb_id"
+                " AND d.x <= :x1 AND d.x + d.width - 1 >= :x0"
+                " AND d.y <= :y1 AND d.y + d.height - 1 >= :y0"
+            )
+    if result_id is not None:
+        sql += " AND d.result_id = :result_id"
+        params["result_id"] = result_id
+    rows = db.execute(text(sql + " ORDER BY d.id"), params).all()
+    return [dict(zip(DEFECT_COLUMNS, row)) for row in rows]
+
+
+def result_mask_stats(db: Session, result_id: int):
+    """Defect area and bounding box of each mask artifact of a result
+
+    Read from the stored RLE, or the regenerated one of a "minimal" result;
+    None for a mask stored as JPEG before masks were packed. None for an
+    unknown result.
+    """
+    resultData = db.query(model.Result).filter(model.Result.results_id == result_id).scalar()
+    if resultData is None:
+        return None
+
+    stats = {}
+    regenerated = None
+    for name in MASK_ARTIFACTS:
+        image = db.query(model.ImagePCB).filter_by(
+            image_id=getattr(resultData, f"{name}_image")
+        ).first()
+        if image is not None:
+            image_bytes = image_store.read_bytes(image.filepath)
+            packed = image.filepath.endswith(MASK_EXT) and image_bytes is not None
+            stats[name] = mask_stats(image_bytes) if packed else None
+            continue
+        if regenerated is None:
+            regenerated = regenerate_result_images(db, resultData)
+        image_bytes, ext = regenerated.get(name, (None, None))
+        stats[name] = mask_stats(image_bytes) if ext == MASK_EXT else None
+    return stats
 
 
 async def create_pcb_image(db: Session, file: UploadFile, pcb_id: int):
@@ -167,12 +478,11 @@ def get_pcb(db: Session, pcb_id: int):
     if image_path is None:
         raise FileNotFoundError(f"No image path found for PCB id: {pcb_id}")
 
-    if not os.path.exists(image_path):
+    # a blob of the image store or a plain file
+    image_bytes = image_store.read_bytes(image_path)
+    if image_bytes is None:
         raise FileNotFoundError(f"Image file not found at: {image_path}")
 
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
-
     imageData = (
         db.query(model.ImagePCB)
         .join(model.PCB, model.ImagePCB.image_id == model.PCB.originalPcb)
@@ -214,12 +524,11 @@ def get_pcb_original_images(db: Session, pcb_id: int):
     if image_path is None:
         raise FileNotFoundError(f"No image path found for PCB id: {pcb_id}")
 
-    if not os.path.exists(image_path):
+    # a blob of the image store or a plain file
+    image_bytes = image_store.read_bytes(image_path)
+    if image_bytes is None:
         raise FileNotFoundError(f"Image file not found at: {image_path}")
 
-    with open(image_path, "rb") as f:
-        image_bytes = f.read()
-
     return image_bytes
 
 
@@ -236,33 +545,12 @@ def get_pcb_result(db: Session, pcb_id: int):
         .scalar()
     )
 
-    imageList = {
-        "template_image": None,
-        "defective_image": None,
-        "aligned_image": None,
-        "diff_image": None,
-        "cleaned_image": None,
-        "result_image": None,
-    }
-
-    for key in imageList.keys():
-        image_id = getattr(resultData, key, None)
-        image = db.query(model.ImagePCB).filter_by(image_id=image_id).first()
-        if image and os.path.exists(image.filepath):
-            with open(image.filepath, "rb") as f:
-                imageList[key] = {
-                    "image_id": image.image_id,
-                    "filename": image.filename,
-                    "filepath": image.filepath,
-                    "uploaded_at": (
-                        image.uploaded_at.isoformat() if image.uploaded_at else None
-                    ),
-                    "image_data": base64.b64encode(f.read()).decode("utf-8"),
-                }
+    imageList = result_image_list(db, resultData)
 
     return {
         "results_id": resultData.results_id,
         "pcb_result_id": resultData.pcb_result_id,
+        "board_id": resultData.board_id,
         "accuracy": float(getattr(resultData, "accuracy", 0)),
         "description": resultData.description,
         "imageList": imageList,
@@ -285,23 +573,14 @@ def get_pcb_result_working(db: Session, pcb_id: int):
 
         # print(resultData.__dict__)
 
-        image_id = getattr(resultData, "result_image", None)
-        image = db.query(model.ImagePCB).filter_by(image_id=image_id).first()
-        if image and os.path.exists(image.filepath):
-            with open(image.filepath, "rb") as f:
-                result_image = {
-                    "image_id": image.image_id,
-                    "filename": image.filename,
-                    "filepath": image.filepath,
-                    "uploaded_at": (
-                        image.uploaded_at.isoformat() if image.uploaded_at else None
-                    ),
-                    "image_data": base64.b64encode(f.read()).decode("utf-8"),
-                }
-
+        result_image = result_image_list(
+            db, resultData, ("result_image",), regenerate=False
+        )["result_image"]
+        if result_image:
             result = {
                 "results_id": resultData.results_id,
                 "pcb_result_id": resultData.pcb_result_id,
+                "board_id": resultData.board_id,
                 "accuracy": float(getattr(resultData, "accuracy", 0)),
                 "description": resultData.description,
                 "imageList": result_image,
@@ -322,14 +601,8 @@ def delete_pcb(db: Session, pcb_id: int):
 
     results = db.query(model.Result).filter(model.Result.pcb_result_id == pcb_id).all()
 
-    image_keys = [
-        "template_image",
-        "defective_image",
-        "aligned_image",
-        "diff_image",
-        "cleaned_image",
-        "result_image",
-    ]
+    image_keys = RESULT_IMAGE_COLUMNS + ("capture_image",)
+    freed = []
 
     for result in results:
         for key in image_keys:
@@ -337,13 +610,21 @@ def delete_pcb(db: Session, pcb_id: int):
             if image_id:
                 image = db.query(model.ImagePCB).filter_by(image_id=image_id).first()
                 if image:
-                    db.delete(image)
+                    delete_image(db, image, freed)
 
         db.delete(result)
-    db.query(model.ImagePCB).filter(model.ImagePCB.pcb_id == pcb_id).delete()
+        artifact_cache.discard(result.results_id)
+    db.query(model.Defect).filter(model.Defect.pcb_id == pcb_id).delete(
+        synchronize_session=False
+    )
+    for image in db.query(model.ImagePCB).filter(model.ImagePCB.pcb_id == pcb_id).all():
+        if image not in db.deleted:
+            delete_image(db, image, freed)
 
     db.delete(pcb)
     db.commit()
+    remove_blobs(db, freed)
+    heatmap_store.drop(pcb_id)
 
     return True
 
@@ -354,33 +635,12 @@ def get_result(db: Session, result_id: int):
         db.query(model.Result).filter(model.Result.results_id == result_id).scalar()
     )
 
-    imageList = {
-        "template_image": None,
-        "defective_image": None,
-        "aligned_image": None,
-        "diff_image": None,
-        "cleaned_image": None,
-        "result_image": None,
-    }
-
-    for key in imageList.keys():
-        image_id = getattr(resultData, key, None)
-        image = db.query(model.ImagePCB).filter_by(image_id=image_id).first()
-        if image and os.path.exists(image.filepath):
-            with open(image.filepath, "rb") as f:
-                imageList[key] = {
-                    "image_id": image.image_id,
-                    "filename": image.filename,
-                    "filepath": image.filepath,
-                    "uploaded_at": (
-                        image.uploaded_at.isoformat() if image.uploaded_at else None
-                    ),
-                    "image_data": base64.b64encode(f.read()).decode("utf-8"),
-                }
+    imageList = result_image_list(db, resultData)
 
     return {
         "results_id": resultData.results_id,
         "pcb_result_id": resultData.pcb_result_id,
+        "board_id": resultData.board_id,
         "accuracy": float(getattr(resultData, "accuracy", 0)),
         "description": resultData.description,
         "imageList": imageList,
@@ -401,17 +661,17 @@ def get_all_pcb_results(db: Session):
             }
 
             image = db.query(model.ImagePCB).filter_by(image_id=pcb.originalPcb).first()
-            if image and os.path.exists(image.filepath):
-                with open(image.filepath, "rb") as f:
-                    imageList = {
-                        "image_id": image.image_id,
-                        "filename": image.filename,
-                        "filepath": image.filepath,
-                        "uploaded_at": (
-                            image.uploaded_at.isoformat() if image.uploaded_at else None
-                        ),
-                        "image_data": base64.b64encode(f.read()).decode("utf-8"),
-                    }
+            image_bytes = image_store.read_bytes(image.filepath) if image else None
+            if image_bytes is not None:
+                imageList = {
+                    "image_id": image.image_id,
+                    "filename": image.filename,
+                    "filepath": image.filepath,
+                    "uploaded_at": (
+                        image.uploaded_at.isoformat() if image.uploaded_at else None
+                    ),
+                    "image_data": base64.b64encode(image_bytes).decode("utf-8"),
+                }
 
                 pcb_dict["originalPcb"] = imageList
 
@@ -437,24 +697,23 @@ def delete_result(db: Session, result_id: int):
     if not result:
         return None
 
-    image_keys = [
-        "template_image",
-        "defective_image",
-        "aligned_image",
-        "diff_image",
-        "cleaned_image",
-        "result_image",
-    ]
+    image_keys = RESULT_IMAGE_COLUMNS + ("capture_image",)
+    freed = []
 
     for key in image_keys:
         image_id = getattr(result, key, None)
         if image_id:
             image = db.query(model.ImagePCB).filter_by(image_id=image_id).first()
             if image:
-                db.delete(image)
+                delete_image(db, image, freed)
 
+    db.query(model.Defect).filter(model.Defect.result_id == result_id).delete(
+        synchronize_session=False
+    )
     db.delete(result)
 
     db.commit()
+    remove_blobs(db, freed)
+    artifact_cache.discard(result_id)
 
     return True
@@ -1,23 +1,62 @@
+import os
+
 from sqlalchemy import (
     Column,
     Integer,
     String,
     DateTime,
     create_engine,
+    event,
     ForeignKey,
     DECIMAL,
+    Float,
     LargeBinary,
+    inspect,
+    text,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 
-engine = create_engine(
-    "sqlite:///database.db/images.db", echo=True
-)
+DATABASE_URL = os.environ.get("PCB_DATABASE_URL", "sqlite:///database.db/images.db")
+
+
+def configure_sqlite(engine, journal_mode="WAL", synchronous="NORMAL"):
+    """Set the journal pragmas on every new connection
+
+    WAL with synchronous=NORMAL fsyncs the log at checkpoints instead of on
+    every commit, a committed board can only be lost on power loss, never
+    corrupted. Engines of other databases are returned untouched.
+    """
+    if engine.dialect.name != "sqlite":
+        return engine
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.close()
+
+    return engine
+
+
+engine = configure_sqlite(create_engine(DATABASE_URL, echo=True))
 Base = declarative_base()
 
 
+class Blob(Base):
+    """A content-addressed image file, shared by every ImagePCB with its bytes"""
+
+    __tablename__ = "blob"
+
+    digest = Column(String, primary_key=True)
+    filepath = Column(String, nullable=False)
+    size = Column(Integer)
+    refcount = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class ImagePCB(Base):
     __tablename__ = "imagepcb"
 
@@ -26,6 +65,8 @@ class ImagePCB(Base):
     filepath = Column(String, nullable=False)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     pcb_id = Column(Integer, ForeignKey("pcb.id"))
+    # NULL for files written before the image store
+    blob_digest = Column(String, ForeignKey("blob.digest"), index=True)
 
     pcb = relationship("PCB", back_populates="images", foreign_keys=[pcb_id])
 
@@ -37,16 +78,43 @@ class Result(Base):
     pcb_result_id = Column(Integer, ForeignKey("pcb.id"))
     accuracy = Column(DECIMAL(5, 2))
     description = Column(String)
+    board_id = Column(Integer)
     template_image = Column(Integer, ForeignKey("imagepcb.image_id"))
     defective_image = Column(Integer, ForeignKey("imagepcb.image_id"))
     aligned_image = Column(Integer, ForeignKey("imagepcb.image_id"))
     diff_image = Column(Integer, ForeignKey("imagepcb.image_id"))
     cleaned_image = Column(Integer, ForeignKey("imagepcb.image_id"))
     result_image = Column(Integer, ForeignKey("imagepcb.image_id"))
+    # the captured crop the other images are regenerated from ("minimal")
+    capture_image = Column(Integer, ForeignKey("imagepcb.image_id"))
+    artifact_level = Column(String)
+    # JSON: inspection level, scale, homography and template image id
+    params = Column(String)
 
     pcb = relationship("PCB", back_populates="results")
 
 
+class Defect(Base):
+    """A connected defect region of a result, in template pixels
+
+    Mirrored into the defect_rtree R*Tree by triggers (create_defect_index).
+    """
+
+    __tablename__ = "defect"
+
+    id = Column(Integer, primary_key=True)
+    result_id = Column(Integer, ForeignKey("result.results_id"), index=True)
+    pcb_id = Column(Integer, ForeignKey("pcb.id"), index=True)
+    x = Column(Integer)
+    y = Column(Integer)
+    width = Column(Integer)
+    height = Column(Integer)
+    area = Column(Integer)
+    cx = Column(Float)
+    cy = Column(Float)
+    mean_intensity = Column(Float)
+
+
 class PCB(Base):
     __tablename__ = "pcb"
 
@@ -55,6 +123,8 @@ class PCB(Base):
     # originalPcb = relationship("ImagePCB", back_populates="pcb")
 
     originalPcb = Column(Integer, ForeignKey("imagepcb.image_id"))
+    # none / minimal / full, NULL means DEFAULT_ARTIFACT_LEVEL
+    artifact_level = Column(String)
     # original_filename = Column(String)
     # originalPcb_data = Column(LargeBinary)
     results = relationship("Result", back_populates="pcb")
@@ -71,7 +141,50 @@ class PCB(Base):
         return [r.results_id for r in self.results]
 
 
+def add_missing_columns():
+    """create_all() never alters an existing table, add new columns in place"""
+    inspector = inspect(engine)
+    for table in Base.metadata.tables.values():
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+
+
+def create_defect_index():
+    """R*Tree over the defect boxes, kept in sync with the defect table by triggers
+
+    SQLite only, returns whether the index exists.
+    """
+    if engine.dialect.name != "sqlite":
+        return False
+    statements = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS defect_rtree"
+        " USING rtree(id, min_x, max_x, min_y, max_y, +pcb_id)",
+        "CREATE TRIGGER IF NOT EXISTS defect_rtree_insert AFTER INSERT ON defect BEGIN"
+        " INSERT INTO defect_rtree VALUES (new.id, new.x, new.x + new.width - 1,"
+        " new.y, new.y + new.height - 1, new.pcb_id); END",
+        "CREATE TRIGGER IF NOT EXISTS defect_rtree_delete AFTER DELETE ON defect BEGIN"
+        " DELETE FROM defect_rtree WHERE id = old.id; END",
+    )
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+    return True
+
+
 Base.metadata.create_all(engine)
+add_missing_columns()
+has_defect_index = create_defect_index()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
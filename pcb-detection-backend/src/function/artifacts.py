@@ -0,0 +1,126 @@
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from .inspection import level_scale, regenerate_images
+from .masks import MASK_ARTIFACTS, MASK_EXT, pack_mask, unpack_mask
+from .metrics import CallbackCounter, register, stage
+
+logger = logging.getLogger(__name__)
+
+# What is written per inspected board, chosen per product (PCB.artifact_level)
+#   none:    only the result row, no image can be shown later
+#   minimal: the captured crop, the rest is regenerated on request
+#   full:    all six images, as inspected
+ARTIFACT_LEVELS = ("none", "minimal", "full")
+DEFAULT_ARTIFACT_LEVEL = os.environ.get("PCB_ARTIFACT_LEVEL", "minimal")
+ARTIFACT_NAMES = ("template", "defective", "aligned", "diff", "cleaned", "result")
+
+
+def inspection_params(inspected, template_image=None):
+    """JSON of what regenerate_artifacts needs besides the two images"""
+    return json.dumps(
+        {
+            "level": inspected["level"],
+            "scale": level_scale(inspected["level"]),
+            "homography": np.asarray(inspected["homography"]).tolist(),
+            "template_image": template_image,
+        }
+    )
+
+
+def encode_artifact(gray_image):
+    bgr_image = cv2.cvtColor(gray_image, cv2.COLOR_GRAY2BGR)
+    return cv2.imencode(".jpg", bgr_image)[1].tobytes()
+
+
+def store_artifact(name, gray_image):
+    """Stored bytes and file extension of an artifact, the masks packed as RLE"""
+    if name in MASK_ARTIFACTS:
+        return pack_mask(gray_image), MASK_EXT
+    return encode_artifact(gray_image), ".jpg"
+
+
+def display_artifact(filepath, data):
+    """JPEG bytes to show for stored artifact bytes"""
+    if filepath and filepath.endswith(MASK_EXT):
+        return cv2.imencode(".jpg", unpack_mask(data))[1].tobytes()
+    return data
+
+
+def regenerate_artifacts(template_bytes, capture_bytes, params):
+    """Every artifact of a stored inspection, as store_artifact would write it"""
+    with stage("artifact_regenerate"):
+        template_img = cv2.imdecode(np.frombuffer(template_bytes, np.uint8), cv2.IMREAD_COLOR)
+        capture_img = cv2.imdecode(np.frombuffer(capture_bytes, np.uint8), cv2.IMREAD_COLOR)
+        if template_img is None or capture_img is None:
+            raise ValueError("Stored template or capture could not be decoded")
+        H = np.asarray(params["homography"], dtype=np.float64)
+        images = regenerate_images(template_img, capture_img, params["level"], H)
+        return {name: store_artifact(name, images[name]) for name in ARTIFACT_NAMES}
+
+
+class ArtifactCache:
+    """LRU of regenerated artifacts, keyed by result id
+
+    Dashboards open the same few recent results over and over, a hit skips
+    the registration replay and the JPEG encodes.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = build()
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return value
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+artifact_cache = ArtifactCache()
+
+register(
+    CallbackCounter(
+        "pcb_artifact_cache_hits_total",
+        "Regenerated artifact requests served from the cache",
+        lambda: artifact_cache.hits,
+    )
+)
+register(
+    CallbackCounter(
+        "pcb_artifact_cache_misses_total",
+        "Artifact regenerations",
+        lambda: artifact_cache.misses,
+    )
+)
@@ -0,0 +1,512 @@
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+import time
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from .metrics import CallbackCounter, Gauge, frames_captured, frames_dropped, register, stage
+
+logger = logging.getLogger(__name__)
+
+# uhubctl location of the camera's USB port (see test_raspberry_pi/usb-Controlled.py)
+USB_HUB_LOCATION = "1-1"
+USB_HUB_PORT = 2
+# Directory of board photos to replay instead of opening the camera
+SIMULATED_CAMERA_DIR = os.environ.get("PCB_CAMERA_SIMULATE")
+
+
+class UsbPowerController:
+    """Switch a USB port with uhubctl, the last resort for a hung UVC camera
+
+    ``runner`` is called like subprocess.run, pass a fake to test without
+    touching the hub.
+    """
+
+    def __init__(
+        self,
+        location=USB_HUB_LOCATION,
+        port=USB_HUB_PORT,
+        off_seconds=2.0,
+        runner=subprocess.run,
+    ):
+        self.location = location
+        self.port = port
+        self.off_seconds = off_seconds
+        self.runner = runner
+
+    def set_power(self, action):
+        command = ["sudo", "uhubctl", "-l", str(self.location), "-p", str(self.port), "-a", action]
+        try:
+            self.runner(command, check=False, capture_output=True, timeout=10)
+            return True
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(f"uhubctl {action} failed: {str(e)}")
+            return False
+
+    def power_cycle(self):
+        logger.warning(f"Power-cycling USB port {self.location}:{self.port}")
+        if not self.set_power("off"):
+            return False
+        time.sleep(self.off_seconds)
+        return self.set_power("on")
+
+
+class SimulatedCapture:
+    """cv2.VideoCapture stand-in sliding board photos across a dark belt
+
+    ``source`` is a directory of board images (pcb-dataset/pcb). Every
+    board crosses the frame from left to right in ``frames_per_board``
+    frames, reads are paced to the fps set through ``set`` like a real
+    camera. Lets the line and the load generator run without hardware.
+    """
+
+    def __init__(self, source, frames_per_board=40):
+        self.frames_per_board = frames_per_board
+        self.width = 640
+        self.height = 480
+        self.fps = 10
+        self.boards = []
+        if os.path.isdir(str(source)):
+            for name in sorted(os.listdir(source)):
+                image = cv2.imread(os.path.join(source, name))
+                if image is not None:
+                    self.boards.append(image)
+        self.opened = bool(self.boards)
+        self.index = 0
+        self._next_time = None
+        self._background = None
+        self._scaled = {}
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+        elif prop == cv2.CAP_PROP_FPS:
+            self.fps = float(value)
+        else:
+            return False
+        self._background = None
+        self._scaled.clear()
+        return True
+
+    def grab(self):
+        if not self.opened:
+            return False
+        now = time.monotonic()
+        if self._next_time is None:
+            self._next_time = now
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+        self._next_time = max(self._next_time + 1.0 / self.fps, time.monotonic())
+        self.index += 1
+        return True
+
+    def retrieve(self):
+        if not self.opened:
+            return False, None
+        return True, self._render()
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        self.opened = False
+
+    def _board(self, number):
+        board = self._scaled.get(number)
+        if board is None:
+            image = self.boards[number]
+            scale = self.height * 0.6 / image.shape[0]
+            board = cv2.resize(image, (int(image.shape[1] * scale), int(image.shape[0] * scale)))
+            self._scaled[number] = board
+        return board
+
+    def _render(self):
+        if self._background is None:
+            rng = np.random.default_rng(0)
+            noise = rng.integers(0, 10, (self.height, self.width, 3), dtype=np.uint8)
+            self._background = cv2.add(np.full_like(noise, 35), noise)
+        frame = self._background.copy()
+
+        step = self.index % self.frames_per_board
+        board = self._board((self.index // self.frames_per_board) % len(self.boards))
+        height, width = board.shape[:2]
+        x = int(-width + (self.width + width) * step / self.frames_per_board)
+        y = (self.height - height) // 2
+        left, right = max(x, 0), min(x + width, self.width)
+        if right > left:
+            frame[y : y + height, left:right] = board[:, left - x : right - x]
+        return frame
+
+
+class CameraManager:
+    """Single owner of the camera shared by every websocket
+
+    A capture thread keeps the newest frame. A watchdog thread notices when
+    frames stop arriving (read errors or a driver that blocks forever),
+    reopens the device with exponential backoff and, after
+    ``power_cycle_after`` failed reopens or as soon as a reopened device's
+    first read blocks for ``stall_timeout``, power-cycles the USB port.
+    Handlers only see a short wait on ``next_frame`` while it recovers.
+
+    After ``idle_after`` seconds without a ``wake`` (a detection or a
+    trigger) the capture goes idle: frames are still grabbed so the driver
+    queue stays fresh, but only decoded every ``idle_interval`` seconds and
+    checked for motion on a thumbnail. Motion or a ``wake`` call brings it
+    back to full rate on the next frame.
+    """
+
+    def __init__(
+        self,
+        source=0,
+        width=640,
+        height=480,
+        fps=10,
+        stall_timeout=2.0,
+        max_backoff=8.0,
+        power_cycle_after=3,
+        max_attempts=8,
+        usb_power: Optional[UsbPowerController] = None,
+        capture_factory=cv2.VideoCapture,
+        idle_after=60.0,
+        idle_interval=0.5,
+        motion_threshold=0.01,
+    ):
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.stall_timeout = stall_timeout
+        self.max_backoff = max_backoff
+        self.power_cycle_after = power_cycle_after
+        self.max_attempts = max_attempts
+        self.usb_power = usb_power
+        self.capture_factory = capture_factory
+        self.idle_after = idle_after
+        self.idle_interval = idle_interval
+        self.motion_threshold = motion_threshold
+
+        self.camera: Optional[cv2.VideoCapture] = None
+        self.active_connections = 0
+        self.lock = asyncio.Lock()
+        self.frame_interval = 0.08
+
+        self._cond = threading.Condition()
+        self._frame = None
+        self._frame_id = 0
+        self._frame_time = None
+        self._last_read_id = 0
+        self._generation = 0
+        self._failed = False
+        self._stop = threading.Event()
+        self._watchdog = None
+
+        self.frames = 0
+        self.read_failures = 0
+        self.stalls = 0
+        self.reopens = 0
+        self.power_cycles = 0
+        self.last_frame_gap = 0.0
+        self.max_frame_gap = 0.0
+        self.last_recovery_seconds = None
+        self.recovering = False
+
+        self.idle = False
+        self.idle_entered = 0
+        self.wakes = 0
+        self._last_activity = time.monotonic()
+        self._last_idle_decode = 0.0
+        self._thumbnail = None
+
+    def _open(self):
+        camera = self.capture_factory(self.source)
+        if not camera.isOpened():
+            camera.release()
+            return None
+        # Optimize for Raspberry Pi
+        camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        camera.set(cv2.CAP_PROP_FPS, self.fps)
+        return camera
+
+    def _start_capture(self, camera):
+        with self._cond:
+            self._generation += 1
+            generation = self._generation
+            self.camera = camera
+            self._frame_time = time.monotonic()
+        threading.Thread(
+            target=self._capture_loop,
+            args=(camera, generation),
+            name=f"camera-capture-{generation}",
+            daemon=True,
+        ).start()
+
+    def _capture_loop(self, camera, generation):
+        while not self._stop.is_set() and generation == self._generation:
+            idle = self.idle
+            if idle:
+                ret = camera.grab()
+                frame = None
+                if ret and time.monotonic() - self._last_idle_decode >= self.idle_interval:
+                    self._last_idle_decode = time.monotonic()
+                    ret, frame = camera.retrieve()
+                    if ret and self._motion(frame):
+                        self.wake("motion")
+            else:
+                with stage("capture"):
+                    ret, frame = camera.read()
+            now = time.monotonic()
+            if not ret:
+                self.read_failures += 1
+                time.sleep(0.05)
+                continue
+            if not idle and now - self._last_activity > self.idle_after:
+                self._enter_idle()
+            with self._cond:
+                if generation != self._generation:
+                    break
+                if frame is None:
+                    # grabbed but not decoded, the camera is still alive
+                    self._frame_time = now
+                    continue
+                gap = now - self._frame_time
+                self.last_frame_gap = gap
+                if not idle:
+                    self.max_frame_gap = max(self.max_frame_gap, gap)
+                frames_captured.inc()
+                if self._frame is not None and self._frame_id != self._last_read_id:
+                    frames_dropped.inc()
+                self._frame = frame
+                self._frame_id += 1
+                self._frame_time = now
+                self.frames += 1
+                self._cond.notify_all()
+
+    def _motion(self, frame):
+        """Cheap presence check, fraction of changed pixels in an 80x60 thumbnail"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.GaussianBlur(
+            cv2.resize(gray, (80, 60), interpolation=cv2.INTER_AREA), (5, 5), 0
+        )
+        previous, self._thumbnail = self._thumbnail, thumbnail
+        if previous is None:
+            return False
+        changed = cv2.countNonZero(
+            cv2.threshold(cv2.absdiff(previous, thumbnail), 25, 255, cv2.THRESH_BINARY)[1]
+        )
+        return changed / thumbnail.size > self.motion_threshold
+
+    def _enter_idle(self):
+        self.idle = True
+        self.idle_entered += 1
+        self._thumbnail = None
+        logger.info(
+            f"No board for {self.idle_after:.0f}s, camera idle "
+            f"({1 / self.idle_interval:.0f} FPS presence check)"
+        )
+
+    def wake(self, reason="activity"):
+        """Record activity (a detection, a trigger) and leave idle mode"""
+        self._last_activity = time.monotonic()
+        if self.idle:
+            self.idle = False
+            self.wakes += 1
+            logger.info(f"Camera active again ({reason})")
+
+    def _watchdog_loop(self):
+        while not self._stop.wait(self.stall_timeout / 4):
+            with self._cond:
+                stalled = time.monotonic() - self._frame_time > self.stall_timeout
+            if stalled:
+                self.stalls += 1
+                logger.warning("Camera stalled, recovering")
+                self._recover()
+
+    def _probe(self, camera):
+        """First read of a reopened camera, None if it is still blocked
+        after ``stall_timeout`` (the read is then left to its thread)"""
+        result = []
+        probe = threading.Thread(
+            target=lambda: result.append(camera.read()), name="camera-probe", daemon=True
+        )
+        probe.start()
+        probe.join(self.stall_timeout)
+        return result[0] if result else None
+
+    def _recover(self):
+        started = time.monotonic()
+        self.recovering = True
+        backoff = 0.5
+        # a reopened camera whose read hangs goes straight to the power cycle
+        hung = False
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                if self._stop.is_set():
+                    return
+                with self._cond:
+                    # orphan the old capture thread, it may be stuck in read()
+                    self._generation += 1
+                    old_camera, self.camera = self.camera, None
+                if old_camera is not None:
+                    try:
+                        old_camera.release()
+                    except cv2.error:
+                        pass
+
+                if self.usb_power is not None and (hung or attempt > self.power_cycle_after):
+                    hung = False
+                    self.power_cycles += 1
+                    self.usb_power.power_cycle()
+
+                self._stop.wait(backoff)
+                self.reopens += 1
+                camera = self._open()
+                if camera is not None:
+                    probed = self._probe(camera)
+                    if probed is None:
+                        logger.warning(
+                            f"Camera read still blocked after {self.stall_timeout:.1f}s"
+                        )
+                        hung = True
+                    elif probed[0]:
+                        self.last_recovery_seconds = time.monotonic() - started
+                        logger.info(
+                            f"Camera recovered after {attempt} attempt(s) in "
+                            f"{self.last_recovery_seconds:.1f}s"
+                        )
+                        self._start_capture(camera)
+                        return
+                    else:
+                        camera.release()
+                logger.warning(f"Camera reopen attempt {attempt} failed")
+                backoff = min(backoff * 2, self.max_backoff)
+
+            logger.error("Camera recovery gave up")
+            with self._cond:
+                self._failed = True
+                self._cond.notify_all()
+            self._stop.set()
+        finally:
+            self.recovering = False
+
+    async def get_camera(self):
+        async with self.lock:
+            if self._watchdog is None or not self._watchdog.is_alive():
+                camera = await asyncio.to_thread(self._open)
+                if camera is None:
+                    logger.error("Failed to open camera")
+                    return None
+                self._stop.clear()
+                self._failed = False
+                self.idle = False
+                self._last_activity = time.monotonic()
+                self._start_capture(camera)
+                self._watchdog = threading.Thread(
+                    target=self._watchdog_loop, name="camera-watchdog", daemon=True
+                )
+                self._watchdog.start()
+                logger.info(f"Camera opened ({self.width}x{self.height} @ {self.fps}FPS)")
+            return self
+
+    def read(self, timeout=None):
+        """Newest frame, waiting up to ``timeout`` for one newer than the last read
+
+        Returns (False, None) when no new frame arrived in time.
+        """
+        if timeout is None:
+            timeout = self.stall_timeout
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._frame_id == self._last_read_id and not self._failed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._failed or self._frame_id == self._last_read_id:
+                return False, None
+            self._last_read_id = self._frame_id
+            return True, self._frame
+
+    async def next_frame(self):
+        """read() for async handlers, keeps waiting while the watchdog recovers
+
+        Returns (False, None) only once the watchdog has given up.
+        """
+        while True:
+            ret, frame = await asyncio.to_thread(self.read)
+            if ret or self._failed or self._stop.is_set():
+                return ret, frame
+            logger.info("Waiting for the camera to recover")
+
+    def stats(self):
+        with self._cond:
+            frame_age = (
+                time.monotonic() - self._frame_time if self._frame_time else None
+            )
+        return {
+            "open": self.camera is not None,
+            "mode": "idle" if self.idle else "active",
+            "idle_entered": self.idle_entered,
+            "wakes": self.wakes,
+            "recovering": self.recovering,
+            "failed": self._failed,
+            "frames": self.frames,
+            "read_failures": self.read_failures,
+            "stalls": self.stalls,
+            "reopens": self.reopens,
+            "power_cycles": self.power_cycles,
+            "frame_age_seconds": frame_age,
+            "last_frame_gap_seconds": self.last_frame_gap,
+            "max_frame_gap_seconds": self.max_frame_gap,
+            "last_recovery_seconds": self.last_recovery_seconds,
+        }
+
+    async def release_camera(self):
+        async with self.lock:
+            self._stop.set()
+            with self._cond:
+                self._generation += 1
+                camera, self.camera = self.camera, None
+                self._frame = None
+                self._cond.notify_all()
+            if self._watchdog is not None:
+                await asyncio.to_thread(self._watchdog.join, 2.0)
+                self._watchdog = None
+            if camera is not None:
+                camera.release()
+                logger.info("Camera released")
+
+
+if SIMULATED_CAMERA_DIR:
+    logger.info(f"Simulating the camera with the images in {SIMULATED_CAMERA_DIR}")
+    camera_manager = CameraManager(
+        source=SIMULATED_CAMERA_DIR, capture_factory=SimulatedCapture
+    )
+else:
+    camera_manager = CameraManager(usb_power=UsbPowerController())
+
+for _name, _key, _help in (
+    ("pcb_camera_stalls_total", "stalls", "Camera stalls detected by the watchdog"),
+    ("pcb_camera_reopens_total", "reopens", "Camera reopen attempts"),
+    ("pcb_camera_power_cycles_total", "power_cycles", "USB power cycles of the camera port"),
+):
+    register(CallbackCounter(_name, _help, lambda key=_key: camera_manager.stats()[key]))
+
+for _name, _key, _help in (
+    ("pcb_camera_frame_age_seconds", "frame_age_seconds", "Age of the newest frame"),
+    ("pcb_camera_max_frame_gap_seconds", "max_frame_gap_seconds", "Longest gap between frames"),
+    ("pcb_camera_last_recovery_seconds", "last_recovery_seconds", "Duration of the last recovery"),
+):
+    register(Gauge(_name, _help, lambda key=_key: camera_manager.stats()[key]))
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Calibration of the camera against the belt and the distance from the
+# center line of the frame to the servo diverter, measured along the belt.
+PX_PER_MM = 2.0
+DIVERTER_DISTANCE_MM = 250.0
+# Time the servo needs to swing before the board reaches the diverter
+SERVO_LEAD_SECONDS = 0.3
+
+
+class BeltSpeedEstimator:
+    """Belt speed in px/s from the tracked board velocities (EWMA)"""
+
+    def __init__(self, alpha=0.2, min_speed=1.0):
+        self.alpha = alpha
+        self.min_speed = min_speed
+        self.speed = None
+        self.direction = 1
+
+    def update(self, tracks):
+        for track in tracks:
+            vx, _ = track.velocity()
+            if abs(vx) < self.min_speed:
+                continue
+            self.direction = 1 if vx > 0 else -1
+            if self.speed is None:
+                self.speed = abs(vx)
+            else:
+                self.speed = self.alpha * abs(vx) + (1 - self.alpha) * self.speed
+        return self.speed
+
+    def speed_mm_s(self):
+        return self.speed / PX_PER_MM if self.speed else None
+
+
+def diverter_eta(track, center_x, speed_px_s, direction, now=None):
+    """Seconds until the tracked board reaches the diverter"""
+    if now is None:
+        now = time.time()
+    if not speed_px_s:
+        return None
+    travelled_px = (track.centroid[0] - center_x) * direction
+    remaining_px = DIVERTER_DISTANCE_MM * PX_PER_MM - travelled_px
+    # the centroid was measured at last_seen, not now
+    return remaining_px / speed_px_s - (now - track.last_seen)
+
+
+class DiverterScheduler:
+    """Fire one actuator action per board at its arrival time
+
+    Actions run in a worker thread because the servo helpers block while
+    the horn moves, and are serialized so two boards never drive the servo
+    at the same time.
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+
+    def schedule(self, delay, action, *args):
+        task = asyncio.create_task(self._run(max(0.0, delay), action, *args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _run(self, delay, action, *args):
+        await asyncio.sleep(delay)
+        async with self.lock:
+            await asyncio.to_thread(action, *args)
+
+    def cancel_all(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+
+class InspectionDeadlineStats:
+    """Inspection latency against the time budget to the diverter"""
+
+    def __init__(self, engine=None, window=100):
+        self.engine = engine
+        self.latencies = deque(maxlen=window)
+        self.inspected = 0
+        self.late = 0
+        self.belt_speed_mm_s = None
+
+    def record(self, latency, deadline_met):
+        self.latencies.append(latency)
+        self.inspected += 1
+        if not deadline_met:
+            self.late += 1
+
+    def latency_p95(self):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def max_belt_speed_mm_s(self):
+        """Fastest belt at which the p95 inspection still beats the diverter"""
+        p95 = self.latency_p95()
+        if p95 is None:
+            return None
+        return DIVERTER_DISTANCE_MM / (p95 + SERVO_LEAD_SECONDS)
+
+    def summary(self):
+        return {
+            "belt_speed_mm_s": self.belt_speed_mm_s,
+            "max_belt_speed_mm_s": self.max_belt_speed_mm_s(),
+            "inspection_p95_s": self.latency_p95(),
+            "inspected": self.inspected,
+            "late": self.late,
+            "engine": self.engine.summary() if self.engine else None,
+        }
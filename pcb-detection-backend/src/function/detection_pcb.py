@@ -0,0 +1,116 @@
+import cv2
+import numpy as np
+
+from .metrics import stage
+
+
+LOWER_COPPER = np.array([5, 30, 5])
+UPPER_COPPER = np.array([45, 255, 255])
+MIN_BOARD_AREA = 5000
+
+
+def expand_contour(contour, percentage):
+    """Expand contour boundaries by given percentage"""
+    M = cv2.moments(contour)
+    if M["m00"] == 0:
+        return contour
+
+    cx = int(M["m10"] / M["m00"])
+    cy = int(M["m01"] / M["m00"])
+
+    expanded = []
+    for point in contour:
+        x, y = point[0]
+        dir_x = x - cx
+        dir_y = y - cy
+        new_x = cx + (1 + percentage) * dir_x
+        new_y = cy + (1 + percentage) * dir_y
+        expanded.append([[int(new_x), int(new_y)]])
+
+    return np.array(expanded, dtype=np.int32)
+
+
+def order_points(pts):
+    """Order 4 points as: top-left, top-right, bottom-right, bottom-left"""
+    rect = np.zeros((4, 2), dtype="float32")
+    s = pts.sum(axis=1)
+    rect[0] = pts[np.argmin(s)]
+    rect[2] = pts[np.argmax(s)]
+    diff = np.diff(pts, axis=1)
+    rect[1] = pts[np.argmin(diff)]
+    rect[3] = pts[np.argmax(diff)]
+    return rect
+
+
+def four_point_transform(image, pts):
+    """Perform perspective transform using 4 points"""
+    (tl, tr, br, bl) = pts
+    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
+    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
+    maxWidth = max(int(widthA), int(widthB))
+
+    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
+    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
+    maxHeight = max(int(heightA), int(heightB))
+
+    dst = np.array(
+        [[0, 0], [maxWidth - 1, 0], [maxWidth - 1, maxHeight - 1], [0, maxHeight - 1]],
+        dtype="float32",
+    )
+
+    with stage("warp"):
+        M = cv2.getPerspectiveTransform(pts, dst)
+        warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
+    return warped
+
+
+def copper_mask(frame, lower=LOWER_COPPER, upper=UPPER_COPPER):
+    """HSV copper mask cleaned with open/close morphology"""
+    with stage("hsv_mask"):
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, lower, upper)
+
+        kernel = np.ones((5, 5), np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    return mask
+
+
+def detect_boards(frame, min_area=MIN_BOARD_AREA):
+    """Find every board in the frame, largest first
+
+    Each board is a dict with the expanded hull, its bounding box, centroid,
+    area and the ordered 4-point quad (None when the hull is not a quad).
+    """
+    mask = copper_mask(frame)
+    with stage("contour"):
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        boards = []
+        for contour in contours:
+            if cv2.contourArea(contour) < min_area / 2:
+                continue
+
+            expanded_contour = expand_contour(contour, 0.05)
+            hull = cv2.convexHull(expanded_contour)
+            area = cv2.contourArea(hull)
+            if area < min_area:
+                continue
+
+            epsilon = 0.02 * cv2.arcLength(hull, True)
+            approx = cv2.approxPolyDP(hull, epsilon, True)
+            quad = order_points(approx.reshape(4, 2)) if len(approx) == 4 else None
+
+            x, y, w, h = cv2.boundingRect(hull)
+            boards.append(
+                {
+                    "hull": hull,
+                    "bbox": (x, y, w, h),
+                    "centroid": (x + w / 2.0, y + h / 2.0),
+                    "area": area,
+                    "quad": quad,
+                }
+            )
+
+    boards.sort(key=lambda board: board["area"], reverse=True)
+    return boards
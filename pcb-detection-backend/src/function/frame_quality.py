@@ -0,0 +1,69 @@
+import cv2
+import numpy as np
+
+
+def sharpness(gray):
+    """Variance of the Laplacian, drops quickly with motion blur"""
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+
+def exposure(gray):
+    """1.0 for a well exposed crop, lower when dark, bright or clipped"""
+    mean = float(gray.mean())
+    clipped = np.count_nonzero((gray < 5) | (gray > 250)) / gray.size
+    return max(0.0, 1.0 - abs(mean - 128.0) / 128.0 - clipped)
+
+
+def quad_stability(quad, prev_quad):
+    """1.0 when the corners did not move since the previous frame"""
+    if prev_quad is None:
+        return 0.5
+    shift = float(np.linalg.norm(quad - prev_quad, axis=1).mean())
+    return 1.0 / (1.0 + shift)
+
+
+def crop_quality(crop):
+    """Sharpness weighted by exposure, comparable between crops of one board"""
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    return sharpness(gray) * exposure(gray)
+
+
+def score_crop(crop, quad, prev_quad=None):
+    return crop_quality(crop) * quad_stability(quad, prev_quad)
+
+
+class BestFrameSelector:
+    """Keep the best warped crop of one board while it is in the centering window
+
+    ``add`` returns True once the score has not improved for ``patience``
+    frames (or ``max_frames`` were seen), the board is then ready to inspect
+    with ``best_crop``.
+    """
+
+    def __init__(self, patience=3, max_frames=15):
+        self.patience = patience
+        self.max_frames = max_frames
+        self.best_crop = None
+        self.best_score = -1.0
+        self.frames = 0
+        self.since_best = 0
+        self.prev_quad = None
+
+    def add(self, crop, quad):
+        score = score_crop(crop, quad, self.prev_quad)
+        self.prev_quad = quad
+        self.frames += 1
+
+        if score > self.best_score:
+            self.best_score = score
+            self.best_crop = crop
+            self.since_best = 0
+        else:
+            self.since_best += 1
+
+        return self.done()
+
+    def done(self):
+        return self.best_crop is not None and (
+            self.since_best >= self.patience or self.frames >= self.max_frames
+        )
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import cv2
+
+from .metrics import CallbackCounter, Gauge, register
+
+logger = logging.getLogger(__name__)
+
+# Point at a directory of fake sysfs files to test without a Pi
+SYSFS_ROOT = os.environ.get("PCB_SYSFS_ROOT", "/sys")
+
+# Steps taken as pressure rises. Only the preview stream and the detection
+# cadence while no board is in view degrade, inspection always gets the
+# full-resolution crop.
+GOVERNOR_STEPS = (
+    {"name": "normal", "preview_fps": 12.5, "preview_scale": 1.0, "detect_every": 1},
+    {"name": "warm", "preview_fps": 8.0, "preview_scale": 1.0, "detect_every": 1},
+    {"name": "hot", "preview_fps": 5.0, "preview_scale": 0.75, "detect_every": 2},
+    {"name": "critical", "preview_fps": 2.0, "preview_scale": 0.5, "detect_every": 3},
+)
+# Level reached once each threshold is crossed
+TEMPERATURE_THRESHOLDS_C = (65.0, 72.0, 78.0)
+LOOP_LAG_THRESHOLDS_S = (0.05, 0.15, 0.4)
+# The firmware lowers the clock when it throttles
+THROTTLED_FREQ_RATIO = 0.8
+
+
+def level_for(value, thresholds):
+    if value is None:
+        return 0
+    return sum(1 for threshold in thresholds if value >= threshold)
+
+
+class PipelineGovernor:
+    """Step the preview down when the Pi runs hot, throttles or lags
+
+    A background task samples the SoC temperature, the CPU clock and the
+    event-loop lag. The level rises as soon as a threshold is crossed and
+    falls back one step at a time after ``relax_after`` seconds below it.
+    """
+
+    def __init__(
+        self,
+        sysfs_root=SYSFS_ROOT,
+        interval=2.0,
+        lag_sample=0.25,
+        relax_after=30.0,
+        steps=GOVERNOR_STEPS,
+    ):
+        self.sysfs_root = sysfs_root
+        self.interval = interval
+        self.lag_sample = lag_sample
+        self.relax_after = relax_after
+        self.steps = steps
+
+        self.level = 0
+        self.changes = 0
+        self.history = deque(maxlen=20)
+        self.temperature_c = None
+        self.cpu_freq_khz = None
+        self.cpu_max_freq_khz = None
+        self.loop_lag = 0.0
+        self.max_loop_lag = 0.0
+        self._last_change = time.monotonic()
+        self._task = None
+
+    def _read(self, relative_path):
+        try:
+            with open(os.path.join(self.sysfs_root, relative_path)) as f:
+                return float(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def read_temperature(self):
+        millidegrees = self._read("class/thermal/thermal_zone0/temp")
+        return None if millidegrees is None else millidegrees / 1000.0
+
+    def read_cpu_freq(self):
+        cpufreq = "devices/system/cpu/cpu0/cpufreq"
+        return (
+            self._read(f"{cpufreq}/scaling_cur_freq"),
+            self._read(f"{cpufreq}/scaling_max_freq"),
+        )
+
+    def throttled(self):
+        if not self.cpu_freq_khz or not self.cpu_max_freq_khz:
+            return False
+        return self.cpu_freq_khz < self.cpu_max_freq_khz * THROTTLED_FREQ_RATIO
+
+    def target_level(self):
+        level = max(
+            level_for(self.temperature_c, TEMPERATURE_THRESHOLDS_C),
+            level_for(self.loop_lag, LOOP_LAG_THRESHOLDS_S),
+            2 if self.throttled() else 0,
+        )
+        return min(level, len(self.steps) - 1)
+
+    def sample(self):
+        self.temperature_c = self.read_temperature()
+        self.cpu_freq_khz, self.cpu_max_freq_khz = self.read_cpu_freq()
+
+    def evaluate(self, now=None):
+        """Move to the level the latest readings call for, returns the level"""
+        if now is None:
+            now = time.monotonic()
+        target = self.target_level()
+        if target > self.level:
+            self._set_level(target, now)
+        elif target < self.level and now - self._last_change >= self.relax_after:
+            self._set_level(self.level - 1, now)
+        return self.level
+
+    def _set_level(self, level, now):
+        previous = self.steps[self.level]["name"]
+        self.level = level
+        self.changes += 1
+        self._last_change = now
+        step = self.steps[level]
+        self.history.append(
+            {
+                "time": time.time(),
+                "level": level,
+                "step": step["name"],
+                "temperature_c": self.temperature_c,
+                "cpu_freq_khz": self.cpu_freq_khz,
+                "loop_lag_s": self.loop_lag,
+            }
+        )
+        logger.warning(
+            f"Governor {previous} -> {step['name']}: "
+            f"temp={self.temperature_c}C freq={self.cpu_freq_khz}kHz "
+            f"lag={self.loop_lag:.3f}s, preview {step['preview_fps']}fps "
+            f"x{step['preview_scale']}, detect every {step['detect_every']} frame(s)"
+        )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            window_lag = 0.0
+            window_end = loop.time() + self.interval
+            while loop.time() < window_end:
+                started = loop.time()
+                await asyncio.sleep(self.lag_sample)
+                lag = max(0.0, loop.time() - started - self.lag_sample)
+                window_lag = max(window_lag, lag)
+            self.loop_lag = window_lag
+            self.max_loop_lag = max(self.max_loop_lag, window_lag)
+            await asyncio.to_thread(self.sample)
+            self.evaluate()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def step(self):
+        return self.steps[self.level]
+
+    def frame_interval(self, base_interval):
+        return max(base_interval, 1.0 / self.step["preview_fps"])
+
+    def should_detect(self, frame_index, busy=False):
+        """Detection always runs while a board is being followed"""
+        return busy or frame_index % self.step["detect_every"] == 0
+
+    def preview(self, frame):
+        scale = self.step["preview_scale"]
+        if scale >= 1.0:
+            return frame
+        return cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    def summary(self):
+        return {
+            "level": self.level,
+            "step": self.step["name"],
+            "changes": self.changes,
+            "temperature_c": self.temperature_c,
+            "cpu_freq_khz": self.cpu_freq_khz,
+            "cpu_max_freq_khz": self.cpu_max_freq_khz,
+            "throttled": self.throttled(),
+            "loop_lag_s": self.loop_lag,
+            "max_loop_lag_s": self.max_loop_lag,
+            "preview_fps": self.step["preview_fps"],
+            "preview_scale": self.step["preview_scale"],
+            "detect_every": self.step["detect_every"],
+            "history": list(self.history),
+        }
+
+
+governor = PipelineGovernor()
+
+register(Gauge("pcb_governor_level", "Governor step, 0 is normal", lambda: governor.level))
+register(
+    CallbackCounter(
+        "pcb_governor_changes_total", "Governor step changes", lambda: governor.changes
+    )
+)
+register(Gauge("pcb_soc_temperature_celsius", "SoC temperature", lambda: governor.temperature_c))
+register(Gauge("pcb_event_loop_lag_seconds", "Event-loop lag", lambda: governor.loop_lag))
@@ -0,0 +1,144 @@
+import json
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from .metrics import CallbackCounter, register
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HEATMAP_DIR = os.environ.get(
+    "PCB_HEATMAP_DIR", os.path.join(BACKEND_DIR, "database.db", "heatmaps")
+)
+
+
+class HeatmapStore:
+    """Per product count of defective boards at each template pixel
+
+    One float32 ``.npy`` memmap per pcb_id, at the template's full
+    resolution, plus a small JSON of how many boards were added. ``add``
+    increments only the defect pixels of a board's aligned mask, so reading
+    the hotspots never touches the result files. Deleting a result does not
+    take its board back out, deleting the product drops the map.
+    """
+
+    def __init__(self, root=HEATMAP_DIR):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.maps = {}
+        self.boards = {}
+        self.updates = 0
+
+    def _paths(self, pcb_id):
+        base = os.path.join(self.root, f"pcb-{pcb_id}")
+        return base + ".npy", base + ".json"
+
+    def _load(self, pcb_id, shape=None):
+        """The memmap of a product, created with ``shape`` if missing (lock held)"""
+        heatmap = self.maps.get(pcb_id)
+        if heatmap is not None:
+            return heatmap
+        map_path, count_path = self._paths(pcb_id)
+        if os.path.exists(map_path):
+            heatmap = np.load(map_path, mmap_mode="r+")
+            try:
+                with open(count_path) as f:
+                    self.boards[pcb_id] = json.load(f)["boards"]
+            except (OSError, ValueError, KeyError):
+                self.boards[pcb_id] = 0
+        elif shape is not None:
+            os.makedirs(self.root, exist_ok=True)
+            heatmap = np.lib.format.open_memmap(
+                map_path, mode="w+", dtype=np.float32, shape=shape
+            )
+            self.boards[pcb_id] = 0
+        else:
+            return None
+        self.maps[pcb_id] = heatmap
+        return heatmap
+
+    def add(self, pcb_id, mask, template_shape):
+        """Count one board, ``mask`` is its defect mask at any working size
+
+        ``template_shape`` is the (height, width) of the product's template,
+        the map is created at that size and the mask stretched onto it.
+        """
+        with self.lock:
+            heatmap = self._load(pcb_id, tuple(int(v) for v in template_shape[:2]))
+            if mask.shape[:2] != heatmap.shape:
+                mask = cv2.resize(
+                    mask, (heatmap.shape[1], heatmap.shape[0]), interpolation=cv2.INTER_NEAREST
+                )
+            ys, xs = np.nonzero(mask)
+            heatmap[ys, xs] += 1.0
+            self.boards[pcb_id] += 1
+            self.updates += 1
+            self._write_count(pcb_id)
+
+    def _write_count(self, pcb_id):
+        _, count_path = self._paths(pcb_id)
+        with open(count_path, "w") as f:
+            json.dump({"boards": self.boards[pcb_id]}, f)
+
+    def get(self, pcb_id, max_size=None):
+        """(counts, boards) of a product, the counts averaged down so the
+        longest side is at most ``max_size``; (None, 0) without a map"""
+        with self.lock:
+            heatmap = self._load(pcb_id)
+            if heatmap is None:
+                return None, 0
+            boards = self.boards[pcb_id]
+            h, w = heatmap.shape
+            if max_size and max(h, w) > max_size:
+                factor = max_size / max(h, w)
+                size = (max(1, int(round(w * factor))), max(1, int(round(h * factor))))
+                counts = cv2.resize(np.asarray(heatmap), size, interpolation=cv2.INTER_AREA)
+            else:
+                counts = np.array(heatmap)
+        return counts, boards
+
+    def drop(self, pcb_id):
+        with self.lock:
+            self.maps.pop(pcb_id, None)
+            self.boards.pop(pcb_id, None)
+            for path in self._paths(pcb_id):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def flush(self):
+        with self.lock:
+            for heatmap in self.maps.values():
+                heatmap.flush()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "root": self.root,
+                "open_maps": len(self.maps),
+                "updates": self.updates,
+            }
+
+
+def render_heatmap(counts):
+    """JPEG of defect rates, colour-mapped from 0 to the hottest pixel"""
+    peak = float(counts.max()) if counts.size else 0.0
+    scaled = counts * (255.0 / peak) if peak > 0 else np.zeros_like(counts)
+    image = cv2.applyColorMap(scaled.astype(np.uint8), cv2.COLORMAP_JET)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+heatmap_store = HeatmapStore()
+
+register(
+    CallbackCounter(
+        "pcb_heatmap_updates_total",
+        "Boards added to the defect heatmaps",
+        lambda: heatmap_store.updates,
+    )
+)
@@ -0,0 +1,483 @@
+import hashlib
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+
+from .metrics import CallbackCounter, register
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+IMAGE_STORE_DIR = os.environ.get(
+    "PCB_IMAGE_STORE", os.path.join(BACKEND_DIR, "database.db", "blobs")
+)
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+# Segment record: magic, raw sha256, data length, then the data. The
+# headers let a lost index be rebuilt by scanning the segments.
+RECORD_MAGIC = b"PCB1"
+RECORD_HEADER = struct.Struct("<4s32sQ")
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class ImageStore:
+    """Content-addressed image files, ``<root>/<sha256><ext>``
+
+    Writing bytes that are already stored only returns the existing path,
+    so identical templates and artifacts share one file. The files carry
+    no ownership; ImagePCB rows reference them through the blob table,
+    whose refcount decides when ``remove`` may be called.
+    """
+
+    def __init__(self, root=IMAGE_STORE_DIR):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.dedup_hits = 0
+        self.bytes_written = 0
+        self.bytes_saved = 0
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.root, digest + ext)
+
+    def put(self, data: bytes, ext=".jpg"):
+        """Path of the blob holding ``data``, written only if new"""
+        path = self.path_for(hashlib.sha256(data).hexdigest(), ext)
+        with self.lock:
+            if os.path.exists(path):
+                self.dedup_hits += 1
+                self.bytes_saved += len(data)
+                return path
+            os.makedirs(self.root, exist_ok=True)
+            # readers never see a half-written blob
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.writes += 1
+            self.bytes_written += len(data)
+        return path
+
+    def digest_of(self, path):
+        """The sha256 of a blob path of this store, None for any other file"""
+        if not path or os.path.dirname(os.path.abspath(path)) != self.root:
+            return None
+        digest = os.path.splitext(os.path.basename(path))[0]
+        return digest if _DIGEST.match(digest) else None
+
+    def read_bytes(self, path):
+        """Contents of a stored image or any plain file, None if missing"""
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except (OSError, TypeError):
+            return None
+
+    def exists(self, path):
+        return bool(path) and os.path.exists(path)
+
+    def size(self, path):
+        try:
+            return os.path.getsize(path)
+        except (OSError, TypeError):
+            return None
+
+    def remove(self, path):
+        with self.lock:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Could not remove blob {path}: {str(e)}")
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {
+            "root": self.root,
+            "writes": self.writes,
+            "dedup_hits": self.dedup_hits,
+            "bytes_written": self.bytes_written,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+class SegmentStore(ImageStore):
+    """ImageStore packing the blobs into append-only segment files
+
+    Blobs keep their ``<root>/<sha256><ext>`` paths, but those name an
+    entry of the offset index (``index.db``, SQLite) instead of a file.
+    Writes append to the active segment and are fsynced in batches of
+    ``sync_every`` records or ``sync_interval`` seconds; the index is only
+    committed right after such an fsync, so it never points at data a
+    crash could lose. Callers about to commit rows referencing new blobs
+    call ``flush`` first. Reads slice an mmap of the segment. ``remove``
+    only marks a record dead; the background thread flushes the last
+    batch and copies the live records out of segments that are at least
+    ``compact_ratio`` dead, without holding the lock while it copies.
+    Paths of loose files written before packing keep working.
+    """
+
+    def __init__(
+        self,
+        root=IMAGE_STORE_DIR,
+        segment_bytes=SEGMENT_BYTES,
+        sync_every=32,
+        sync_interval=2.0,
+        compact_ratio=0.5,
+        compact_interval=300.0,
+    ):
+        super().__init__(root)
+        self.segment_dir = os.path.join(self.root, "segments")
+        self.segment_bytes = segment_bytes
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+
+        self.index = None
+        self.maps = {}
+        self.active_id = None
+        self.next_id = None
+        self.active_file = None
+        self.active_size = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.syncs = 0
+        self.compactions = 0
+
+        self._compact_wanted = threading.Event()
+        self._compact_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+
+    def _open(self):
+        """Open the index and the active segment on first use (lock held)"""
+        if self.index is not None:
+            return
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.index = sqlite3.connect(
+            os.path.join(self.root, "index.db"), check_same_thread=False
+        )
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("PRAGMA synchronous=NORMAL")
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, segment INTEGER,"
+            " offset INTEGER, length INTEGER, dead INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.index.execute("CREATE INDEX IF NOT EXISTS blobs_segment ON blobs (segment)")
+        self.index.commit()
+
+        segments = self._segment_ids()
+        self.active_id = segments[-1] if segments else 1
+        self.next_id = self.active_id + 1
+        self._open_active()
+        # records past the end of the file were indexed but never synced
+        lost = self.index.execute(
+            "DELETE FROM blobs WHERE segment = ? AND offset + length > ?",
+            (self.active_id, self.active_size),
+        ).rowcount
+        self.index.commit()
+        if lost:
+            logger.warning(f"Dropped {lost} blobs lost from the end of segment {self.active_id}")
+
+    def _segment_ids(self):
+        return sorted(
+            int(name[4:-4])
+            for name in os.listdir(self.segment_dir)
+            if name.startswith("seg-") and name.endswith(".dat")
+        )
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self.segment_dir, f"seg-{segment_id:06d}.dat")
+
+    def _open_active(self):
+        # unbuffered, so an mmap of the segment sees every completed write
+        self.active_file = open(self._segment_path(self.active_id), "ab", buffering=0)
+        self.active_size = self.active_file.seek(0, os.SEEK_END)
+
+    def _new_segment_id(self):
+        segment_id = self.next_id
+        self.next_id += 1
+        return segment_id
+
+    def _rotate(self):
+        self._sync()
+        self.active_file.close()
+        self.active_id = self._new_segment_id()
+        self._open_active()
+
+    def _sync(self):
+        """fsync the appended records, then commit the index (lock held)"""
+        if self.unsynced:
+            os.fsync(self.active_file.fileno())
+            self.unsynced = 0
+            self.syncs += 1
+        # the only commit of index changes, revivals and dead marks included
+        if self.index.in_transaction:
+            self.index.commit()
+        self.last_sync = time.monotonic()
+
+    def _append(self, digest, data):
+        if self.active_size + RECORD_HEADER.size + len(data) > self.segment_bytes and self.active_size:
+            self._rotate()
+        header = RECORD_HEADER.pack(RECORD_MAGIC, bytes.fromhex(digest), len(data))
+        self.active_file.write(header + data)
+        offset = self.active_size + RECORD_HEADER.size
+        self.active_size += RECORD_HEADER.size + len(data)
+        self.unsynced += 1
+        return self.active_id, offset
+
+    def put(self, data: bytes, ext=".jpg"):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest, ext)
+        with self.lock:
+            self._open()
+            row = self.index.execute(
+                "SELECT dead FROM blobs WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is not None:
+                if row[0]:
+                    # freed but not compacted yet, the record is still there
+                    self.index.execute("UPDATE blobs SET dead = 0 WHERE digest = ?", (digest,))
+                self.dedup_hits += 1
+                self.bytes_saved += len(data)
+                return path
+
+            segment_id, offset = self._append(digest, data)
+            self.index.execute(
+                "INSERT INTO blobs (digest, segment, offset, length) VALUES (?, ?, ?, ?)",
+                (digest, segment_id, offset, len(data)),
+            )
+            self.writes += 1
+            self.bytes_written += len(data)
+            if (
+                self.unsynced >= self.sync_every
+                or time.monotonic() - self.last_sync >= self.sync_interval
+            ):
+                self._sync()
+        return path
+
+    def _map(self, segment_id, end):
+        """mmap of a segment covering at least ``end`` bytes (lock held)"""
+        segment_map = self.maps.get(segment_id)
+        if segment_map is None or len(segment_map) < end:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment_id), "rb") as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment_id] = segment_map
+        return segment_map
+
+    def _locate(self, path):
+        digest = self.digest_of(path)
+        if digest is None:
+            return None
+        return self.index.execute(
+            "SELECT segment, offset, length FROM blobs WHERE digest = ? AND dead = 0",
+            (digest,),
+        ).fetchone()
+
+    def read_bytes(self, path):
+        with self.lock:
+            self._open()
+            located = self._locate(path)
+            if located is not None:
+                segment_id, offset, length = located
+                return self._map(segment_id, offset + length)[offset : offset + length]
+        return super().read_bytes(path)
+
+    def exists(self, path):
+        with self.lock:
+            self._open()
+            if self._locate(path) is not None:
+                return True
+        return super().exists(path)
+
+    def size(self, path):
+        with self.lock:
+            self._open()
+            located = self._locate(path)
+        if located is not None:
+            return located[2]
+        return super().size(path)
+
+    def remove(self, path):
+        digest = self.digest_of(path)
+        with self.lock:
+            self._open()
+            marked = digest is not None and self.index.execute(
+                "UPDATE blobs SET dead = 1 WHERE digest = ? AND dead = 0", (digest,)
+            ).rowcount
+        if marked:
+            self._compact_wanted.set()
+        else:
+            super().remove(path)
+
+    def flush(self):
+        with self.lock:
+            if self.index is not None:
+                self._sync()
+
+    def compact(self, ratio=None):
+        """Rewrite the live records of mostly dead segments, returns bytes reclaimed"""
+        ratio = self.compact_ratio if ratio is None else ratio
+        reclaimed = 0
+        with self._compact_lock:
+            with self.lock:
+                self._open()
+                candidates = self.index.execute(
+                    "SELECT segment, SUM(CASE WHEN dead THEN length ELSE 0 END), SUM(length)"
+                    " FROM blobs WHERE segment != ? GROUP BY segment",
+                    (self.active_id,),
+                ).fetchall()
+                indexed = {segment_id for segment_id, _, _ in candidates}
+                # segments whose every record was compacted away or lost
+                for segment_id in self._segment_ids():
+                    if segment_id != self.active_id and segment_id not in indexed:
+                        reclaimed += self._drop_segment(segment_id)
+            for segment_id, dead, total in candidates:
+                if total and dead / total >= ratio:
+                    reclaimed += self._compact_segment(segment_id)
+        return reclaimed
+
+    def _compact_segment(self, segment_id):
+        """Copy the live records of a sealed segment to a new one, then drop it
+
+        Reads and puts only wait for the two index updates, the copy and
+        its fsync run without the lock.
+        """
+        with self.lock:
+            live = self.index.execute(
+                "SELECT digest, offset, length FROM blobs WHERE segment = ? AND dead = 0",
+                (segment_id,),
+            ).fetchall()
+            end = max((offset + length for _, offset, length in live), default=0)
+            source = self._map(segment_id, end) if live else None
+            target_id = self._new_segment_id() if live else None
+
+        moved = []
+        if live:
+            with open(self._segment_path(target_id), "wb") as f:
+                position = 0
+                for digest, offset, length in live:
+                    header = RECORD_HEADER.pack(RECORD_MAGIC, bytes.fromhex(digest), length)
+                    f.write(header + source[offset : offset + length])
+                    moved.append((target_id, position + RECORD_HEADER.size, digest, segment_id))
+                    position += RECORD_HEADER.size + length
+                f.flush()
+                os.fsync(f.fileno())
+
+        with self.lock:
+            self.index.executemany(
+                "UPDATE blobs SET segment = ?, offset = ? WHERE digest = ? AND segment = ?",
+                moved,
+            )
+            # records revived by a put while we copied
+            revived = self.index.execute(
+                "SELECT digest, offset, length FROM blobs WHERE segment = ? AND dead = 0",
+                (segment_id,),
+            ).fetchall()
+            for digest, offset, length in revived:
+                data = self._map(segment_id, offset + length)[offset : offset + length]
+                new_segment, new_offset = self._append(digest, data)
+                self.index.execute(
+                    "UPDATE blobs SET segment = ?, offset = ? WHERE digest = ?",
+                    (new_segment, new_offset, digest),
+                )
+            self.index.execute("DELETE FROM blobs WHERE segment = ?", (segment_id,))
+            # the copies are durable before the old records go
+            self._sync()
+            self.compactions += 1
+            logger.info(f"Compacted segment {segment_id}, {len(live) + len(revived)} blobs moved")
+            return self._drop_segment(segment_id)
+
+    def _drop_segment(self, segment_id):
+        segment_map = self.maps.pop(segment_id, None)
+        if segment_map is not None:
+            segment_map.close()
+        path = self._segment_path(segment_id)
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+
+    def _run(self):
+        next_compaction = time.monotonic() + self.compact_interval
+        while not self._stop.is_set():
+            self._compact_wanted.wait(self.sync_interval)
+            if self._stop.is_set():
+                break
+            try:
+                # the last batch must not wait for a put that may never come
+                self.flush()
+                if self._compact_wanted.is_set() or time.monotonic() >= next_compaction:
+                    self._compact_wanted.clear()
+                    next_compaction = time.monotonic() + self.compact_interval
+                    reclaimed = self.compact()
+                    if reclaimed:
+                        logger.info(f"Compaction reclaimed {reclaimed / 1024 / 1024:.1f}MB")
+            except Exception as e:
+                logger.error(f"Blob store maintenance failed: {str(e)}", exc_info=True)
+
+    def start(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name="blob-store", daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        self._stop.set()
+        self._compact_wanted.set()
+        if self._worker is not None:
+            self._worker.join(5.0)
+            self._worker = None
+        self.flush()
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            if self.index is not None:
+                live, dead = self.index.execute(
+                    "SELECT COALESCE(SUM(CASE WHEN dead THEN 0 ELSE length END), 0),"
+                    " COALESCE(SUM(CASE WHEN dead THEN length ELSE 0 END), 0) FROM blobs"
+                ).fetchone()
+                stats.update(live_bytes=live, dead_bytes=dead)
+            stats.update(
+                active_segment=self.active_id,
+                syncs=self.syncs,
+                compactions=self.compactions,
+            )
+        return stats
+
+
+image_store = SegmentStore()
+
+register(
+    CallbackCounter(
+        "pcb_image_store_dedup_hits_total",
+        "Image writes skipped because the same bytes were stored",
+        lambda: image_store.dedup_hits,
+    )
+)
+register(
+    CallbackCounter(
+        "pcb_image_store_bytes_saved_total",
+        "Bytes not written thanks to deduplication",
+        lambda: image_store.bytes_saved,
+    )
+)
+register(
+    CallbackCounter(
+        "pcb_image_store_syncs_total",
+        "Batched fsyncs of the active segment",
+        lambda: image_store.syncs,
+    )
+)
@@ -0,0 +1,451 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from .metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Inspection plans, cheapest first. Every level returns the same verdict
+# fields so a caller can take whichever one fits its time budget.
+#   lowres_diff: half resolution, phase correlation shift only (the crop is
+#                already warped to the board quad), a low confidence verdict
+#   full_ecc:    full resolution, ECC affine registration
+#   full_orb:    full resolution, ORB + FLANN homography (reference)
+LEVELS = ("lowres_diff", "full_ecc", "full_orb")
+LOW_CONFIDENCE_LEVELS = ("lowres_diff",)
+DEFAULT_LEVEL_SECONDS = {"lowres_diff": 0.05, "full_ecc": 0.3, "full_orb": 0.9}
+
+
+def image_preprocess(img):
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return clahe.apply(img)
+
+
+def describe_accuracy(accuracy_percentage):
+    if accuracy_percentage <= 80:
+        return "The PCB picture does not match or is incorrect."
+    elif accuracy_percentage <= 97:
+        return "The PCB picture has many errors."
+    return "The PCB picture has some errors."
+
+
+def binarize_pair(template_img, defective_img, scale=1.0):
+    """Grayscale, size-match and adaptive-threshold both images"""
+    template_gray = cv2.cvtColor(template_img, cv2.COLOR_BGR2GRAY)
+    defective_gray = cv2.cvtColor(defective_img, cv2.COLOR_BGR2GRAY)
+
+    min_height = min(template_gray.shape[0], defective_gray.shape[0])
+    min_width = min(template_gray.shape[1], defective_gray.shape[1])
+    size = (max(1, int(min_width * scale)), max(1, int(min_height * scale)))
+    template_gray = cv2.resize(template_gray, size)
+    defective_gray = cv2.resize(defective_gray, size)
+
+    # === CLAHE for lighting compensation ===
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    template = clahe.apply(template_gray)
+    defective = clahe.apply(defective_gray)
+
+    # === Adaptive Threshold instead of Otsu ===
+    template = cv2.adaptiveThreshold(
+        template, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 15, 2
+    )
+    defective = cv2.adaptiveThreshold(
+        defective, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 15, 2
+    )
+    return template, defective
+
+
+def align_orb(template, defective):
+    """Homography mapping defective onto template, or (None, reason)"""
+    template_proc = image_preprocess(template)
+    defective_proc = image_preprocess(defective)
+
+    orb = cv2.ORB_create(
+        nfeatures=20000, scaleFactor=1.2, nlevels=8, edgeThreshold=15, patchSize=31
+    )
+    kp1, des1 = orb.detectAndCompute(template_proc, None)
+    kp2, des2 = orb.detectAndCompute(defective_proc, None)
+
+    if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
+        return None, "Not enough features for matching"
+
+    FLANN_INDEX_LSH = 6
+    index_params = dict(
+        algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1
+    )
+    search_params = dict(checks=50)
+    flann = cv2.FlannBasedMatcher(index_params, search_params)
+
+    matches = flann.knnMatch(des1, des2, k=2)
+
+    good_matches = []
+    for m_n in matches:
+        if len(m_n) == 2:
+            m, n = m_n
+            if m.distance < 0.7 * n.distance:
+                good_matches.append(m)
+
+    if len(good_matches) < 1:
+        return None, "Not enough good matches for alignment"
+
+    src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+    dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+
+    H, _ = cv2.findHomography(dst_pts, src_pts, cv2.RANSAC, 5.0)
+    if H is None:
+        return None, "Homography estimation failed"
+    return H, None
+
+
+def align_shift(template, defective):
+    """Coarse registration, the translation found by phase correlation"""
+    (dx, dy), _ = cv2.phaseCorrelate(np.float32(template), np.float32(defective))
+    # the defective image is shifted by (dx, dy), move it back by whole
+    # pixels: a sub-pixel warp would blur every edge of the binary image
+    dx, dy = round(dx), round(dy)
+    return np.array([[1, 0, -dx], [0, 1, -dy], [0, 0, 1]], dtype=np.float64), None
+
+
+def align_ecc(template, defective):
+    """ECC affine registration expressed as a homography like align_orb"""
+    warp = np.eye(2, 3, dtype=np.float32)
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4)
+    try:
+        _, warp = cv2.findTransformECC(
+            template.astype(np.float32),
+            defective.astype(np.float32),
+            warp,
+            cv2.MOTION_AFFINE,
+            criteria,
+            None,
+            5,
+        )
+    except cv2.error:
+        return None, "ECC alignment did not converge"
+    # ECC maps template coordinates into the defective image
+    return np.linalg.inv(np.vstack([warp, [0, 0, 1]])), None
+
+
+def find_defects(mask, diff, to_template=(1.0, 1.0)):
+    """Connected regions of a defect mask, in the template's own pixels
+
+    Bbox, area, centroid and the mean of ``diff`` over each region, from
+    a single labelling pass; the intensity sums only visit the defect
+    pixels. ``to_template`` is the (x, y) factor from the working
+    resolution back to the template image.
+    """
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        mask, connectivity=8, ltype=cv2.CV_16U
+    )
+    if count >= np.iinfo(np.uint16).max:
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(
+            mask, connectivity=8, ltype=cv2.CV_32S
+        )
+    if count <= 1:
+        return []
+    pixels = np.flatnonzero(mask)
+    intensity = np.bincount(
+        labels.ravel()[pixels], weights=diff.ravel()[pixels], minlength=count
+    )
+    fx, fy = to_template
+    defects = []
+    for label in range(1, count):
+        x, y, width, height, area = stats[label]
+        cx, cy = centroids[label]
+        defects.append(
+            {
+                "x": int(round(x * fx)),
+                "y": int(round(y * fy)),
+                "width": max(1, int(round(width * fx))),
+                "height": max(1, int(round(height * fy))),
+                "area": int(round(area * fx * fy)),
+                "cx": float((cx + 0.5) * fx - 0.5),
+                "cy": float((cy + 0.5) * fy - 0.5),
+                "mean_intensity": float(intensity[label] / area),
+            }
+        )
+    return defects
+
+
+def diff_images(template, aligned, to_template=(1.0, 1.0)):
+    """Difference, defect mask, defect regions and accuracy of an aligned pair"""
+    # === Blur before diff to reduce lighting noise ===
+    template_blur = cv2.GaussianBlur(template, (3, 3), 0)
+    aligned_blur = cv2.GaussianBlur(aligned, (3, 3), 0)
+
+    diff = cv2.absdiff(template_blur, aligned_blur)
+
+    # Specific gray mask for defect highlight
+    mask = cv2.inRange(diff, 50, 225)
+    specific_gray = cv2.bitwise_and(diff, diff, mask=mask)
+
+    # Thresholding combination
+    _, thresh_otsu = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    thresh_range = cv2.inRange(diff, 100, 255)
+    combined_thresh = cv2.bitwise_or(thresh_otsu, thresh_range)
+
+    # Morphology
+    kernel = np.ones((3, 3), np.uint8)
+    cleaned = cv2.morphologyEx(combined_thresh, cv2.MORPH_OPEN, kernel, iterations=1)
+    cleaned = cv2.morphologyEx(cleaned, cv2.MORPH_CLOSE, kernel, iterations=2)
+
+    # the defects are the components of the closed mask, the verdict counts
+    # their outer contours filled, holes included
+    contours, _ = cv2.findContours(cleaned, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    mask_diff = np.zeros_like(cleaned)
+    cv2.drawContours(mask_diff, contours, -1, (255), thickness=cv2.FILLED)
+    result = cv2.bitwise_and(aligned, aligned, mask=mask_diff)
+
+    total_pixels = result.shape[0] * result.shape[1]
+    white_pixels = total_pixels - cv2.countNonZero(result)
+    accuracy_percentage = (white_pixels / total_pixels) * 100
+
+    return {
+        "accuracy": accuracy_percentage,
+        "defects": find_defects(cleaned, diff, to_template),
+        "mask": cleaned,
+        "images": {
+            "template": template,
+            "aligned": aligned,
+            "diff": diff,
+            "cleaned": specific_gray,
+            "result": result,
+        },
+    }
+
+
+def level_scale(level):
+    return 0.5 if level == "lowres_diff" else 1.0
+
+
+def compare_pcb(template_img, defective_img, level="full_orb"):
+    """Run one inspection plan on decoded BGR images"""
+    scale = level_scale(level)
+    template, defective = binarize_pair(template_img, defective_img, scale)
+
+    with stage("registration"):
+        if level == "lowres_diff":
+            H, message = align_shift(template, defective)
+        elif level == "full_ecc":
+            H, message = align_ecc(template, defective)
+        else:
+            H, message = align_orb(template, defective)
+
+    if H is None:
+        return {"detected": False, "message": message, "level": level}
+
+    with stage("diff"):
+        aligned = cv2.warpPerspective(
+            defective, H, (template.shape[1], template.shape[0])
+        )
+        # binarize_pair works at min(template, capture) * scale
+        to_template = (
+            template_img.shape[1] / template.shape[1],
+            template_img.shape[0] / template.shape[0],
+        )
+        compared = diff_images(template, aligned, to_template)
+    compared["images"]["defective"] = defective
+
+    return {
+        "detected": True,
+        "message": "PCB analysis completed successfully",
+        "accuracy": compared["accuracy"],
+        "result": describe_accuracy(compared["accuracy"]),
+        "level": level,
+        "confidence": "low" if level in LOW_CONFIDENCE_LEVELS else "high",
+        "homography": H,
+        # (height, width) of the template, the frame of defects and mask
+        "template_shape": template_img.shape[:2],
+        "defects": compared["defects"],
+        "mask": compared["mask"],
+        "images": compared["images"],
+    }
+
+
+def regenerate_images(template_img, defective_img, level, H):
+    """The artifact images of a past inspection, from its inputs and homography
+
+    Repeats compare_pcb without the registration, so the images are the
+    ones the inspection saw (given the same decoded inputs).
+    """
+    template, defective = binarize_pair(template_img, defective_img, level_scale(level))
+    aligned = cv2.warpPerspective(defective, H, (template.shape[1], template.shape[0]))
+    images = diff_images(template, aligned)["images"]
+    images["defective"] = defective
+    return images
+
+
+class InspectionEngine:
+    """Deadline-aware anytime inspection
+
+    Each level's cost is learned as an EWMA of its measured run time. With a
+    deadline the engine first runs the cheapest level, so a verdict exists
+    whatever happens, then refines it with the most accurate level still
+    predicted to finish in the remaining budget, stepping down if that
+    level cannot register the board. The best verdict found so far is
+    returned. Without a deadline it runs full_orb, falling back the same
+    way.
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.cost = dict(DEFAULT_LEVEL_SECONDS)
+        self.level_counts = {level: 0 for level in LEVELS}
+        self.late = 0
+        self.runs = 0
+        self.lock = threading.Lock()
+
+    def plan(self, budget):
+        """Refinement levels for a budget in seconds, best first"""
+        if budget is None:
+            return list(reversed(LEVELS))
+        return [level for level in reversed(LEVELS[1:]) if self.cost[level] <= budget]
+
+    def run(self, template_img, defective_img, deadline=None, cancel_event=None):
+        """Inspect against a time.monotonic() deadline (None for no deadline)
+
+        Setting ``cancel_event`` stops the run before the next level starts.
+        """
+        started = time.monotonic()
+        best = None
+        failed = None
+
+        def attempt(level):
+            nonlocal best, failed
+            level_started = time.monotonic()
+            result = compare_pcb(template_img, defective_img, level)
+            self._observe(level, time.monotonic() - level_started)
+            if result["detected"]:
+                best = result
+            else:
+                failed = result
+            return result["detected"]
+
+        if deadline is None:
+            levels = self.plan(None)
+        else:
+            # the cheap verdict first, then refine while the budget lasts
+            attempt(LEVELS[0])
+            levels = self.plan(deadline - time.monotonic())
+
+        for level in levels:
+            if cancel_event is not None and cancel_event.is_set():
+                return {
+                    "detected": False,
+                    "message": "Cancelled",
+                    "level": None,
+                    "late": False,
+                    "cancelled": True,
+                }
+            if deadline is not None and time.monotonic() + self.cost[level] > deadline:
+                continue
+            if attempt(level):
+                break
+
+        result = best if best is not None else failed
+        elapsed = time.monotonic() - started
+        result["elapsed"] = elapsed
+        result["late"] = deadline is not None and time.monotonic() > deadline
+
+        with self.lock:
+            self.runs += 1
+            self.level_counts[result["level"]] += 1
+            if result["late"]:
+                self.late += 1
+        if result["late"]:
+            logger.warning(
+                f"Inspection missed its deadline by "
+                f"{time.monotonic() - deadline:.3f}s at level {result['level']}"
+            )
+        return result
+
+    def _observe(self, level, seconds):
+        with self.lock:
+            self.cost[level] = self.alpha * seconds + (1 - self.alpha) * self.cost[level]
+
+    def summary(self):
+        with self.lock:
+            return {
+                "runs": self.runs,
+                "late": self.late,
+                "levels": dict(self.level_counts),
+                "level_seconds": dict(self.cost),
+            }
+
+
+class InspectionJob:
+    def __init__(self, board_id, future, cancel_event, quality, deadline):
+        self.board_id = board_id
+        self.future = future
+        self.cancel_event = cancel_event
+        self.quality = quality
+        self.deadline = deadline
+        self.submitted = time.monotonic()
+        # set by the worker, a speculative job may wait long before it runs
+        self.started = None
+        self.finished = None
+
+    def run_seconds(self):
+        """Time the inspection itself took, None until it finished"""
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.future.cancel()
+
+
+class InspectionPool:
+    """Worker threads running at most one live inspection job per board
+
+    Submitting a job for a board that already has one supersedes it: the
+    old job is cancelled if still queued, or told to stop at its next
+    level boundary if already running.
+    """
+
+    def __init__(self, max_workers=2):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="inspection"
+        )
+        self.jobs = {}
+        self.submitted = 0
+        self.cancelled = 0
+
+    def submit(self, board_id, quality, deadline, fn, *args):
+        """Run fn(*args, deadline=..., cancel_event=...) for one board"""
+        self.cancel(board_id)
+        cancel_event = threading.Event()
+        # jobs join the board trace of the caller
+        context = contextvars.copy_context()
+        job = InspectionJob(board_id, None, cancel_event, quality, deadline)
+
+        def run():
+            job.started = time.monotonic()
+            try:
+                return context.run(fn, *args, deadline=deadline, cancel_event=cancel_event)
+            finally:
+                job.finished = time.monotonic()
+
+        job.future = self.executor.submit(run)
+        self.jobs[board_id] = job
+        self.submitted += 1
+        return job
+
+    def cancel(self, board_id):
+        job = self.jobs.pop(board_id, None)
+        if job is not None:
+            job.cancel()
+            self.cancelled += 1
+
+    def shutdown(self):
+        for board_id in list(self.jobs):
+            self.cancel(board_id)
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from .metrics import CallbackCounter, register
+
+logger = logging.getLogger(__name__)
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def short_path(filename):
+    if filename.startswith(SRC_DIR):
+        return "src" + filename[len(SRC_DIR):]
+    return os.path.join(*filename.split(os.sep)[-2:])
+
+
+class LoopMonitor:
+    """Find the code that blocks the event loop
+
+    A heartbeat task measures how late the loop wakes it up. A sampling
+    thread watches the heartbeat and, while it is overdue by more than
+    ``threshold``, grabs the stack of the loop thread every ``interval``.
+    Each distinct stack is an offender, ranked by the time it held the loop.
+    """
+
+    def __init__(self, interval=0.02, threshold=0.1, max_offenders=50, stack_depth=15):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_offenders = max_offenders
+        self.stack_depth = stack_depth
+
+        self.offenders = {}
+        self.lock = threading.Lock()
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.stalls = 0
+        self.blocked_seconds = 0.0
+
+        self._beat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start monitoring the running loop"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(
+            target=self._sample_loop, name="loop-monitor", daemon=True
+        )
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - before - self.interval)
+            self._beat = now
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms")
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            overdue = time.monotonic() - self._beat - self.interval
+            if overdue < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)[-self.stack_depth:]
+            del frame
+            if stack and stack[-1].filename.endswith("selectors.py"):
+                # the loop is idle again, the heartbeat just has not run yet
+                continue
+            self._record(stack, overdue)
+
+    def _record(self, stack, overdue):
+        key = tuple((entry.filename, entry.lineno, entry.name) for entry in stack)
+        with self.lock:
+            self.blocked_seconds += self.interval
+            offender = self.offenders.get(key)
+            if offender is None:
+                if len(self.offenders) >= self.max_offenders:
+                    smallest = min(
+                        self.offenders, key=lambda k: self.offenders[k]["blocked_seconds"]
+                    )
+                    del self.offenders[smallest]
+                offender = self.offenders[key] = {
+                    "samples": 0,
+                    "blocked_seconds": 0.0,
+                    "max_overdue_seconds": 0.0,
+                    "stack": stack,
+                }
+            offender["samples"] += 1
+            offender["blocked_seconds"] += self.interval
+            offender["max_overdue_seconds"] = max(offender["max_overdue_seconds"], overdue)
+            offender["last_seen"] = time.time()
+
+    def report(self, limit=10):
+        with self.lock:
+            ranked = sorted(
+                self.offenders.values(), key=lambda o: o["blocked_seconds"], reverse=True
+            )[:limit]
+            offenders = [
+                {
+                    "location": self._location(offender["stack"]),
+                    "samples": offender["samples"],
+                    "blocked_seconds": offender["blocked_seconds"],
+                    "max_overdue_seconds": offender["max_overdue_seconds"],
+                    "last_seen": offender["last_seen"],
+                    "stack": [
+                        f"{short_path(entry.filename)}:{entry.lineno} in {entry.name}"
+                        for entry in offender["stack"]
+                    ],
+                }
+                for offender in ranked
+            ]
+        return {
+            "threshold_seconds": self.threshold,
+            "last_lag_seconds": self.last_lag,
+            "max_lag_seconds": self.max_lag,
+            "stalls": self.stalls,
+            "blocked_seconds": self.blocked_seconds,
+            "offenders": offenders,
+        }
+
+    def _location(self, stack):
+        """Innermost frame of our own code, the call that blocked"""
+        for entry in reversed(stack):
+            if entry.filename.startswith(SRC_DIR):
+                return f"{short_path(entry.filename)}:{entry.lineno} in {entry.name}"
+        entry = stack[-1]
+        return f"{short_path(entry.filename)}:{entry.lineno} in {entry.name}"
+
+    def reset(self):
+        with self.lock:
+            self.offenders.clear()
+            self.max_lag = 0.0
+            self.stalls = 0
+            self.blocked_seconds = 0.0
+
+
+loop_monitor = LoopMonitor()
+
+register(
+    CallbackCounter(
+        "pcb_event_loop_blocked_seconds_total",
+        "Time the event loop was sampled blocked past the threshold",
+        lambda: loop_monitor.blocked_seconds,
+    )
+)
+register(
+    CallbackCounter(
+        "pcb_event_loop_stalls_total",
+        "Heartbeats delayed past the threshold",
+        lambda: loop_monitor.stalls,
+    )
+)
@@ -0,0 +1,123 @@
+import struct
+
+import numpy as np
+
+# The "cleaned" and "result" artifacts are zero but for the defects. They
+# are stored run-length encoded instead of as JPEGs: lossless, a few KB
+# and the defect area and bounding box come straight from the runs.
+MASK_ARTIFACTS = ("cleaned", "result")
+MASK_EXT = ".rle"
+
+# magic, height, width, number of runs, number of foreground values
+MASK_HEADER = struct.Struct("<4sIIII")
+MASK_MAGIC = b"RLE1"
+
+
+def rle_encode(mask):
+    """COCO style RLE of the nonzero pixels, ``{"size": [h, w], "counts": ...}``
+
+    Runs are taken in column-major order and alternate background and
+    foreground, starting with a (possibly empty) background run.
+    """
+    h, w = mask.shape[:2]
+    foreground = mask.ravel(order="F") != 0
+    if foreground.size == 0:
+        return {"size": [h, w], "counts": np.zeros(0, np.uint32)}
+    changes = np.flatnonzero(foreground[1:] != foreground[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [foreground.size])))
+    if foreground[0]:
+        counts = np.concatenate(([0], counts))
+    return {"size": [h, w], "counts": counts.astype(np.uint32)}
+
+
+def rle_decode(rle):
+    """Boolean mask of an RLE"""
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    flat = np.repeat(np.arange(counts.size) % 2 == 1, counts)
+    return np.ascontiguousarray(flat.reshape((w, h)).T)
+
+
+def _foreground_runs(rle):
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    starts, lengths = starts[1::2], counts[1::2]
+    return starts[lengths > 0], lengths[lengths > 0]
+
+
+def rle_area(rle):
+    """Number of foreground pixels"""
+    return int(np.asarray(rle["counts"], dtype=np.int64)[1::2].sum())
+
+
+def rle_bbox(rle):
+    """``[x, y, w, h]`` of the foreground, None for an empty mask"""
+    h = rle["size"][0]
+    starts, lengths = _foreground_runs(rle)
+    if starts.size == 0:
+        return None
+    ends = starts + lengths - 1
+    first_col, last_col = starts // h, ends // h
+    x0, x1 = int(first_col.min()), int(last_col.max())
+    # a run wrapping into the next column covers the last and first rows
+    wraps = last_col > first_col
+    single = ~wraps
+    y0 = 0 if wraps.any() else int((starts[single] % h).min())
+    y1 = h - 1 if wraps.any() else int((ends[single] % h).max())
+    return [x0, y0, x1 - x0 + 1, y1 - y0 + 1]
+
+
+def pack_mask(gray_image):
+    """Stored bytes of a mask artifact: header, uint32 runs, foreground values
+
+    The values are only kept when some foreground pixel is not 255, so a
+    binary mask costs its runs alone and a masked gray image stays exact.
+    """
+    rle = rle_encode(gray_image)
+    h, w = rle["size"]
+    values = gray_image.ravel(order="F")
+    values = values[values != 0]
+    if np.all(values == 255):
+        values = values[:0]
+    counts = rle["counts"].astype("<u4")
+    header = MASK_HEADER.pack(MASK_MAGIC, h, w, counts.size, values.size)
+    return header + counts.tobytes() + values.astype(np.uint8).tobytes()
+
+
+def read_rle(data):
+    """The RLE of packed mask bytes, without decoding the pixels"""
+    magic, h, w, n_counts, _ = MASK_HEADER.unpack_from(data)
+    if magic != MASK_MAGIC:
+        raise ValueError("Not a packed mask")
+    counts = np.frombuffer(data, "<u4", n_counts, MASK_HEADER.size)
+    return {"size": [h, w], "counts": counts}
+
+
+def unpack_mask(data):
+    """Gray image of packed mask bytes"""
+    magic, h, w, n_counts, n_values = MASK_HEADER.unpack_from(data)
+    if magic != MASK_MAGIC:
+        raise ValueError("Not a packed mask")
+    counts = np.frombuffer(data, "<u4", n_counts, MASK_HEADER.size)
+    foreground = rle_decode({"size": [h, w], "counts": counts})
+    image = np.zeros((h, w), np.uint8)
+    if n_values:
+        values = np.frombuffer(data, np.uint8, n_values, MASK_HEADER.size + 4 * n_counts)
+        # the values are in column-major order, as the runs
+        image.T[foreground.T] = values
+    else:
+        image[foreground] = 255
+    return image
+
+
+def mask_stats(data):
+    """Size, defect area and bounding box of packed mask bytes"""
+    rle = read_rle(data)
+    h, w = rle["size"]
+    area = rle_area(rle)
+    return {
+        "size": [h, w],
+        "area": area,
+        "area_ratio": area / (h * w) if h * w else 0.0,
+        "bbox": rle_bbox(rle),
+    }
@@ -0,0 +1,155 @@
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+MB = 1024 * 1024
+
+# Peak bytes a stage may allocate on a 640x480 frame and a board crop of
+# the same size, checked by assert_within_budgets
+STAGE_MEMORY_BUDGETS = {
+    "hsv_mask": 4 * MB,
+    "contour": 2 * MB,
+    "warp": 2 * MB,
+    "encode": 2 * MB,
+    "registration": 48 * MB,
+    "diff": 8 * MB,
+    "artifact_write": 8 * MB,
+}
+
+
+class MemoryBudgetExceeded(AssertionError):
+    pass
+
+
+class StageMemoryTracker:
+    """Attribute tracemalloc peak and retained bytes to pipeline stages
+
+    metrics.stage() calls ``enter``/``exit`` while tracking is enabled. The
+    tracemalloc peak is process wide, so the numbers are exact for a single
+    pipeline thread (tests, benchmarks) and an upper bound when several
+    threads run stages at once. Nested stages each get their own peak.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self._started_tracemalloc = False
+
+    def enable(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._started_tracemalloc = True
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def enter(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self._stack()
+        if stack:
+            # resetting the peak below would lose the parent's peak so far
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        tracemalloc.reset_peak()
+        stack.append({"name": name, "start": current, "peak": current})
+
+    def exit(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self._stack()
+        if not stack or stack[-1]["name"] != name:
+            return
+        frame = stack.pop()
+        frame["peak"] = max(frame["peak"], peak)
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], frame["peak"])
+
+        peak_bytes = frame["peak"] - frame["start"]
+        retained_bytes = current - frame["start"]
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {
+                    "calls": 0,
+                    "peak_bytes": 0,
+                    "last_peak_bytes": 0,
+                    "total_peak_bytes": 0,
+                    "retained_bytes": 0,
+                }
+            stats["calls"] += 1
+            stats["peak_bytes"] = max(stats["peak_bytes"], peak_bytes)
+            stats["last_peak_bytes"] = peak_bytes
+            stats["total_peak_bytes"] += peak_bytes
+            stats["retained_bytes"] += retained_bytes
+
+    def report(self):
+        with self.lock:
+            stages = {
+                name: {
+                    **stats,
+                    "mean_peak_bytes": stats["total_peak_bytes"] / stats["calls"],
+                }
+                for name, stats in self.stats.items()
+            }
+        current = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        return {"enabled": self.enabled, "traced_bytes": current, "stages": stages}
+
+    def over_budget(self, budgets=None):
+        """Stages whose worst peak exceeded their budget"""
+        if budgets is None:
+            budgets = STAGE_MEMORY_BUDGETS
+        with self.lock:
+            return {
+                name: {"peak_bytes": self.stats[name]["peak_bytes"], "budget_bytes": budget}
+                for name, budget in budgets.items()
+                if name in self.stats and self.stats[name]["peak_bytes"] > budget
+            }
+
+    def assert_within_budgets(self, budgets=None):
+        exceeded = self.over_budget(budgets)
+        if exceeded:
+            details = ", ".join(
+                f"{name} {info['peak_bytes'] / MB:.1f}MB > {info['budget_bytes'] / MB:.1f}MB"
+                for name, info in exceeded.items()
+            )
+            raise MemoryBudgetExceeded(f"Stage memory over budget: {details}")
+
+
+memory_tracker = StageMemoryTracker()
+
+
+@contextmanager
+def track_stage_memory(budgets=None):
+    """Track stage memory inside the block and check it against the budgets
+
+        with track_stage_memory():
+            inspection_engine.run(template, board)
+    """
+    was_enabled = memory_tracker.enabled
+    memory_tracker.reset()
+    memory_tracker.enable()
+    try:
+        yield memory_tracker
+    finally:
+        if not was_enabled:
+            memory_tracker.disable()
+    memory_tracker.assert_within_budgets(budgets)
+
+
+if os.environ.get("PCB_MEMORY_PROFILE") == "1":
+    memory_tracker.enable()
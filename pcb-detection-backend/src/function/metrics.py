@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from .memory import memory_tracker
+from .tracing import span
+
+# Pipeline stages timed with ``stage(name)``
+STAGES = (
+    "capture",
+    "hsv_mask",
+    "contour",
+    "warp",
+    "encode",
+    "ws_send",
+    "registration",
+    "diff",
+    "artifact_write",
+    "artifact_regenerate",
+    "db_commit",
+    "actuation",
+)
+# Seconds, from a fast numpy op to a full ORB registration on the Pi
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {self.value}",
+        ]
+
+
+class Histogram:
+    """Fixed-bucket histogram with one series per label value"""
+
+    def __init__(self, name, help_text, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            for label_value, series in sorted(self.series.items()):
+                labels = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{labels}}} {series['count']}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                label_value: {"count": series["count"], "sum": series["sum"]}
+                for label_value, series in self.series.items()
+            }
+
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self):
+        value = self.read()
+        if value is None:
+            return []
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.type_name}",
+            f"{self.name} {float(value)}",
+        ]
+
+
+class CallbackCounter(Gauge):
+    """Monotonic total read from a callback at scrape time, name it ``_total``"""
+
+    type_name = "counter"
+
+
+stage_seconds = Histogram(
+    "pcb_stage_seconds", "Time spent in each pipeline stage", "stage"
+)
+frames_captured = Counter("pcb_frames_captured_total", "Frames decoded from the camera")
+frames_dropped = Counter(
+    "pcb_frames_dropped_total", "Frames replaced by a newer one before any handler read them"
+)
+frames_sent = Counter("pcb_frames_sent_total", "Preview frames sent over websockets")
+boards_inspected = Counter("pcb_boards_inspected_total", "Boards inspected and stored")
+boards_passed = Counter("pcb_boards_passed_total", "Boards that passed inspection")
+boards_rejected = Counter("pcb_boards_rejected_total", "Boards rejected by inspection")
+
+
+def _resident_bytes():
+    """Current RSS from /proc, None where it is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+_metrics = [
+    CallbackCounter(
+        "pcb_process_cpu_seconds_total", "CPU time used by the server process", time.process_time
+    ),
+    Gauge("pcb_process_resident_memory_bytes", "Resident memory of the server", _resident_bytes),
+    Gauge("pcb_cpu_count", "CPUs available to the server", os.cpu_count),
+    stage_seconds,
+    frames_captured,
+    frames_dropped,
+    frames_sent,
+    boards_inspected,
+    boards_passed,
+    boards_rejected,
+]
+
+
+def register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# thread id -> names of the stages open on it, read by the profiler
+active_stages = {}
+
+
+class stage:
+    """Time a block into ``pcb_stage_seconds``: ``with stage("warp"): ...``
+
+    The block is also recorded as a span of the active board trace and,
+    while memory tracking is on, its tracemalloc peak is attributed to it.
+    """
+
+    __slots__ = ("name", "started", "span", "stack")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.stack = active_stages.setdefault(threading.get_ident(), [])
+        self.stack.append(self.name)
+        self.span = span(self.name).__enter__()
+        if memory_tracker.enabled:
+            memory_tracker.enter(self.name)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stage_seconds.observe(self.name, time.perf_counter() - self.started)
+        if memory_tracker.enabled:
+            memory_tracker.exit(self.name)
+        self.span.__exit__(exc_type, exc, tb)
+        # coroutines on the event loop interleave, so this need not be the top
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index] == self.name:
+                del self.stack[index]
+                break
+        if not self.stack:
+            # threads come and go (pools, to_thread), only open stages stay
+            active_stages.pop(threading.get_ident(), None)
+        return False
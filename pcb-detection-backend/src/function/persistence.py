@@ -0,0 +1,123 @@
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from .metrics import CallbackCounter, Gauge, register
+
+logger = logging.getLogger(__name__)
+
+
+class PersistenceQueue:
+    """Write-behind storage of inspected boards
+
+    The line acts on a verdict first and only then queues the board here.
+    A single worker thread encodes and writes the artifacts and inserts the
+    rows, one board at a time and in order. At most ``maxsize`` boards
+    wait; when the card falls that far behind ``submit`` waits for a slot
+    (off the event loop) instead of letting memory grow. ``stop`` drains
+    the queue, so every board accepted before shutdown is written.
+    """
+
+    def __init__(self, maxsize=32):
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self._thread = None
+
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.waits = 0
+
+    def start(self):
+        with self.lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="persistence", daemon=True
+            )
+            self._thread.start()
+
+    async def submit(self, fn, *args):
+        """Queue fn(*args), returns a concurrent Future of its result"""
+        self.start()
+        future = Future()
+        # the write joins the board trace of the caller
+        item = (future, contextvars.copy_context(), fn, args)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.waits += 1
+            logger.warning(f"Persistence queue full ({self.queue.maxsize}), waiting")
+            await asyncio.to_thread(self.queue.put, item)
+        self.submitted += 1
+        return future
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                future, context, fn, args = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(context.run(fn, *args))
+                    self.written += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Persisting a board failed: {str(e)}", exc_info=True)
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Block until everything queued so far is written"""
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.join()
+
+    def stop(self, timeout=30.0):
+        """Write what is queued, then end the worker (blocking)"""
+        with self.lock:
+            thread, self._thread = self._thread, None
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(None)
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.error(
+                f"Persistence did not drain in {timeout}s, {self.queue.qsize()} boards left"
+            )
+        else:
+            logger.info(f"Persistence flushed, {self.written} boards written")
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "maxsize": self.queue.maxsize,
+            "submitted": self.submitted,
+            "written": self.written,
+            "failed": self.failed,
+            "waits": self.waits,
+        }
+
+
+persistence_queue = PersistenceQueue()
+
+register(
+    Gauge(
+        "pcb_persistence_queue_depth",
+        "Boards waiting to be written",
+        lambda: persistence_queue.stats()["depth"],
+    )
+)
+
+for _name, _key, _help in (
+    ("pcb_persistence_written_total", "written", "Boards written by the persistence worker"),
+    ("pcb_persistence_failed_total", "failed", "Boards whose write failed"),
+    ("pcb_persistence_waits_total", "waits", "Submits that waited for a free queue slot"),
+):
+    register(CallbackCounter(_name, _help, lambda key=_key: persistence_queue.stats()[key]))
@@ -0,0 +1,168 @@
+import asyncio
+import sys
+import threading
+import time
+import weakref
+from collections import Counter
+
+from .loop_monitor import short_path
+from .metrics import active_stages
+
+MAX_SECONDS = 60.0
+MIN_INTERVAL = 0.001
+
+# request path of every task serving an HTTP request or websocket
+_task_routes = weakref.WeakKeyDictionary()
+
+
+class RouteTagMiddleware:
+    """ASGI middleware remembering which route each asyncio task serves"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        task = asyncio.current_task()
+        _task_routes[task] = scope["path"]
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _task_routes.pop(task, None)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """Sample the stacks of every thread for a while
+
+    Sampling reads ``sys._current_frames()`` from a separate thread, the
+    profiled code is never instrumented or paused, so it is safe to run
+    while the line is inspecting. Each sample is tagged with its thread,
+    the route served by the running asyncio task on the loop thread, and
+    the innermost pipeline stage open on that thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.loop_thread_id = None
+
+    def attach(self, loop):
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+
+    def _tags(self, thread_id, thread_names):
+        thread = thread_names.get(thread_id, str(thread_id))
+        route = None
+        if thread_id == self.loop_thread_id and self.loop is not None:
+            task = asyncio.tasks._current_tasks.get(self.loop)
+            if task is not None:
+                route = _task_routes.get(task) or task.get_name()
+        stages = active_stages.get(thread_id)
+        stage = stages[-1] if stages else None
+        return thread, route, stage
+
+    def profile(self, seconds=10.0, interval=0.005):
+        """Blocking, returns (sample counts, duration, interval)"""
+        seconds = min(max(seconds, 0.1), MAX_SECONDS)
+        interval = max(interval, MIN_INTERVAL)
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("A profile is already running")
+        try:
+            own_id = threading.get_ident()
+            samples = Counter()
+            started = time.perf_counter()
+            deadline = started + seconds
+            while time.perf_counter() < deadline:
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append((code.co_name, code.co_filename, frame.f_lineno))
+                        frame = frame.f_back
+                    stack.reverse()
+                    samples[(self._tags(thread_id, thread_names), tuple(stack))] += 1
+                time.sleep(interval)
+            return samples, time.perf_counter() - started, interval
+        finally:
+            self.lock.release()
+
+
+def tag_frames(tags):
+    thread, route, stage = tags
+    frames = [f"thread:{thread}"]
+    if route:
+        frames.append(f"route:{route}")
+    if stage:
+        frames.append(f"stage:{stage}")
+    return frames
+
+
+def frame_name(frame):
+    name, filename, lineno = frame
+    return f"{name} ({short_path(filename)}:{lineno})"
+
+
+def to_collapsed(samples):
+    """Brendan Gregg's collapsed stacks, one ``a;b;c count`` line per stack"""
+    lines = []
+    for (tags, stack), count in samples.most_common():
+        names = tag_frames(tags) + [frame_name(frame).replace(";", ",") for frame in stack]
+        lines.append(f"{';'.join(names)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def to_speedscope(samples, duration, interval, name="pcb-detection-backend"):
+    """speedscope.app JSON, one sampled profile per thread"""
+    frames = []
+    frame_index = {}
+
+    def index_of(key, entry):
+        if key not in frame_index:
+            frame_index[key] = len(frames)
+            frames.append(entry)
+        return frame_index[key]
+
+    profiles = {}
+    for (tags, stack), count in samples.items():
+        indexes = [index_of(("tag", tag), {"name": tag}) for tag in tag_frames(tags)]
+        for frame in stack:
+            fn_name, filename, lineno = frame
+            indexes.append(
+                index_of(
+                    frame,
+                    {"name": fn_name, "file": short_path(filename), "line": lineno},
+                )
+            )
+        profile = profiles.setdefault(tags[0], {"samples": [], "weights": []})
+        profile["samples"].append(indexes)
+        profile["weights"].append(count * interval)
+
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": f"{name} sampling profiler",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": f"thread {thread}",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": duration,
+                "samples": profile["samples"],
+                "weights": profile["weights"],
+            }
+            for thread, profile in sorted(profiles.items())
+        ],
+    }
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,198 @@
+import contextvars
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# (trace, parent span id) of the code currently running, copied into
+# asyncio tasks, to_thread calls and inspection pool jobs
+_current = contextvars.ContextVar("pcb_trace", default=None)
+_span_ids = itertools.count(1)
+
+
+class Trace:
+    """Spans recorded for one board, from capture to the diverter"""
+
+    def __init__(self, board_id, max_spans=256):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.board_id = board_id
+        self.started_at = time.time()
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end, cpu=None, parent=None, span_id=None, **attrs):
+        """Record a span from perf_counter() start and end times"""
+        span = {
+            "id": span_id or next(_span_ids),
+            "parent": parent,
+            "name": name,
+            "start": start,
+            "duration": end - start,
+            "cpu": cpu,
+            "thread": threading.current_thread().name,
+            "attrs": attrs,
+        }
+        with self.lock:
+            if len(self.spans) >= self.max_spans:
+                self.dropped += 1
+            else:
+                self.spans.append(span)
+        return span
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        origin = spans[0]["start"] if spans else 0.0
+        return {
+            "trace_id": self.trace_id,
+            "board_id": self.board_id,
+            "started_at": self.started_at,
+            "dropped_spans": self.dropped,
+            "spans": [
+                {
+                    "id": span["id"],
+                    "parent": span["parent"],
+                    "name": span["name"],
+                    "offset_ms": (span["start"] - origin) * 1000,
+                    "duration_ms": span["duration"] * 1000,
+                    "cpu_ms": None if span["cpu"] is None else span["cpu"] * 1000,
+                    "thread": span["thread"],
+                    **span["attrs"],
+                }
+                for span in spans
+            ],
+        }
+
+
+class _Activation:
+    __slots__ = ("trace", "token")
+
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.token = _current.set((self.trace, None))
+        return self.trace
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self.token)
+        return False
+
+
+class _Span:
+    """Timed span under the active trace, CPU time is the thread's
+
+    A span that awaits on the event loop also counts the CPU time of the
+    other tasks that ran meanwhile.
+    """
+
+    __slots__ = ("name", "attrs", "trace", "parent", "span_id", "token", "start", "cpu")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.trace = None
+
+    def __enter__(self):
+        current = _current.get()
+        if current is None:
+            return self
+        self.trace, self.parent = current
+        self.span_id = next(_span_ids)
+        self.token = _current.set((self.trace, self.span_id))
+        self.cpu = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is None:
+            return False
+        end = time.perf_counter()
+        cpu = time.thread_time() - self.cpu
+        _current.reset(self.token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.add(
+            self.name,
+            self.start,
+            end,
+            cpu=cpu,
+            parent=self.parent,
+            span_id=self.span_id,
+            **self.attrs,
+        )
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Tracer:
+    """Bounded in-process buffer of the most recent board traces"""
+
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+
+    def board(self, board_id):
+        """The trace of a board, started on first use"""
+        with self.lock:
+            trace = self.traces.get(board_id)
+            if trace is None:
+                trace = self.traces[board_id] = Trace(board_id)
+                while len(self.traces) > self.capacity:
+                    self.traces.popitem(last=False)
+            return trace
+
+    def activate(self, trace):
+        """Make spans opened inside the block (and tasks it starts) join ``trace``"""
+        return _Activation(trace)
+
+    def recent(self, limit=20):
+        with self.lock:
+            traces = list(self.traces.values())[-limit:]
+        return [trace.to_dict() for trace in reversed(traces)]
+
+    def chrome(self, limit=20):
+        """Recent traces as Chrome trace events (chrome://tracing, Perfetto)"""
+        events = []
+        with self.lock:
+            traces = list(self.traces.values())[-limit:]
+        for trace in traces:
+            with trace.lock:
+                spans = list(trace.spans)
+            for span in spans:
+                events.append(
+                    {
+                        "name": span["name"],
+                        "cat": f"board-{trace.board_id}",
+                        "ph": "X",
+                        "ts": span["start"] * 1e6,
+                        "dur": span["duration"] * 1e6,
+                        "pid": trace.board_id,
+                        "tid": span["thread"],
+                        "args": {
+                            "trace_id": trace.trace_id,
+                            "cpu_ms": None if span["cpu"] is None else span["cpu"] * 1000,
+                            **span["attrs"],
+                        },
+                    }
+                )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+tracer = Tracer()
+
+
+def span(name, **attrs):
+    """``with span("servo"): ...`` records into the active trace, if any"""
+    return _Span(name, attrs)
+
+
+def current_trace():
+    current = _current.get()
+    return current[0] if current else None
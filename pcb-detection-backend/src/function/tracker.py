@@ -0,0 +1,112 @@
+import time
+from collections import deque
+
+
+def bbox_iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    ix = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    iy = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = ix * iy
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.0
+
+
+class TrackedBoard:
+    def __init__(self, board_id, detection, now):
+        self.board_id = board_id
+        self.first_seen = now
+        self.missed = 0
+        self.inspected = False
+        self.history = deque(maxlen=30)
+        self.update(detection, now)
+
+    def update(self, detection, now):
+        self.detection = detection
+        self.bbox = detection["bbox"]
+        self.centroid = detection["centroid"]
+        self.quad = detection["quad"]
+        self.last_seen = now
+        self.missed = 0
+        self.history.append((now, self.centroid[0], self.centroid[1]))
+
+    def velocity(self):
+        """Centroid velocity in px/s over the recent history"""
+        if len(self.history) < 2:
+            return 0.0, 0.0
+        t0, x0, y0 = self.history[0]
+        t1, x1, y1 = self.history[-1]
+        dt = t1 - t0
+        if dt <= 0:
+            return 0.0, 0.0
+        return (x1 - x0) / dt, (y1 - y0) / dt
+
+    def spans_x(self, line_x):
+        x, _, w, _ = self.bbox
+        return x < line_x < x + w
+
+
+class PCBTracker:
+    """Centroid/IoU tracker that gives every board on the belt a stable id
+
+    Detections are matched to live tracks greedily, best IoU first, falling
+    back to centroid distance for fast boards whose boxes no longer overlap
+    between frames. Tracks that go unmatched for ``max_missed`` frames are
+    dropped, so a board that leaves the view is never matched again.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_distance=120, max_missed=5, start_id=1):
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.next_id = start_id
+        self.tracks = {}
+
+    def update(self, detections, now=None):
+        if now is None:
+            now = time.time()
+
+        pairs = []
+        for board_id, track in self.tracks.items():
+            for index, detection in enumerate(detections):
+                iou = bbox_iou(track.bbox, detection["bbox"])
+                dx = track.centroid[0] - detection["centroid"][0]
+                dy = track.centroid[1] - detection["centroid"][1]
+                distance = (dx * dx + dy * dy) ** 0.5
+                if iou >= self.iou_threshold or distance <= self.max_distance:
+                    pairs.append((-iou, distance, board_id, index))
+        pairs.sort()
+
+        matched_tracks = set()
+        matched_detections = set()
+        for _, _, board_id, index in pairs:
+            if board_id in matched_tracks or index in matched_detections:
+                continue
+            self.tracks[board_id].update(detections[index], now)
+            matched_tracks.add(board_id)
+            matched_detections.add(index)
+
+        for board_id in list(self.tracks):
+            if board_id in matched_tracks:
+                continue
+            track = self.tracks[board_id]
+            track.missed += 1
+            if track.missed > self.max_missed:
+                del self.tracks[board_id]
+
+        for index, detection in enumerate(detections):
+            if index in matched_detections:
+                continue
+            track = TrackedBoard(self.next_id, detection, now)
+            self.tracks[self.next_id] = track
+            self.next_id += 1
+
+        return self.visible()
+
+    def visible(self):
+        """Tracks matched in the latest frame, left to right"""
+        return sorted(
+            (track for track in self.tracks.values() if track.missed == 0),
+            key=lambda track: track.centroid[0],
+        )
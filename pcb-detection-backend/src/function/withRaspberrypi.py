@@ -1,18 +1,26 @@
 from gpiozero import OutputDevice,Device
-from gpiozero.pins.lgpio import LGPIOFactory
+import os
 import time
 import numpy as np
 
-# Explicitly set the pin factory
-Device.pin_factory = LGPIOFactory()
+# Explicitly set the pin factory, unless one is chosen through the
+# environment (GPIOZERO_PIN_FACTORY=mock runs without a Raspberry Pi)
+if not os.environ.get("GPIOZERO_PIN_FACTORY"):
+    from gpiozero.pins.lgpio import LGPIOFactory
+
+    Device.pin_factory = LGPIOFactory()
 
 # belt = OutputDevice(17, active_high=False, initial_value=False)
 
 
 import asyncio
-from gpiozero import OutputDevice, Servo
+import threading
+from gpiozero import DigitalInputDevice, OutputDevice, Servo
 from RPLCD.i2c import CharLCD
 
+# Photoelectric beam-break sensor in front of the camera (active low)
+SENSOR_PIN = 22
+
 
 
 class Belt:
@@ -78,25 +86,90 @@ class Belt:
         #     self._task = True
 
 class Lcd :
-    def __init__(self):
-        self.lcd = CharLCD('PCF8574', 0x27, cols=16, rows=2, charmap='A02')
+    """16x2 I2C character LCD behind a background writer thread
 
-    def lcd_running(self):
+    Callers only set the text that should be shown. The writer pushes the
+    characters that differ from what is on the glass, at most ``max_rate``
+    times per second, so a burst of updates collapses into a single I2C
+    write and the factory loop never waits on the bus.
+    """
+
+    COLS = 16
+    ROWS = 2
+
+    def __init__(self, max_rate=5.0):
+        self.lcd = CharLCD('PCF8574', 0x27, cols=self.COLS, rows=self.ROWS, charmap='A02')
         self.lcd.clear()
-        self.lcd.write_string('Running........')
+        self.min_interval = 1.0 / max_rate
+        self.updates = 0
+        self.writes = 0
+        self._desired = [" " * self.COLS] * self.ROWS
+        self._shown = list(self._desired)
+        self._running = True
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._writer, name="lcd-writer", daemon=True)
+        self._thread.start()
+
+    def show(self, *lines):
+        """Set the desired rows, missing rows are blanked"""
+        lines = list(lines) + [""] * (self.ROWS - len(lines))
+        with self._cond:
+            self._desired = [str(line)[: self.COLS].ljust(self.COLS) for line in lines[: self.ROWS]]
+            self.updates += 1
+            self._cond.notify()
+
+    def show_row(self, row, text):
+        with self._cond:
+            desired = list(self._desired)
+            desired[row] = str(text)[: self.COLS].ljust(self.COLS)
+            self._desired = desired
+            self.updates += 1
+            self._cond.notify()
+
+    def show_text(self, text):
+        """Wrap text over both rows like the controller's own line break"""
+        self.show(*[text[i : i + self.COLS] for i in range(0, self.COLS * self.ROWS, self.COLS)])
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while self._running and self._desired == self._shown:
+                    self._cond.wait()
+                if self._desired == self._shown:
+                    return
+                desired = self._desired
+
+            for row, text in enumerate(desired):
+                shown = self._shown[row]
+                if shown is None:
+                    changed = list(range(self.COLS))
+                else:
+                    changed = [i for i in range(self.COLS) if text[i] != shown[i]]
+                if not changed:
+                    continue
+                first, last = changed[0], changed[-1]
+                try:
+                    self.lcd.cursor_pos = (row, first)
+                    self.lcd.write_string(text[first : last + 1])
+                except OSError as e:
+                    # a glitch on the I2C bus, the row is unknown now: rewrite it whole
+                    print(f"LCD write of row {row} failed: {e}")
+                    self._shown[row] = None
+                    continue
+                self._shown[row] = text
+                self.writes += 1
+
+            time.sleep(self.min_interval)
+
+    def lcd_running(self):
+        self.show('Running........')
         print("running<==================================================================")
-        self.lcd.cursor_pos = (1, 0)
-        
 
     def lcd_processing(self):
-        self.lcd.clear()
-        self.lcd.write_string('Processing........')
-        self.lcd.cursor_pos = (1, 0)
+        self.show_text('Processing........')
 
     def lcd_stop_runnung(self):
-        self.lcd.clear()
-        self.lcd.write_string('Waitting for start........')
-        self.lcd.cursor_pos = (1, 0)
+        self.show_text('Waitting for start........')
 
     def lcd_show_result(self, message):
         if isinstance(message, (int, float, np.float64)):
@@ -104,23 +177,22 @@ class Lcd :
         else:
             message_str = str(message)
 
-        self.lcd.write_string(f"Quality = {message_str}%")
-        self.lcd.cursor_pos = (1, 0)
+        self.show_row(1, f"Quality = {message_str}%")
 
     def lcd_show_log(self,log, message):
-
-        self.lcd.clear()
-
         if isinstance(message, (int, float, np.float64)):
             message_str = f"{message:.2f}"
         else:
             message_str = str(message)
 
-        self.lcd.write_string(f"Error {str(log)} : {message_str}%")
-        self.lcd.cursor_pos = (1, 0)
-
+        self.show_text(f"Error {str(log)} : {message_str}%")
 
     def close(self):
+        """Flush the pending text, then release the display"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout=2.0)
         self.lcd.close()
 
 class ServoController :
@@ -180,3 +252,41 @@ class Pilotlamp :
     def __del__(self):
         self.close()
 
+
+class BeamSensor :
+    """Beam-break sensor that wakes the factory loop when a board arrives
+
+    gpiozero calls the edge callback from its own thread, the edge is handed
+    to the event loop so ``wait`` can be awaited between boards.
+    """
+
+    def __init__(self, pin=SENSOR_PIN):
+        self.sensor = DigitalInputDevice(pin, pull_up=True, bounce_time=0.01)
+        self.triggers = 0
+        self.last_trigger = None
+        self._loop = None
+        self._event = None
+
+    def attach(self, loop):
+        self._loop = loop
+        self._event = asyncio.Event()
+        self.sensor.when_activated = self._on_edge
+
+    def _on_edge(self):
+        self.triggers += 1
+        self.last_trigger = time.monotonic()
+        print(f"Beam sensor triggered ({self.triggers})")
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout=None):
+        """True when a board broke the beam, False on timeout"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+    def close(self):
+        self.sensor.when_activated = None
+        self.sensor.close()
@@ -19,6 +19,7 @@ from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from datetime import datetime
 from typing import Optional
+import itertools
 import logging
 import time
 import uvicorn
@@ -31,128 +32,309 @@ from ..database.database import (
     create_pcb_image,
 )
 from ..database.model import ImagePCB, PCB, Result
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from sqlalchemy.orm import Session
 from ..database import database, model
 from . import pcb_detection
 import os
 from datetime import datetime
 
-from ..function.withRaspberrypi import Belt, Lcd, Pilotlamp, ServoController
+from ..function.withRaspberrypi import (
+    Belt,
+    BeamSensor,
+    Lcd,
+    Pilotlamp,
+    ServoController,
+)
+from ..function.artifacts import inspection_params, store_artifact
+from ..function.camera import camera_manager
+from ..function.detection_pcb import detect_boards, four_point_transform
+from ..function.tracker import PCBTracker
+from ..function.governor import governor
+from ..function.heatmap import heatmap_store, render_heatmap
+from ..function.image_store import image_store
+from ..function.persistence import persistence_queue
+from ..function.tracing import span, tracer
+from ..function.metrics import (
+    boards_inspected,
+    boards_passed,
+    boards_rejected,
+    frames_sent,
+    stage,
+)
+from ..function.frame_quality import BestFrameSelector, crop_quality
+from ..function.inspection import InspectionEngine, InspectionPool
+from ..function.conveyor import (
+    SERVO_LEAD_SECONDS,
+    BeltSpeedEstimator,
+    DiverterScheduler,
+    InspectionDeadlineStats,
+    diverter_eta,
+)
 
 
 UPLOAD_DIR = "./tmp"
+# A speculative crop is kept when it is at least this good as the best one
+CONFIRM_QUALITY_RATIO = 0.9
+# Frames grabbed after a beam-sensor edge in trigger mode
+TRIGGER_FRAMES = 5
+# Boards at or above this accuracy go straight through the diverter
+PASS_ACCURACY = 80
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
-def expand_contour(contour, percentage):
-    """Expand contour boundaries by given percentage"""
-    M = cv2.moments(contour)
-    if M["m00"] == 0:
-        return contour
-
-    cx = int(M["m10"] / M["m00"])
-    cy = int(M["m01"] / M["m00"])
-
-    expanded = []
-    for point in contour:
-        x, y = point[0]
-        dir_x = x - cx
-        dir_y = y - cy
-        new_x = cx + (1 + percentage) * dir_x
-        new_y = cy + (1 + percentage) * dir_y
-        expanded.append([[int(new_x), int(new_y)]])
-
-    return np.array(expanded, dtype=np.int32)
-
-
-def order_points(pts):
-    """Order 4 points as: top-left, top-right, bottom-right, bottom-left"""
-    rect = np.zeros((4, 2), dtype="float32")
-    s = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(s)]
-    rect[2] = pts[np.argmax(s)]
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]
-    rect[3] = pts[np.argmax(diff)]
-    return rect
-
-
-def four_point_transform(image, pts):
-    """Perform perspective transform using 4 points"""
-    (tl, tr, br, bl) = pts
-    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    maxWidth = max(int(widthA), int(widthB))
-
-    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    maxHeight = max(int(heightA), int(heightB))
-
-    dst = np.array(
-        [[0, 0], [maxWidth - 1, 0], [maxWidth - 1, maxHeight - 1], [0, maxHeight - 1]],
-        dtype="float32",
-    )
+inspection_engine = InspectionEngine()
+deadline_stats = InspectionDeadlineStats(inspection_engine)
 
-    M = cv2.getPerspectiveTransform(pts, dst)
-    warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
-    return warped
 
+def image_to_base64(image):
+    _, buffer = cv2.imencode(".jpg", image)
+    return base64.b64encode(buffer).decode("utf-8")
 
-class CameraManager:
-    def __init__(self):
-        self.camera: Optional[cv2.VideoCapture] = None
-        self.active_connections = 0
-        self.lock = asyncio.Lock()
-        self.frame_interval = 0.08
 
-    async def get_camera(self):
-        async with self.lock:
-            if self.camera is None or not self.camera.isOpened():
-                self.camera = cv2.VideoCapture(0)
-                if not self.camera.isOpened():
-                    logger.error("Failed to open camera")
-                    return None
+def decode_base64_image(base64_str):
+    return base64.b64decode(base64_str)
 
-                self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                self.camera.set(cv2.CAP_PROP_FPS, 10)
-                logger.info("Camera opened (640x480 @ 10FPS)")
-            return self.camera
 
-    async def release_camera(self):
-        async with self.lock:
-            if self.camera and self.camera.isOpened():
-                self.camera.release()
-                self.camera = None
-                logger.info("Camera released")
+def actuate_result(prepare_result, lcd, pilotlamp, servo):
+    """Show the verdict and move the diverter for one inspected board"""
+    with stage("actuation"):
+        _actuate_result(prepare_result, lcd, pilotlamp, servo)
+
+
+def reject_board(reason, lcd, pilotlamp, servo):
+    """Fail safe for a board without a usable verdict: divert it to reject"""
+    with stage("actuation"):
+        print(f"right (fail safe: {reason}) <===================================")
+        with span("servo", position="right", fail_safe=reason):
+            servo.right()
+        with span("pilotlamp"):
+            pilotlamp.error()
+        with span("lcd"):
+            lcd.show("REJECT", reason)
+
+
+def _actuate_result(prepare_result, lcd, pilotlamp, servo):
+    print("=====> ", prepare_result["accuracy"])
+    if prepare_result["accuracy"] >= PASS_ACCURACY:
+        with span("lcd"):
+            lcd.lcd_show_result(prepare_result["accuracy"])
+        print("mid <==================================")
+        with span("pilotlamp"):
+            pilotlamp.running()
+        with span("servo", position="mid"):
+            servo.mid()
+    else:
+        if prepare_result["accuracy"] >= 70:
+            with span("pilotlamp"):
+                pilotlamp.running()
+            print("left <===================================")
+            with span("servo", position="left"):
+                servo.left()
+        else:
+            print("right <===================================")
+            with span("servo", position="right"):
+                servo.right()
+            with span("pilotlamp"):
+                pilotlamp.error()
+        with span("lcd"):
+            lcd.lcd_show_log(prepare_result["result"], prepare_result["accuracy"])
+
+
+async def publish_result(websocket, pcb_id, board_id, inspected):
+    """Persist an actuated board behind the line, announce it once written"""
+    future = await persistence_queue.submit(persist_result, inspected, pcb_id, board_id)
+    try:
+        # shielded, a closing websocket must not cancel a queued write
+        prepare_result, results_id = await asyncio.shield(asyncio.wrap_future(future))
+    except Exception as e:
+        logger.error(f"Board #{board_id} was not saved: {str(e)}")
+        return None
+    print("=====> Database updated with PCB result")
+    boards_inspected.inc()
+    if prepare_result["accuracy"] >= PASS_ACCURACY:
+        boards_passed.inc()
+    else:
+        boards_rejected.inc()
+    with span("ws_new_result"):
+        await websocket.send_json(
+            {
+                "type": "new_result",
+                "message": "PCB result created",
+                "result_id": results_id,
+                "board_id": board_id,
+                "line_stats": deadline_stats.summary(),
+            }
+        )
+    return prepare_result
 
 
-camera_manager = CameraManager()
+def publish_in_background(tasks, websocket, pcb_id, board_id, inspected):
+    task = asyncio.create_task(publish_result(websocket, pcb_id, board_id, inspected))
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
 
 
-def image_preprocess(img):
-    img = cv2.GaussianBlur(img, (5, 5), 0)
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    return clahe.apply(img)
+async def inspect_on_the_fly(websocket, db, pcb_id, board_id, job, scheduler, actuators):
+    """Wait for a board's inspection job and time the diverter to it"""
+    try:
+        deadline = job.deadline
+        inspected = await asyncio.wrap_future(job.future)
+        # the run alone: a confirmed speculative job was submitted before
+        # the board travelled to the center, that wait is not inspection time
+        latency = job.run_seconds()
+        print(
+            f"=====> PCB analysis prepared, board #{board_id} in {latency:.2f}s"
+            f" at level {inspected['level']}"
+        )
 
+        delay = 0.0 if deadline is None else deadline - time.monotonic()
+        deadline_met = delay >= 0
+        deadline_stats.record(latency, deadline_met)
+        if not deadline_met:
+            logger.warning(
+                f"Board #{board_id} decided {-delay:.2f}s after the diverter deadline"
+            )
 
-def image_to_base64(image):
-    _, buffer = cv2.imencode(".jpg", image)
-    return base64.b64encode(buffer).decode("utf-8")
+        if inspected["detected"] and deadline_met:
+            actuation = scheduler.schedule(delay, actuate_result, inspected, *actuators)
+        else:
+            # never leave the diverter where the previous board put it
+            reason = "late verdict" if inspected["detected"] else "not inspected"
+            actuation = scheduler.schedule(0.0, reject_board, reason, *actuators)
+        await asyncio.wait({actuation})
+        if inspected["detected"]:
+            await publish_result(websocket, pcb_id, board_id, inspected)
+    except Exception as e:
+        logger.error(f"Inspection of board #{board_id} failed: {str(e)}")
 
 
-def decode_base64_image(base64_str):
-    return base64.b64decode(base64_str)
+async def send_frames(websocket, display_frame, pcb_frame):
+    """Send the preview and the board crop, scaled down by the governor"""
+    with stage("encode"):
+        _, display_buffer = cv2.imencode(".jpg", governor.preview(display_frame))
+        if pcb_frame is None:
+            pcb_frame = np.zeros((100, 100, 3), dtype=np.uint8)
+        _, pcb_buffer = cv2.imencode(".jpg", pcb_frame)
+
+    with stage("ws_send"):
+        await websocket.send_bytes(display_buffer.tobytes())
+        await websocket.send_bytes(pcb_buffer.tobytes())
+    frames_sent.inc()
+
+
+def fully_visible(bbox, width, height, margin=4):
+    x, y, w, h = bbox
+    return x > margin and y > margin and x + w < width - margin and y + h < height - margin
+
+
+def trace_board(board_id, frame_spans, **attrs):
+    """The board's trace, with the capture and detection of the current frame"""
+    trace = tracer.board(board_id)
+    for name, (start, end) in frame_spans.items():
+        trace.add(name, start, end, **attrs)
+    return trace
+
+
+def submit_inspection(pool, board_id, crop, original_bytes, deadline, quality=None):
+    if quality is None:
+        quality = crop_quality(crop)
+    _, buffer = cv2.imencode(".jpg", crop)
+    return pool.submit(
+        board_id, quality, deadline, inspect_pcb, original_bytes, buffer.tobytes()
+    )
+
+
+async def trigger_loop(
+    websocket, db, pcb_id, camera, original_bytes, sensor, pool, belt, actuators
+):
+    """Inspect one board per beam-sensor edge instead of watching every frame
+
+    Between boards the loop only waits on the sensor, the camera frames are
+    not decoded or processed at all.
+    """
+    board_ids = itertools.count(database.get_next_board_id(db))
+    publishing = set()
+    sensor.attach(asyncio.get_running_loop())
+
+    while True:
+        if not await sensor.wait(timeout=1.0):
+            continue
+
+        board_id = next(board_ids)
+        with tracer.activate(tracer.board(board_id)):
+            camera.wake("trigger")
+            with span("belt", command="off"):
+                belt.off()
+            print(f"=====> Sensor triggered, board #{board_id}")
+
+            selector = BestFrameSelector(max_frames=TRIGGER_FRAMES)
+            display_frame = None
+            for _ in range(TRIGGER_FRAMES):
+                with span("frame_capture"):
+                    ret, frame = await camera.next_frame()
+                if not ret:
+                    logger.error("Frame read failed")
+                    break
+                with span("center_detection"):
+                    boards = [
+                        board for board in detect_boards(frame) if board["quad"] is not None
+                    ]
+                if not boards:
+                    continue
+                display_frame = frame
+                crop = four_point_transform(frame, boards[0]["quad"])
+                if selector.add(crop, boards[0]["quad"]):
+                    break
+
+            if selector.best_crop is None:
+                logger.warning(f"Board #{board_id} broke the beam but was not found")
+                await asyncio.to_thread(reject_board, "not found", *actuators)
+                belt.on()
+                continue
+
+            await send_frames(websocket, display_frame, selector.best_crop)
+
+            job = submit_inspection(pool, board_id, selector.best_crop, original_bytes, None)
+            inspected = await asyncio.wrap_future(job.future)
+            pool.jobs.pop(board_id, None)
+            print("=====> PCB analysis prepared")
+            if inspected["detected"]:
+                await asyncio.to_thread(actuate_result, inspected, *actuators)
+                publish_in_background(publishing, websocket, pcb_id, board_id, inspected)
+            else:
+                # never leave the diverter where the previous board put it
+                await asyncio.to_thread(reject_board, "not inspected", *actuators)
+            with span("belt", command="on"):
+                belt.on()
+
+
+@router.get("/line_stats")
+async def get_line_stats():
+    return JSONResponse(
+        status_code=200,
+        content={"status": "success", "line_stats": deadline_stats.summary()},
+    )
 
 
 @router.websocket("/ws/factory-workflow")
 async def websocket_endpoint(
-    websocket: WebSocket, pcb_id: int = Query(...), db: Session = Depends(model.get_db)
+    websocket: WebSocket,
+    pcb_id: int = Query(...),
+    mode: str = Query("stop"),
+    db: Session = Depends(model.get_db),
 ):
+    """Factory line loop
+
+    mode="stop" halts the belt under the camera for every board,
+    mode="continuous" keeps the belt running, inspects in the background and
+    schedules the diverter from the measured belt speed,
+    mode="trigger" waits for the beam sensor and only then grabs frames.
+    """
     await websocket.accept()
     camera_manager.active_connections += 1
     logger.info(f"New connection. Total: {camera_manager.active_connections}")
@@ -161,6 +343,11 @@ async def websocket_endpoint(
     lcd = None
     waitting = False
     pilotlamp = None
+    sensor = None
+    continuous = mode == "continuous"
+    scheduler = DiverterScheduler()
+    pool = InspectionPool()
+    inspections = set()
     try:
         lcd = Lcd()
         lcd.lcd_running()
@@ -189,161 +376,215 @@ async def websocket_endpoint(
         # template_np = np.frombuffer(decoded_bytes, np.uint8)
         # template_image = cv2.imdecode(template_np, cv2.IMREAD_COLOR)
 
-        center_line_start_time = None
-        center_line_detected = False
-        cooldown_seconds = 0.4
+        if mode == "trigger":
+            sensor = BeamSensor()
+            await trigger_loop(
+                websocket,
+                db,
+                pcb_id,
+                camera,
+                original_base64,
+                sensor,
+                pool,
+                belt,
+                (lcd, pilotlamp, servo),
+            )
+            return
+
+        tracker = PCBTracker(start_id=database.get_next_board_id(db))
+        belt_speed = BeltSpeedEstimator()
+        selectors = {}
+        frame_indexes = itertools.count()
+
+        def deadline_for(track):
+            if not continuous:
+                return None
+            eta = diverter_eta(track, center_x, belt_speed.speed, belt_speed.direction)
+            if eta is None:
+                return None
+            return time.monotonic() + eta - SERVO_LEAD_SECONDS
 
         while True:
-            ret, frame = camera.read()
+            capture_started = time.perf_counter()
+            ret, frame = await camera.next_frame()
+            capture_ended = time.perf_counter()
             if not ret:
                 logger.error("Frame read failed")
                 break
 
-            # PCB detection
-            hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-            lower_copper = np.array([5, 30, 5])
-            upper_copper = np.array([45, 255, 255])
-
-            mask = cv2.inRange(hsv, lower_copper, upper_copper)
-
-            kernel = np.ones((5, 5), np.uint8)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+            # under load, skip detection on some frames while the line is empty
+            busy = bool(tracker.tracks or selectors or pool.jobs)
+            if not governor.should_detect(next(frame_indexes), busy):
+                await send_frames(websocket, frame, None)
+                await asyncio.sleep(governor.frame_interval(camera_manager.frame_interval))
+                continue
 
-            contours, _ = cv2.findContours(
-                mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-            )
+            # PCB detection
+            boards = detect_boards(frame)
+            frame_spans = {
+                "frame_capture": (capture_started, capture_ended),
+                "center_detection": (capture_ended, time.perf_counter()),
+            }
+            if boards:
+                camera.wake("detection")
+            tracks = tracker.update(boards)
+            belt_speed.update(tracks)
+            deadline_stats.belt_speed_mm_s = belt_speed.speed_mm_s()
 
             display_frame = frame.copy()
             pcb_frame = None
-            center_line_detected = False
 
             height, width = frame.shape[:2]
             center_x = width // 2
             cv2.line(display_frame, (center_x, 0), (center_x, height), (0, 0, 255), 2)
 
-            if contours:
-             largest_contour = max(contours, key=cv2.contourArea)
-             expanded_contour = expand_contour(largest_contour, 0.05)
-             hull = cv2.convexHull(expanded_contour)
-
-                # Draw green contour around PCB
-             area = cv2.contourArea(hull)
-             min_area_threshold = 5000
-             if area >= min_area_threshold:
+            centered_track = None
+            for track in tracks:
+                hull = track.detection["hull"]
                 cv2.drawContours(display_frame, [hull], -1, (0, 255, 0), 3)
-
-                epsilon = 0.02 * cv2.arcLength(hull, True)
-                approx = cv2.approxPolyDP(hull, epsilon, True)
-
-                if len(approx) == 4:
-                    approx = order_points(approx.reshape(4, 2))
-                    pcb_frame = four_point_transform(frame, approx)
-
-                    x, y, w, h = cv2.boundingRect(hull)
-                    if area >= min_area_threshold and x < center_x < x + w:
-                      if center_line_start_time is None:
-                            center_line_start_time = time.time()
-                      elapsed = time.time() - center_line_start_time
-                      if not center_line_detected:
-                            center_line_detected = True
-                            cv2.putText(
-                                display_frame,
-                                "CENTERED",
-                                (center_x - 50, 30),
-                                cv2.FONT_HERSHEY_SIMPLEX,
-                                0.7,
-                                (0, 0, 255),
-                                2,
-                            )
-                      
-                      if waitting is False:
-                        # print(elapsed,"time =============<")
+                x, y, _, _ = track.bbox
+                cv2.putText(
+                    display_frame,
+                    f"#{track.board_id}",
+                    (x, max(y - 10, 20)),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.7,
+                    (0, 255, 0),
+                    2,
+                )
+
+                if track.quad is None:
+                    continue
+
+                # speculative job on the first frame showing the whole board,
+                # it hides the inspection behind the travel to the center
+                if (
+                    not track.inspected
+                    and track.board_id not in pool.jobs
+                    and fully_visible(track.bbox, width, height)
+                ):
+                    trace = trace_board(track.board_id, frame_spans, phase="speculative")
+                    with tracer.activate(trace):
+                        crop = four_point_transform(frame, track.quad)
+                        submit_inspection(
+                            pool, track.board_id, crop, original_base64, deadline_for(track)
+                        )
+
+                if not track.spans_x(center_x):
+                    continue
+
+                if centered_track is None or (
+                    abs(track.centroid[0] - center_x)
+                    < abs(centered_track.centroid[0] - center_x)
+                ):
+                    centered_track = track
+
+            if centered_track is not None:
+                pcb_frame = four_point_transform(frame, centered_track.quad)
+                cv2.putText(
+                    display_frame,
+                    "CENTERED",
+                    (center_x - 50, 30),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.7,
+                    (0, 0, 255),
+                    2,
+                )
+
+            board_id = centered_track.board_id if centered_track else None
+            inspect_id = None
+            if centered_track is not None and not centered_track.inspected:
+                if waitting is False:
+                    if not continuous:
                         belt.off()
-                        if elapsed >= cooldown_seconds:
-
-                            print("=====> Center line detected")
-
-                            await asyncio.sleep(0.5)
-                            if pcb_frame is not None:
-                                print("=====> Belt off")
-                                
-                                
-                                _, buffer = cv2.imencode(".jpg", pcb_frame)
-                                image_data = buffer.tobytes()
-                                #######################################################
-                                prepare_result = await analysis_pcb_prepare(
-                                    original_base64, image_data
-                                )
-                                print("=====> PCB analysis prepared")
-                                if prepare_result["detected"]:
-                                    print(prepare_result["detected"])
-                                    push_to_database = await database.create_pcb_result(
-                                        db=db,
-                                        prepare_result=prepare_result,
-                                        pcb_id=pcb_id,
-                                    )
-                                    print("===========================================>",prepare_result["accuracy"])
-                                    print("=====> Database updated with PCB result")
-                                    if push_to_database:
-                                        await websocket.send_json(
-                                            {
-                                                "type": "new_result",
-                                                "message": "PCB result created",
-                                                "result_id": push_to_database.results_id,
-                                            }
-                                        )
-                                    center_line_start_time = None
-                                    center_line_detected = False
-
-                                    # await asyncio.sleep(2)
-                                    print("=====> ",prepare_result["accuracy"])
-                                    belt.test_log(prepare_result["accuracy"])
-                                    if prepare_result["accuracy"] >= 80 :
-                                        lcd.lcd_show_result(prepare_result["accuracy"])
-                                        print("mid <==================================")
-                                        pilotlamp.running()
-                                        servo.mid()
-                                        belt.run_for(2)
-                                    else:
-                                        if prepare_result["accuracy"] >= 70 :
-                                            pilotlamp.running()
-                                            print("left <===================================")
-                                            servo.left()
-                                        else :
-                                            print("right <===================================")
-                                            servo.right()
-                                            pilotlamp.error()
-                                        # pilotlamp.error()
-                                        # belt.Waitting()
-                                        lcd.lcd_show_log(prepare_result["result"], prepare_result["accuracy"])
-                                        # waitting = True
-                                        print("=====> Waitting for start")
-                                        belt.run_for(2)
-                                    # belt.on()
-                                    # await asyncio.sleep(2)
-
+                    selector = selectors.setdefault(board_id, BestFrameSelector())
+                    if selector.add(pcb_frame, centered_track.quad):
+                        inspect_id = board_id
+
+            if inspect_id is None:
+                # a board that left the window before its score settled is
+                # inspected with the best crop it got
+                for selector_id in selectors:
+                    track = tracker.tracks.get(selector_id)
+                    if track is None or not track.spans_x(center_x):
+                        inspect_id = selector_id
+                        break
+
+            for job_id in list(pool.jobs):
+                if job_id not in tracker.tracks and job_id not in selectors:
+                    pool.cancel(job_id)
+
+            if inspect_id is not None:
+                print(f"=====> Center line detected, board #{inspect_id}")
+                selector = selectors.pop(inspect_id)
+                track = tracker.tracks.get(inspect_id)
+                if track is not None:
+                    track.inspected = True
+
+                trace = trace_board(inspect_id, frame_spans, phase="inspect")
+                with tracer.activate(trace):
+                    # confirm the speculative job or replace it with the best crop
+                    job = pool.jobs.get(inspect_id)
+                    best_quality = crop_quality(selector.best_crop)
+                    if job is None or job.quality < best_quality * CONFIRM_QUALITY_RATIO:
+                        job = submit_inspection(
+                            pool,
+                            inspect_id,
+                            selector.best_crop,
+                            original_base64,
+                            deadline_for(track) if track is not None else None,
+                            quality=best_quality,
+                        )
+                        print(f"=====> Speculative job replaced, board #{inspect_id}")
+                    pool.jobs.pop(inspect_id)
+
+                    if continuous:
+                        task = asyncio.create_task(
+                            inspect_on_the_fly(
+                                websocket,
+                                db,
+                                pcb_id,
+                                inspect_id,
+                                job,
+                                scheduler,
+                                (lcd, pilotlamp, servo),
+                            )
+                        )
+                        inspections.add(task)
+                        task.add_done_callback(inspections.discard)
                     else:
-                        if waitting is True:
-                            belt.Stop_Waitting()
-                            lcd.lcd_running()
-                            pilotlamp.running()
-                            waitting = False
-                        center_line_start_time = None
-                        center_line_detected = False
-
-            _, display_buffer = cv2.imencode(".jpg", display_frame)
-            await websocket.send_bytes(display_buffer.tobytes())
-
-            if pcb_frame is not None:
-                _, pcb_buffer = cv2.imencode(".jpg", pcb_frame)
-                await websocket.send_bytes(pcb_buffer.tobytes())
-            else:
-                empty_frame = np.zeros((100, 100, 3), dtype=np.uint8)
-                _, empty_buffer = cv2.imencode(".jpg", empty_frame)
-                await websocket.send_bytes(empty_buffer.tobytes())
+                        inspected = await asyncio.wrap_future(job.future)
+                        print("=====> PCB analysis prepared")
+                        if inspected["detected"]:
+                            belt.test_log(inspected["accuracy"])
+                            # the servo detach and the belt run sleep, off the loop
+                            await asyncio.to_thread(
+                                actuate_result, inspected, lcd, pilotlamp, servo
+                            )
+                            publish_in_background(
+                                inspections, websocket, pcb_id, inspect_id, inspected
+                            )
+                            with span("belt", command="run_for"):
+                                await asyncio.to_thread(belt.run_for, 2)
+                        else:
+                            # never leave the diverter where the previous board put it
+                            await asyncio.to_thread(
+                                reject_board, "not inspected", lcd, pilotlamp, servo
+                            )
+
+            elif centered_track is None or centered_track.inspected:
+                if waitting is True:
+                    belt.Stop_Waitting()
+                    lcd.lcd_running()
+                    pilotlamp.running()
+                    waitting = False
+                elif not belt.is_on():
+                    # each board is inspected once, a board without a result
+                    # would otherwise hold the stopped belt forever
+                    belt.on()
 
-            await asyncio.sleep(camera_manager.frame_interval)
+            await send_frames(websocket, display_frame, pcb_frame)
+            await asyncio.sleep(governor.frame_interval(camera_manager.frame_interval))
 
     except Exception as e:
         if belt:
@@ -353,6 +594,13 @@ async def websocket_endpoint(
             lcd.lcd_stop_runnung()
         logger.error(f"WebSocket error: {str(e)}")
     finally:
+        for task in list(inspections):
+            task.cancel()
+        scheduler.cancel_all()
+        pool.shutdown()
+        if sensor:
+            sensor.close()
+
         camera_manager.active_connections -= 1
         logger.info(f"Connection closed. Total: {camera_manager.active_connections}")
 
@@ -364,6 +612,7 @@ async def websocket_endpoint(
             belt.close()
         if lcd:
             lcd.lcd_stop_runnung()
+            lcd.close()
 
         await websocket.close()
 
@@ -419,14 +668,8 @@ async def get_images(db: Session = Depends(model.get_db), pcb_id: int = 1):
 
 
 def save_image_bytes(image_bytes: bytes, filename: str) -> str:
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    save_dir = os.path.join(BASE_DIR, "../..", "database.db", "tmp")
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
-    save_path = os.path.join(save_dir, filename)
-    with open(save_path, "wb") as f:
-        f.write(image_bytes)
-    return save_path
+    """Path of the content-addressed blob holding the bytes, written once"""
+    return image_store.put(image_bytes, os.path.splitext(filename)[1] or ".jpg")
 
 
 @router.post("/create_pcb")
@@ -437,20 +680,27 @@ async def create_pcb(
     file_path = os.path.join(UPLOAD_DIR, file.filename)
     image_bytes = await file.read()
 
-    file_path = save_image_bytes(image_bytes, file.filename)
     if not file.filename.lower().endswith((".jpg", ".jpeg", ".png")):
         raise HTTPException(
             status_code=400,
             detail="Invalid file type. Only JPG, JPEG, and PNG are allowed.",
         )
 
-    result = await database.upload_and_create_pcb(
-        db=db, filename=file.filename, filepath=file_path
-    )
+    # blob_lock is a thread lock held across encodes and fsyncs, never
+    # taken on the event loop
+    result = await asyncio.to_thread(store_pcb_template, db, file.filename, image_bytes)
 
     return {"status": "success", "result": result}
 
 
+def store_pcb_template(db: Session, filename: str, image_bytes: bytes):
+    """Blocking body of create_pcb: the template blob, then its rows"""
+    # the blob is referenced before a concurrent delete may remove it
+    with database.blob_lock:
+        file_path = save_image_bytes(image_bytes, filename)
+        return database.insert_pcb(db, filename, file_path)
+
+
 @router.post("/create_pcb_image")
 async def create_pcb_image(
     pcb_id: int = Form(...),
@@ -461,12 +711,33 @@ async def create_pcb_image(
     return result
 
 
-def generate_filename(name: str) -> str:
-    timestamp = time.strftime("%Y%m%d_%H%M%S")
-    return f"{name}_{timestamp}.jpg"
+def generate_filename(name: str, ext: str = ".jpg") -> str:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    return f"{name}_{timestamp}{ext}"
 
 
 async def analysis_pcb_prepare(original_bytes: bytes, image_bytes: bytes):
+    return prepare_pcb_result(original_bytes, image_bytes)
+
+
+def prepare_pcb_result(
+    original_bytes: bytes, image_bytes: bytes, deadline=None, cancel_event=None
+):
+    """Inspect a captured board and save its artifacts"""
+    return save_pcb_artifacts(
+        inspect_pcb(original_bytes, image_bytes, deadline, cancel_event)
+    )
+
+
+def inspect_pcb(
+    original_bytes: bytes, image_bytes: bytes, deadline=None, cancel_event=None
+):
+    """Compare a captured board against the template, nothing is written
+
+    ``deadline`` is a time.monotonic() timestamp, the engine then picks the
+    best inspection level that still fits (see InspectionEngine). A set
+    ``cancel_event`` abandons the job at the next level boundary.
+    """
     try:
         template_np = np.frombuffer(original_bytes, np.uint8)
         template_img = cv2.imdecode(template_np, cv2.IMREAD_COLOR)
@@ -479,169 +750,113 @@ async def analysis_pcb_prepare(original_bytes: bytes, image_bytes: bytes):
         if defective_img is None:
             raise ValueError("Defective image decoding failed")
 
-        template_gray = cv2.cvtColor(template_img, cv2.COLOR_BGR2GRAY)
-        defective_gray = cv2.cvtColor(defective_img, cv2.COLOR_BGR2GRAY)
-
-        min_height = min(template_gray.shape[0], defective_gray.shape[0])
-        min_width = min(template_gray.shape[1], defective_gray.shape[1])
-        template_gray = cv2.resize(template_gray, (min_width, min_height))
-        defective_gray = cv2.resize(defective_gray, (min_width, min_height))
-
-        # === CLAHE for lighting compensation ===
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        template = clahe.apply(template_gray)
-        defective = clahe.apply(defective_gray)
-
-        # === Adaptive Threshold instead of Otsu ===
-        template = cv2.adaptiveThreshold(
-            template, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 15, 2
-        )
-        defective = cv2.adaptiveThreshold(
-            defective, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 15, 2
-        )
-
-        original_template = template.copy()
-        original_defective = defective.copy()
-
-        template_proc = image_preprocess(template)
-        defective_proc = image_preprocess(defective)
-
-        orb = cv2.ORB_create(
-            nfeatures=20000, scaleFactor=1.2, nlevels=8, edgeThreshold=15, patchSize=31
-        )
-        kp1, des1 = orb.detectAndCompute(template_proc, None)
-        kp2, des2 = orb.detectAndCompute(defective_proc, None)
-
-        if des1 is None or des2 is None or len(des1) < 2 or len(des2) < 2:
-            return {
-                "detected": False,
-                "message": "Not enough features for matching",
-            }
-
-        FLANN_INDEX_LSH = 6
-        index_params = dict(
-            algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1
-        )
-        search_params = dict(checks=50)
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-
-        matches = flann.knnMatch(des1, des2, k=2)
-
-        good_matches = []
-        for m_n in matches:
-            if len(m_n) == 2:
-                m, n = m_n
-                if m.distance < 0.7 * n.distance:
-                    good_matches.append(m)
-
-        if len(good_matches) < 1:
-            return {
-                "detected": False,
-                "message": "Not enough good matches for alignment",
-            }
-
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good_matches]).reshape(
-            -1, 1, 2
-        )
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good_matches]).reshape(
-            -1, 1, 2
-        )
-
-        H, _ = cv2.findHomography(dst_pts, src_pts, cv2.RANSAC, 5.0)
-        aligned = cv2.warpPerspective(
-            defective, H, (template.shape[1], template.shape[0])
-        )
-
-        # === Blur before diff to reduce lighting noise ===
-        template_blur = cv2.GaussianBlur(template, (3, 3), 0)
-        aligned_blur = cv2.GaussianBlur(aligned, (3, 3), 0)
-
-        diff = cv2.absdiff(template_blur, aligned_blur)
-
-        # Specific gray mask for defect highlight
-        mask = cv2.inRange(diff, 50, 225)
-        specific_gray = cv2.bitwise_and(diff, diff, mask=mask)
+        with span("inspection") as inspection_span:
+            inspected = inspection_engine.run(
+                template_img, defective_img, deadline, cancel_event
+            )
+            inspection_span.set(level=inspected["level"], late=inspected["late"])
+        # the encoded crop is all a "minimal" result keeps of the board
+        inspected["capture"] = image_bytes
+        return inspected
 
-        # Thresholding combination
-        _, thresh_otsu = cv2.threshold(
-            diff, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU
-        )
-        thresh_range = cv2.inRange(diff, 100, 255)
-        combined_thresh = cv2.bitwise_or(thresh_otsu, thresh_range)
+    except Exception as e:
+        logger.error(f"Error processing images: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Morphology
-        kernel = np.ones((3, 3), np.uint8)
-        cleaned = cv2.morphologyEx(
-            combined_thresh, cv2.MORPH_OPEN, kernel, iterations=1
-        )
-        cleaned = cv2.morphologyEx(cleaned, cv2.MORPH_CLOSE, kernel, iterations=2)
 
-        contours, _ = cv2.findContours(
-            cleaned, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-        )
+def save_pcb_artifacts(inspected: dict, artifact_level="full", template_image=None):
+    """Write the artifact images of an inspection and build the result dict
 
-        mask_diff = np.zeros_like(cleaned)
-        cv2.drawContours(mask_diff, contours, -1, (255), thickness=cv2.FILLED)
-        result = cv2.bitwise_and(aligned, aligned, mask=mask_diff)
-
-        white_pixels = np.sum(result == 0)
-        total_pixels = result.shape[0] * result.shape[1]
-        accuracy_percentage = (white_pixels / total_pixels) * 100
-
-        accuracy_result = ""
-        if accuracy_percentage <= 80:
-            accuracy_result = "The PCB picture does not match or is incorrect."
-        elif accuracy_percentage <= 97:
-            accuracy_result = "The PCB picture has many errors."
-        elif accuracy_percentage > 97:
-            accuracy_result = "The PCB picture has some errors."
-
-        image_map = {
-            "template": template,
-            "defective": defective,
-            "aligned": aligned,
-            "diff": diff,
-            "cleaned": specific_gray,
-            "result": result,
+    ``artifact_level`` picks what is written (see ARTIFACT_LEVELS), the
+    homography and parameters are kept in every case so a "minimal" result
+    can be regenerated from its capture and ``template_image``.
+    """
+    if not inspected["detected"]:
+        return {
+            "detected": False,
+            "message": inspected["message"],
+            "level": inspected["level"],
+            "late": inspected["late"],
         }
 
+    try:
         images = {}
-        for name, gray_image in image_map.items():
-            bgr_image = cv2.cvtColor(gray_image, cv2.COLOR_GRAY2BGR)
-            filename = generate_filename(name)
-            filepath = save_image_bytes(
-                cv2.imencode(".jpg", bgr_image)[1].tobytes(), filename
-            )
-            images[name] = {
-                "filename": filename,
-                "filepath": filepath,
-            }
+        with stage("artifact_write"):
+            if artifact_level == "full":
+                artifacts = {
+                    name: store_artifact(name, gray_image)
+                    for name, gray_image in inspected["images"].items()
+                }
+            elif artifact_level == "minimal":
+                artifacts = {"capture": (inspected["capture"], ".jpg")}
+            else:
+                artifacts = {}
+            for name, (image_bytes, ext) in artifacts.items():
+                filename = generate_filename(name, ext)
+                filepath = save_image_bytes(image_bytes, filename)
+                images[name] = {
+                    "filename": filename,
+                    "filepath": filepath,
+                }
 
         return {
             "detected": True,
-            "message": "PCB analysis completed successfully",
-            "accuracy": accuracy_percentage,
-            "result": accuracy_result,
+            "message": inspected["message"],
+            "accuracy": inspected["accuracy"],
+            "result": inspected["result"],
+            "level": inspected["level"],
+            "confidence": inspected["confidence"],
+            "late": inspected["late"],
+            "defects": inspected["defects"],
             "images": images,
+            "artifact_level": artifact_level,
+            "params": inspection_params(inspected, template_image),
         }
 
     except Exception as e:
-        logger.error(f"Error processing images: {str(e)}", exc_info=True)
+        logger.error(f"Error saving images: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def persist_result(inspected: dict, pcb_id: int, board_id: int):
+    """Persistence worker job: the artifact files, then the result rows"""
+    db = model.SessionLocal()
+    try:
+        template_image = (
+            db.query(model.PCB.originalPcb).filter(model.PCB.id == pcb_id).scalar()
+        )
+        artifact_level = database.get_artifact_level(db, pcb_id)
+        # from the first blob put to the commit, see database.blob_lock
+        with database.blob_lock:
+            prepare_result = save_pcb_artifacts(inspected, artifact_level, template_image)
+            db_result = database.insert_pcb_result(db, prepare_result, pcb_id, board_id)
+        if inspected["detected"]:
+            # the board is saved, a heatmap failure must not report otherwise
+            try:
+                heatmap_store.add(pcb_id, inspected["mask"], inspected["template_shape"])
+            except Exception as e:
+                logger.error(
+                    f"Heatmap update of board #{board_id} failed: {str(e)}", exc_info=True
+                )
+        return prepare_result, db_result.results_id
+    finally:
+        db.close()
+
+
 @router.get("/get_result_pcb/{pcb_id}")
 async def get_result_pcb(
     pcb_id: int,
     db: Session = Depends(model.get_db),
 ):
-    result = database.get_pcb_result(db=db, pcb_id=pcb_id)
+    # a "minimal" result is regenerated, off the event loop
+    result = await asyncio.to_thread(database.get_pcb_result, db, pcb_id)
     return JSONResponse(
         status_code=200,
         content={
             "status": "success",
             "results_id": result["results_id"],
             "pcb_result_id": result["pcb_result_id"],
+            "board_id": result["board_id"],
             "accuracy": result["accuracy"],
             "description": result["description"],
             "imageList": result["imageList"],
@@ -665,13 +880,30 @@ async def get_result_pcb_working(
     )
 
 
+@router.post("/set_artifact_level/{pcb_id}")
+async def set_artifact_level(
+    pcb_id: int,
+    level: str = Query(...),
+    db: Session = Depends(model.get_db),
+):
+    """What is stored per board of this product: none, minimal or full"""
+    try:
+        pcb = database.set_artifact_level(db=db, pcb_id=pcb_id, level=level)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if pcb is None:
+        raise HTTPException(status_code=404, detail="PCB not found")
+    return {"status": "success", "pcb_id": pcb_id, "artifact_level": level}
+
+
 @router.delete("/delete_pcb/{pcb_id}")
 async def delete_pcb(
     pcb_id: int,
     db: Session = Depends(model.get_db),
 ):
     try:
-        database.delete_pcb(db=db, pcb_id=pcb_id)
+        # remove_blobs takes database.blob_lock, off the event loop
+        await asyncio.to_thread(database.delete_pcb, db, pcb_id)
         return JSONResponse(
             status_code=200,
             content={
@@ -690,7 +922,7 @@ async def get_result(
     result_id: int,
     db: Session = Depends(model.get_db),
 ):
-    result = database.get_result(db=db, result_id=result_id)
+    result = await asyncio.to_thread(database.get_result, db, result_id)
     return JSONResponse(
         status_code=200,
         content={
@@ -701,6 +933,76 @@ async def get_result(
     )
 
 
+@router.get("/get_result_image/{result_id}/{name}")
+async def get_result_image(
+    result_id: int,
+    name: str,
+    db: Session = Depends(model.get_db),
+):
+    """JPEG of one artifact, what list views link to instead of regenerating"""
+    image_bytes = await asyncio.to_thread(database.result_image, db, result_id, name)
+    if image_bytes is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(content=image_bytes, media_type="image/jpeg")
+
+
+@router.get("/get_result_defects/{result_id}")
+async def get_result_defects(
+    result_id: int,
+    db: Session = Depends(model.get_db),
+):
+    """Defect area and bounding box of the result masks, from their RLE"""
+    stats = await asyncio.to_thread(database.result_mask_stats, db, result_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    return {"status": "success", "result_id": result_id, "masks": stats}
+
+
+@router.get("/get_defects/{pcb_id}")
+async def get_defects(
+    pcb_id: int,
+    x0: Optional[float] = None,
+    y0: Optional[float] = None,
+    x1: Optional[float] = None,
+    y1: Optional[float] = None,
+    result_id: Optional[int] = None,
+    db: Session = Depends(model.get_db),
+):
+    """Defects of a product intersecting the region x0,y0 - x1,y1 (template pixels)"""
+    region = (x0, y0, x1, y1)
+    if any(v is None for v in region):
+        if any(v is not None for v in region):
+            raise HTTPException(status_code=400, detail="Give all of x0, y0, x1, y1 or none")
+        region = None
+    defects = database.query_defects(db=db, pcb_id=pcb_id, region=region, result_id=result_id)
+    return {"status": "success", "pcb_id": pcb_id, "count": len(defects), "defects": defects}
+
+
+@router.get("/get_heatmap/{pcb_id}")
+async def get_heatmap(
+    pcb_id: int,
+    max_size: Optional[int] = Query(256, ge=1),
+    format: str = Query("json", pattern="^(json|image)$"),
+):
+    """Per pixel count of defective boards of a product, at most max_size wide
+
+    ``format=image`` returns a colour-mapped JPEG instead of the counts.
+    """
+    counts, boards = await asyncio.to_thread(heatmap_store.get, pcb_id, max_size)
+    if counts is None:
+        raise HTTPException(status_code=404, detail="No heatmap for this PCB")
+    if format == "image":
+        return Response(content=render_heatmap(counts), media_type="image/jpeg")
+    return {
+        "status": "success",
+        "pcb_id": pcb_id,
+        "boards": boards,
+        "size": list(counts.shape),
+        "max_count": round(float(counts.max()), 3),
+        "heatmap": np.round(counts, 3).tolist(),
+    }
+
+
 @router.get("/get_all_pcb_results")
 async def get_all_pcb_results(
     db: Session = Depends(model.get_db),
@@ -722,7 +1024,7 @@ async def delete_result(
     db: Session = Depends(model.get_db),
 ):
     try:
-        database.delete_result(db=db, result_id=result_id)
+        await asyncio.to_thread(database.delete_result, db, result_id)
         return JSONResponse(
             status_code=200,
             content={
@@ -20,6 +20,8 @@ from typing import Optional
 import logging
 import base64
 
+from ..function.camera import camera_manager
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -81,38 +83,6 @@ def four_point_transform(image, pts):
     return warped
 
 
-class CameraManager:
-    def __init__(self):
-        self.camera: Optional[cv2.VideoCapture] = None
-        self.active_connections = 0
-        self.lock = asyncio.Lock()
-        self.frame_interval = 0.08
-
-    async def get_camera(self):
-        async with self.lock:
-            if self.camera is None or not self.camera.isOpened():
-                self.camera = cv2.VideoCapture(0)
-                if not self.camera.isOpened():
-                    logger.error("Failed to open camera")
-                    return None
-                # Optimize for Raspberry Pi
-                self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                self.camera.set(cv2.CAP_PROP_FPS, 10)
-                logger.info("Camera opened (640x480 @ 10FPS)")
-            return self.camera
-
-    async def release_camera(self):
-        async with self.lock:
-            if self.camera and self.camera.isOpened():
-                self.camera.release()
-                self.camera = None
-                logger.info("Camera released")
-
-
-camera_manager = CameraManager()
-
-
 def image_preprocess(img):
     img = cv2.GaussianBlur(img, (5, 5), 0)
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
@@ -0,0 +1,81 @@
+import asyncio
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from ..function.camera import camera_manager
+from ..function.governor import governor
+from ..function.image_store import image_store
+from ..function.loop_monitor import loop_monitor
+from ..function.memory import memory_tracker
+from ..function.persistence import persistence_queue
+from ..function.profiler import ProfilerBusy, profiler, to_collapsed, to_speedscope
+from ..function.tracing import tracer
+
+router = APIRouter()
+
+
+@router.get("/camera")
+async def get_camera_status():
+    return camera_manager.stats()
+
+
+@router.get("/governor")
+async def get_governor_status():
+    return governor.summary()
+
+
+@router.get("/persistence")
+async def get_persistence_status():
+    return persistence_queue.stats()
+
+
+@router.get("/image_store")
+async def get_image_store_status():
+    return await asyncio.to_thread(image_store.stats)
+
+
+@router.get("/traces")
+async def get_traces(limit: int = 20, format: str = "json"):
+    """Most recent board traces, format="chrome" for chrome://tracing"""
+    if format == "chrome":
+        return tracer.chrome(limit)
+    return tracer.recent(limit)
+
+
+@router.get("/loop")
+async def get_loop_offenders(limit: int = 10, reset: bool = False):
+    """Stacks that blocked the event loop the longest"""
+    report = loop_monitor.report(limit)
+    if reset:
+        loop_monitor.reset()
+    return report
+
+
+@router.get("/profile")
+async def get_profile(seconds: float = 10.0, interval_ms: float = 5.0, format: str = "collapsed"):
+    """Sample every thread for a while, format="speedscope" for speedscope.app"""
+    try:
+        samples, duration, interval = await asyncio.to_thread(
+            profiler.profile, seconds, interval_ms / 1000.0
+        )
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "speedscope":
+        return to_speedscope(samples, duration, interval)
+    return PlainTextResponse(to_collapsed(samples))
+
+
+@router.get("/memory")
+async def get_stage_memory(enable: Optional[bool] = None, reset: bool = False):
+    """Peak bytes per stage, enable=true turns tracemalloc tracking on"""
+    if enable is True:
+        memory_tracker.enable()
+    elif enable is False:
+        memory_tracker.disable()
+    report = memory_tracker.report()
+    report["over_budget"] = memory_tracker.over_budget()
+    if reset:
+        memory_tracker.reset()
+    return report
@@ -2,22 +2,22 @@ from fastapi import FastAPI, File, UploadFile, APIRouter
 from fastapi.responses import FileResponse
 import os
 from random import randint
-import uuid
+
+from ..function.image_store import ImageStore
 
 IMAGEDIR = "../images/"
 
 router = APIRouter()
+# uploads are named by their sha256, the same picture is stored once
+upload_store = ImageStore(IMAGEDIR)
 
 
 @router.post("/upload/")
 async def create_upload_file(file: UploadFile = File(...)):
-
-    file.filename = f"{uuid.uuid4()}.jpg"
     contents = await file.read()
 
     # save the file
-    with open(f"{IMAGEDIR}{file.filename}", "wb") as f:
-        f.write(contents)
+    file.filename = os.path.basename(upload_store.put(contents, ".jpg"))
 
     return {"filename": file.filename}
 
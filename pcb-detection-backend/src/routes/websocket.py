@@ -20,6 +20,16 @@ from typing import Optional
 import logging
 import base64
 
+from ..function.camera import camera_manager
+from ..function.detection_pcb import (
+    copper_mask,
+    expand_contour,
+    four_point_transform,
+    order_points,
+)
+from ..function.governor import governor
+from ..function.metrics import frames_sent, stage
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,92 +37,6 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-def expand_contour(contour, percentage):
-    """Expand contour boundaries by given percentage"""
-    M = cv2.moments(contour)
-    if M["m00"] == 0:
-        return contour
-
-    cx = int(M["m10"] / M["m00"])
-    cy = int(M["m01"] / M["m00"])
-
-    expanded = []
-    for point in contour:
-        x, y = point[0]
-        dir_x = x - cx
-        dir_y = y - cy
-        new_x = cx + (1 + percentage) * dir_x
-        new_y = cy + (1 + percentage) * dir_y
-        expanded.append([[int(new_x), int(new_y)]])
-
-    return np.array(expanded, dtype=np.int32)
-
-
-def order_points(pts):
-    """Order 4 points as: top-left, top-right, bottom-right, bottom-left"""
-    rect = np.zeros((4, 2), dtype="float32")
-    s = pts.sum(axis=1)
-    rect[0] = pts[np.argmin(s)]
-    rect[2] = pts[np.argmax(s)]
-    diff = np.diff(pts, axis=1)
-    rect[1] = pts[np.argmin(diff)]
-    rect[3] = pts[np.argmax(diff)]
-    return rect
-
-
-def four_point_transform(image, pts):
-    """Perform perspective transform using 4 points"""
-    (tl, tr, br, bl) = pts
-    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    maxWidth = max(int(widthA), int(widthB))
-
-    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    maxHeight = max(int(heightA), int(heightB))
-
-    dst = np.array(
-        [[0, 0], [maxWidth - 1, 0], [maxWidth - 1, maxHeight - 1], [0, maxHeight - 1]],
-        dtype="float32",
-    )
-
-    M = cv2.getPerspectiveTransform(pts, dst)
-    warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
-    return warped
-
-
-class CameraManager:
-    def __init__(self):
-        self.camera: Optional[cv2.VideoCapture] = None
-        self.active_connections = 0
-        self.lock = asyncio.Lock()
-        self.frame_interval = 0.08
-
-    async def get_camera(self):
-        async with self.lock:
-            if self.camera is None or not self.camera.isOpened():
-                self.camera = cv2.VideoCapture(0)
-                if not self.camera.isOpened():
-                    logger.error("Failed to open camera")
-                    return None
-                # Optimize for Raspberry Pi
-                self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-                self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-                self.camera.set(cv2.CAP_PROP_FPS, 10)
-                logger.info("Camera opened (640x480 @ 10FPS)")
-            return self.camera
-
-    async def release_camera(self):
-        async with self.lock:
-            if self.camera and self.camera.isOpened():
-                self.camera.release()
-                self.camera = None
-                logger.info("Camera released")
-
-
-camera_manager = CameraManager()
-
-
 def image_preprocess(img):
     img = cv2.GaussianBlur(img, (5, 5), 0)
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
@@ -137,23 +61,17 @@ async def websocket_endpoint_factory(websocket: WebSocket):
             return
 
         while True:
-            ret, frame = camera.read()
+            ret, frame = await camera.next_frame()
             if not ret:
                 logger.error("Frame read failed")
                 break
 
-            hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-            lower_copper = np.array([5, 30, 5])
-            upper_copper = np.array([45, 255, 255])
-            mask = cv2.inRange(hsv, lower_copper, upper_copper)
-
-            kernel = np.ones((5, 5), np.uint8)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+            mask = copper_mask(frame)
 
-            contours, _ = cv2.findContours(
-                mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-            )
+            with stage("contour"):
+                contours, _ = cv2.findContours(
+                    mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+                )
 
             display_frame = frame.copy()
             pcb_frame = None
@@ -171,13 +89,18 @@ async def websocket_endpoint_factory(websocket: WebSocket):
                 if len(approx) == 4:
                     approx = order_points(approx.reshape(4, 2))
                     pcb_frame = four_point_transform(frame, approx)
+                    camera.wake("detection")
 
-            _, display_buffer = cv2.imencode(".jpg", display_frame)
-            await websocket.send_bytes(display_buffer.tobytes())
+            with stage("encode"):
+                _, display_buffer = cv2.imencode(".jpg", governor.preview(display_frame))
+            with stage("ws_send"):
+                await websocket.send_bytes(display_buffer.tobytes())
 
             if pcb_frame is not None:
-                _, pcb_buffer = cv2.imencode(".jpg", pcb_frame)
-                await websocket.send_bytes(pcb_buffer.tobytes())
+                with stage("encode"):
+                    _, pcb_buffer = cv2.imencode(".jpg", pcb_frame)
+                with stage("ws_send"):
+                    await websocket.send_bytes(pcb_buffer.tobytes())
             else:
 
                 empty_frame = np.zeros(
@@ -185,8 +108,9 @@ async def websocket_endpoint_factory(websocket: WebSocket):
                 )  # Send empty frame if no PCB detected
                 _, empty_buffer = cv2.imencode(".jpg", empty_frame)
                 await websocket.send_bytes(empty_buffer.tobytes())
+            frames_sent.inc()
 
-            await asyncio.sleep(camera_manager.frame_interval)
+            await asyncio.sleep(governor.frame_interval(camera_manager.frame_interval))
 
     except WebSocketDisconnect:
         logger.info("Client disconnected normally")
@@ -215,23 +139,17 @@ async def websocket_endpoint(websocket: WebSocket):
             return
 
         while True:
-            ret, frame = camera.read()
+            ret, frame = await camera.next_frame()
             if not ret:
                 logger.error("Frame read failed")
                 break
 
-            hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-            lower_copper = np.array([5, 30, 5])
-            upper_copper = np.array([45, 255, 255])
-            mask = cv2.inRange(hsv, lower_copper, upper_copper)
-
-            kernel = np.ones((5, 5), np.uint8)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+            mask = copper_mask(frame)
 
-            contours, _ = cv2.findContours(
-                mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-            )
+            with stage("contour"):
+                contours, _ = cv2.findContours(
+                    mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+                )
 
             display_frame = frame.copy()
             pcb_frame = None
@@ -249,13 +167,18 @@ async def websocket_endpoint(websocket: WebSocket):
                 if len(approx) == 4:
                     approx = order_points(approx.reshape(4, 2))
                     pcb_frame = four_point_transform(frame, approx)
+                    camera.wake("detection")
 
-            _, display_buffer = cv2.imencode(".jpg", display_frame)
-            await websocket.send_bytes(display_buffer.tobytes())
+            with stage("encode"):
+                _, display_buffer = cv2.imencode(".jpg", governor.preview(display_frame))
+            with stage("ws_send"):
+                await websocket.send_bytes(display_buffer.tobytes())
 
             if pcb_frame is not None:
-                _, pcb_buffer = cv2.imencode(".jpg", pcb_frame)
-                await websocket.send_bytes(pcb_buffer.tobytes())
+                with stage("encode"):
+                    _, pcb_buffer = cv2.imencode(".jpg", pcb_frame)
+                with stage("ws_send"):
+                    await websocket.send_bytes(pcb_buffer.tobytes())
             else:
 
                 empty_frame = np.zeros(
@@ -263,8 +186,9 @@ async def websocket_endpoint(websocket: WebSocket):
                 )  # Send empty frame if no PCB detected
                 _, empty_buffer = cv2.imencode(".jpg", empty_frame)
                 await websocket.send_bytes(empty_buffer.tobytes())
+            frames_sent.inc()
 
-            await asyncio.sleep(camera_manager.frame_interval)
+            await asyncio.sleep(governor.frame_interval(camera_manager.frame_interval))
 
     except WebSocketDisconnect:
         logger.info("Client disconnected normally")
@@ -0,0 +1,4 @@
+import os
+
+# gpiozero falls back to its mock pins, the hardware modules import anywhere
+os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+from gpiozero import Device
+
+from src.function.withRaspberrypi import SENSOR_PIN, BeamSensor
+
+
+@pytest.fixture
+def sensor():
+    sensor = BeamSensor()
+    yield sensor
+    sensor.close()
+    Device.pin_factory.reset()
+
+
+def beam_pin():
+    return Device.pin_factory.pin(SENSOR_PIN)
+
+
+def test_broken_beam_wakes_wait(sensor):
+    async def scenario():
+        sensor.attach(asyncio.get_running_loop())
+        waiting = asyncio.create_task(sensor.wait(timeout=1.0))
+        await asyncio.sleep(0)
+        # gpiozero fires the edge from its own thread
+        await asyncio.to_thread(beam_pin().drive_low)
+        return await waiting
+
+    assert asyncio.run(scenario()) is True
+    assert sensor.triggers == 1
+    assert sensor.last_trigger is not None
+
+
+def test_bouncing_edge_wakes_once(sensor):
+    assert beam_pin().bounce == pytest.approx(0.01)
+
+    async def scenario():
+        sensor.attach(asyncio.get_running_loop())
+        pin = beam_pin()
+        for _ in range(3):
+            pin.drive_low()
+            pin.drive_high()
+        first = await sensor.wait(timeout=1.0)
+        second = await sensor.wait(timeout=0.05)
+        return first, second
+
+    assert asyncio.run(scenario()) == (True, False)
+
+
+def test_wait_times_out_without_board(sensor):
+    async def scenario():
+        sensor.attach(asyncio.get_running_loop())
+        return await sensor.wait(timeout=0.05)
+
+    assert asyncio.run(scenario()) is False
+    assert sensor.triggers == 0
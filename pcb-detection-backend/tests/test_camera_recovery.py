@@ -0,0 +1,85 @@
+import subprocess
+import threading
+
+import numpy as np
+
+from src.function.camera import CameraManager, UsbPowerController
+
+
+class RecordingRunner:
+    """subprocess.run stand-in keeping the uhubctl commands"""
+
+    def __init__(self, fail_on=None):
+        self.commands = []
+        self.fail_on = fail_on
+
+    def __call__(self, command, **kwargs):
+        self.commands.append(command)
+        if command[-1] == self.fail_on:
+            raise subprocess.TimeoutExpired(command, kwargs.get("timeout"))
+
+
+def test_power_cycle_switches_the_port_off_then_on():
+    runner = RecordingRunner()
+    usb_power = UsbPowerController(location="1-1", port=2, off_seconds=0, runner=runner)
+
+    assert usb_power.power_cycle() is True
+    assert runner.commands == [
+        ["sudo", "uhubctl", "-l", "1-1", "-p", "2", "-a", "off"],
+        ["sudo", "uhubctl", "-l", "1-1", "-p", "2", "-a", "on"],
+    ]
+
+
+def test_power_cycle_stops_when_the_port_cannot_be_switched_off():
+    runner = RecordingRunner(fail_on="off")
+    usb_power = UsbPowerController(off_seconds=0, runner=runner)
+
+    assert usb_power.power_cycle() is False
+    assert [command[-1] for command in runner.commands] == ["off"]
+
+
+def test_hung_read_escalates_to_power_cycle():
+    powered = threading.Event()
+
+    class HungCapture:
+        """Blocks in read() until the USB port has been power-cycled"""
+
+        def __init__(self, source):
+            pass
+
+        def isOpened(self):
+            return True
+
+        def set(self, prop, value):
+            return True
+
+        def read(self):
+            if not powered.is_set():
+                threading.Event().wait(5)
+            return True, np.zeros((4, 4, 3), np.uint8)
+
+        def release(self):
+            pass
+
+    runner = RecordingRunner()
+
+    def power(command, **kwargs):
+        runner(command, **kwargs)
+        if command[-1] == "on":
+            powered.set()
+
+    manager = CameraManager(
+        capture_factory=HungCapture,
+        stall_timeout=0.2,
+        power_cycle_after=5,
+        usb_power=UsbPowerController(off_seconds=0, runner=power),
+    )
+    try:
+        manager._recover()
+        # the first probe hangs, the second attempt power-cycles and succeeds
+        assert manager.camera is not None
+        assert manager.power_cycles == 1
+        assert manager.reopens == 2
+        assert [command[-1] for command in runner.commands] == ["off", "on"]
+    finally:
+        manager._stop.set()
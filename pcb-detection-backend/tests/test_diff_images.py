@@ -0,0 +1,16 @@
+import cv2
+import numpy as np
+
+from src.function.inspection import diff_images
+
+
+def test_accuracy_counts_defect_holes():
+    template = np.full((100, 100), 100, np.uint8)
+    aligned = template.copy()
+    cv2.rectangle(aligned, (20, 20), (59, 59), 255, 4)
+
+    inspected = diff_images(template, aligned)
+
+    # the whole 40x40 square is a defect, not only its 4px outline
+    assert inspected["accuracy"] <= 100 * (1 - 40 * 40 / (100 * 100))
+    assert len(inspected["defects"]) == 1
@@ -0,0 +1,80 @@
+import pytest
+
+from src.function.governor import PipelineGovernor
+
+CPUFREQ = "devices/system/cpu/cpu0/cpufreq"
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    """A fake PCB_SYSFS_ROOT with the thermal zone and cpufreq files"""
+    (tmp_path / "class/thermal/thermal_zone0").mkdir(parents=True)
+    (tmp_path / CPUFREQ).mkdir(parents=True)
+
+    def write(temperature_c=50.0, cur_khz=1500000, max_khz=1500000):
+        (tmp_path / "class/thermal/thermal_zone0/temp").write_text(
+            f"{int(temperature_c * 1000)}\n"
+        )
+        (tmp_path / CPUFREQ / "scaling_cur_freq").write_text(f"{cur_khz}\n")
+        (tmp_path / CPUFREQ / "scaling_max_freq").write_text(f"{max_khz}\n")
+
+    write()
+    return tmp_path, write
+
+
+def step_at(governor, now):
+    governor.sample()
+    governor.evaluate(now)
+    return governor.step["name"]
+
+
+def test_reads_the_fake_tree(sysfs):
+    root, write = sysfs
+    write(temperature_c=61.5, cur_khz=1200000, max_khz=1800000)
+    governor = PipelineGovernor(sysfs_root=str(root))
+
+    governor.sample()
+    assert governor.temperature_c == pytest.approx(61.5)
+    assert (governor.cpu_freq_khz, governor.cpu_max_freq_khz) == (1200000, 1800000)
+    assert governor.throttled()
+
+
+def test_rises_at_once_and_relaxes_one_step_at_a_time(sysfs):
+    root, write = sysfs
+    governor = PipelineGovernor(sysfs_root=str(root), relax_after=30.0)
+
+    assert step_at(governor, 0.0) == "normal"
+    write(temperature_c=79.0)
+    assert step_at(governor, 1.0) == "critical"
+
+    write(temperature_c=50.0)
+    assert step_at(governor, 10.0) == "critical"
+    assert step_at(governor, 31.0) == "hot"
+    assert step_at(governor, 40.0) == "hot"
+    assert step_at(governor, 61.0) == "warm"
+    assert step_at(governor, 91.0) == "normal"
+    assert governor.changes == 4
+    assert [entry["step"] for entry in governor.history] == [
+        "critical",
+        "hot",
+        "warm",
+        "normal",
+    ]
+
+
+def test_throttled_clock_steps_to_hot(sysfs):
+    root, write = sysfs
+    write(temperature_c=50.0, cur_khz=600000, max_khz=1500000)
+    governor = PipelineGovernor(sysfs_root=str(root))
+
+    assert step_at(governor, 0.0) == "hot"
+    assert governor.should_detect(1) is False
+    assert governor.should_detect(1, busy=True) is True
+
+
+def test_missing_files_keep_the_normal_step(tmp_path):
+    governor = PipelineGovernor(sysfs_root=str(tmp_path))
+
+    assert step_at(governor, 0.0) == "normal"
+    assert governor.temperature_c is None
+    assert not governor.throttled()
@@ -0,0 +1,24 @@
+import time
+
+from src.function.inspection import InspectionPool
+
+
+def sleeper(seconds, deadline=None, cancel_event=None):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_run_seconds_excludes_the_wait_before_running():
+    pool = InspectionPool(max_workers=1)
+    try:
+        busy = pool.submit(1, None, None, sleeper, 0.3)
+        queued = pool.submit(2, None, None, sleeper, 0.05)
+        assert queued.run_seconds() is None
+
+        assert queued.future.result(timeout=2) == 0.05
+        waited = queued.finished - queued.submitted
+        assert waited >= 0.3
+        assert 0.05 <= queued.run_seconds() < 0.2
+        assert busy.run_seconds() >= 0.3
+    finally:
+        pool.shutdown()
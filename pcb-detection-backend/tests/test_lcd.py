@@ -0,0 +1,38 @@
+import time
+
+from src.function import withRaspberrypi
+
+
+class FlakyCharLCD:
+    def __init__(self, *args, **kwargs):
+        self.failures = 1
+        self.rows = {}
+        self.cursor_pos = (0, 0)
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write_string(self, text):
+        if self.failures:
+            self.failures -= 1
+            raise OSError(121, "Remote I/O error")
+        row, col = self.cursor_pos
+        line = self.rows.get(row, " " * 16)
+        self.rows[row] = line[:col] + text + line[col + len(text) :]
+
+
+def test_writer_survives_a_bus_error(monkeypatch):
+    monkeypatch.setattr(withRaspberrypi, "CharLCD", FlakyCharLCD)
+    lcd = withRaspberrypi.Lcd(max_rate=100.0)
+
+    lcd.show("Running", "PCB 12")
+    deadline = time.monotonic() + 2.0
+    while lcd.lcd.rows != {0: "Running".ljust(16), 1: "PCB 12".ljust(16)}:
+        assert time.monotonic() < deadline, lcd.lcd.rows
+        time.sleep(0.01)
+
+    assert lcd._thread.is_alive()
+    lcd.close()
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+from src.function.metrics import active_stages, render, stage
+
+
+def test_cpu_seconds_is_a_counter():
+    lines = render().splitlines()
+
+    assert "# TYPE pcb_process_cpu_seconds_total counter" in lines
+    assert not any(line.startswith("pcb_process_cpu_seconds ") for line in lines)
+
+
+def test_monotonic_totals_are_counters():
+    from src.function import camera, loop_monitor, persistence  # noqa: F401
+
+    lines = render().splitlines()
+
+    for name in (
+        "pcb_camera_stalls_total",
+        "pcb_persistence_written_total",
+        "pcb_event_loop_blocked_seconds_total",
+    ):
+        assert f"# TYPE {name} counter" in lines
+    assert "# TYPE pcb_persistence_queue_depth gauge" in lines
+
+
+def test_finished_stages_leave_no_thread_entry():
+    seen = {}
+
+    def work():
+        with stage("warp"):
+            with stage("encode"):
+                seen["open"] = list(active_stages[threading.get_ident()])
+        seen["after"] = threading.get_ident() in active_stages
+
+    worker = threading.Thread(target=work)
+    worker.start()
+    worker.join()
+
+    assert seen == {"open": ["warp", "encode"], "after": False}
+
+
+
+def test_interleaved_coroutines_leave_no_stage_behind():
+    seen = {}
+
+    async def board(name, entered, leave):
+        with stage(name):
+            entered.set()
+            await leave.wait()
+
+    async def main():
+        a_in, b_in, a_out, b_out = (asyncio.Event() for _ in range(4))
+        a = asyncio.create_task(board("registration", a_in, a_out))
+        await a_in.wait()
+        b = asyncio.create_task(board("diff", b_in, b_out))
+        await b_in.wait()
+        a_out.set()
+        await a
+        seen["remaining"] = list(active_stages[threading.get_ident()])
+        b_out.set()
+        await b
+
+    def work():
+        asyncio.run(main())
+        seen["after"] = threading.get_ident() in active_stages
+
+    worker = threading.Thread(target=work)
+    worker.start()
+    worker.join()
+
+    assert seen == {"remaining": ["diff"], "after": False}
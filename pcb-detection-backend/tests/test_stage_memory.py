@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+from src.function.memory import MB, MemoryBudgetExceeded, memory_tracker, track_stage_memory
+from src.function.metrics import stage
+
+
+def allocate(name, size_bytes):
+    with stage(name):
+        buffer = np.ones(size_bytes, np.uint8)
+        del buffer
+
+
+def test_stage_over_budget_is_flagged():
+    with pytest.raises(MemoryBudgetExceeded, match="diff"):
+        with track_stage_memory({"diff": 1 * MB, "warp": 16 * MB}):
+            allocate("diff", 4 * MB)
+            allocate("warp", 4 * MB)
+
+    exceeded = memory_tracker.over_budget({"diff": 1 * MB, "warp": 16 * MB})
+    assert list(exceeded) == ["diff"]
+    assert exceeded["diff"]["peak_bytes"] >= 4 * MB
+    assert not memory_tracker.enabled
+
+
+def test_stages_within_budget_pass():
+    with track_stage_memory({"diff": 16 * MB}) as tracker:
+        allocate("diff", 2 * MB)
+
+    stats = tracker.report()["stages"]["diff"]
+    assert stats["calls"] == 1
+    assert 2 * MB <= stats["peak_bytes"] < 16 * MB
+    # the buffer was freed inside the stage
+    assert stats["retained_bytes"] < 1 * MB
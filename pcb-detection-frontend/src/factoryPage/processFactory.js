@@ -17,6 +17,13 @@ import "../page/uploadPage.css";
 import Delete from "../components/Delete.js";
 
 import { Button } from "../page/uploadPCBChecked.js";
+
+// list entries of regenerated results carry a URL instead of the bytes
+const resultImageSrc = (image) =>
+  image.image_data
+    ? `data:image/jpeg;base64,${image.image_data}`
+    : `http://${window.location.hostname}:8000${image.image_url}`;
+
 export default function ProcessFactoryWorkflow() {
   const [originalImageFactory, setOriginalImageFactory] = useState(null);
   const [cameraFeed, setCameraFeed] = useState(null);
@@ -538,7 +545,7 @@ export default function ProcessFactoryWorkflow() {
                       >
                         <div className="aspect-square bg-black rounded-lg overflow-hidden flex items-center justify-center">
                           <img
-                            src={`data:image/jpeg;base64,${result.imageList.image_data}`}
+                            src={resultImageSrc(result.imageList)}
                             alt={result.imageList.filename}
                             className="h-full w-full object-contain"
                           />
@@ -635,7 +642,7 @@ export default function ProcessFactoryWorkflow() {
               </svg>
             </button>
             <img
-              src={`data:image/jpeg;base64,${previewImage.image_data}`}
+              src={resultImageSrc(previewImage)}
               alt={previewImage.filename}
               className="w-full max-h-[70vh] object-contain mx-auto"
             />